@@ -1,7 +1,10 @@
 from accounts.models import UserProfile
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.cache import caches
 from twitter.cache import USER_PROFILE_PATTERN
+from utils.local_cache import local_cache
+from utils.memcached_helper import MemcachedHelper
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -11,16 +14,96 @@ class UserService:
     @classmethod
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        # first layer of cache, in process
+        profile = local_cache.get(key)
+        if profile is not None:
+            return profile
         # read from cache first
         profile = cache.get(key)
         if profile is not None:
+            local_cache.set(key, profile)
             return profile
         # cache miss, read from database
         profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
         cache.set(key, profile)
+        local_cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        """
+        Multi-get of profiles, returns {user id: profile}
+        """
+        keys = {
+            USER_PROFILE_PATTERN.format(user_id=user_id): user_id
+            for user_id in set(user_ids)
+        }
+        # first layer of cache, in process
+        cached_profiles = local_cache.get_many(keys.keys())
+        missing_keys = [key for key in keys if key not in cached_profiles]
+        # read from cache first
+        if missing_keys:
+            memcached_profiles = cache.get_many(missing_keys)
+            local_cache.set_many(memcached_profiles)
+            cached_profiles.update(memcached_profiles)
+        profiles = {
+            keys[key]: profile
+            for key, profile in cached_profiles.items()
+        }
+        missing_ids = [
+            user_id
+            for user_id in keys.values()
+            if user_id not in profiles
+        ]
+        if not missing_ids:
+            return profiles
+
+        # cache miss, read from database
+        missing_profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=missing_ids)
+        }
+        for user_id in missing_ids:
+            if user_id not in missing_profiles:
+                missing_profiles[user_id], _ = UserProfile.objects.get_or_create(
+                    user_id=user_id,
+                )
+        missing_profiles_by_key = {
+            USER_PROFILE_PATTERN.format(user_id=user_id): profile
+            for user_id, profile in missing_profiles.items()
+        }
+        cache.set_many(missing_profiles_by_key)
+        local_cache.set_many(missing_profiles_by_key)
+        profiles.update(missing_profiles)
+        return profiles
+
+    @classmethod
+    def get_users_through_cache(cls, user_ids):
+        """
+        Users with their profiles, in one multi-get of users
+        and one multi-get of profiles
+        """
+        users = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        profiles = cls.get_profiles_through_cache(users.keys())
+        for user_id, user in users.items():
+            setattr(user, '_cached_user_profile', profiles[user_id])
+        return users
+
+    @classmethod
+    def prefetch_users(cls, objects, user_id_field='user_id', cached_field='_cached_user'):
+        """
+        Hydrate the users of a page of objects, read back by the
+        cached_user like properties of the models
+        """
+        users = cls.get_users_through_cache([
+            getattr(obj, user_id_field)
+            for obj in objects
+        ])
+        for obj in objects:
+            setattr(obj, cached_field, users.get(getattr(obj, user_id_field)))
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+        local_cache.invalidate(key)
@@ -1,9 +1,13 @@
 from testing.testcases import TestCase
 from accounts.models import UserProfile
+from accounts.services import UserService
 
 
 class UserProfileTests(TestCase):
 
+    def setUp(self):
+        self.clear_cache()
+
     def test_profile_property(self):
         user = self.create_user('user')
         self.assertEqual(UserProfile.objects.count(), 0)
@@ -11,3 +15,20 @@ class UserProfileTests(TestCase):
         p = user.profile
         self.assertEqual(isinstance(p, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_get_users_through_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        users[0].profile
+        user_ids = [user.id for user in users]
+
+        # cache miss: users, profiles, and profiles not created yet
+        users_by_id = UserService.get_users_through_cache(user_ids)
+        self.assertEqual(set(users_by_id.keys()), set(user_ids))
+        self.assertEqual(UserProfile.objects.count(), 3)
+
+        # cache hit, no query at all
+        with self.assertNumQueries(0):
+            users_by_id = UserService.get_users_through_cache(user_ids)
+            for user in users:
+                self.assertEqual(users_by_id[user.id].username, user.username)
+                self.assertEqual(users_by_id[user.id].profile.user_id, user.id)
@@ -1,9 +1,12 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -23,11 +26,28 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, comments):
+        UserService.prefetch_users(comments)
+        # load counters of the whole page in one round trip
+        self._prefetched_counts = RedisHelper.get_counts(comments, ['likes_count'])
+        self._prefetched_liked_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Comment,
+            [comment.id for comment in comments],
+        )
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        counts = getattr(self, '_prefetched_counts', {}).get(obj.id, {})
+        if 'likes_count' in counts:
+            return counts['likes_count']
+        return RedisHelper.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
+        liked_ids = getattr(self, '_prefetched_liked_ids', None)
+        if liked_ids is not None:
+            return obj.id in liked_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
 
@@ -45,7 +65,7 @@ class CommentSerializerForCreate(serializers.ModelSerializer):
 
     def validate(self, data):
         tweet_id = data['tweet_id']
-        if not Tweet.objects.filter(id=tweet_id).exists():
+        if not Tweet.objects.filter(id=tweet_id, has_deleted=False).exists():
             raise ValidationError({
                 'message': 'tweet dose not exist',
             })
@@ -1,8 +1,11 @@
 from comments.models import Comment
+from django.conf import settings
+from django.test import override_settings
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 COMMENT_URL = '/api/comments/'
 COMMENT_DETAIL_URL = '/api/comments/{}/'
@@ -204,3 +207,57 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.data['comments_count'], 2)
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 2)
+
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        # older comments fall out of the cached list
+        comments = [
+            self.create_comment(self.user1, self.tweet, 'comment {}'.format(i))
+            for i in range(settings.REDIS_LIST_LENGTH_LIMIT + 5)
+        ]
+
+        # latest page first, in created_at order
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [c['id'] for c in response.data['comments']],
+            [c.id for c in comments[-page_size:]],
+        )
+
+        # older pages, the last one read from db
+        pages = []
+        created_at__lt = comments[-page_size].created_at
+        while True:
+            response = self.anonymous_client.get(COMMENT_URL, {
+                'tweet_id': self.tweet.id,
+                'created_at__lt': created_at__lt,
+            })
+            ids = [c['id'] for c in response.data['comments']]
+            pages.append(ids)
+            if not response.data['has_next_page']:
+                break
+            created_at__lt = Comment.objects.get(id=ids[0]).created_at
+        self.assertEqual(
+            sum(pages[::-1], []),
+            [c.id for c in comments[:-page_size]],
+        )
+
+        # newer comments
+        new_comment = self.create_comment(self.user2, self.tweet, 'new comment')
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'created_at__gt': comments[-1].created_at,
+        })
+        self.assertEqual([c['id'] for c in response.data['comments']], [new_comment.id])
+
+        # updates and deletes are applied to the cached list
+        self.user2_client.put(COMMENT_DETAIL_URL.format(new_comment.id), {'content': 'updated'})
+        self.user1_client.delete(COMMENT_DETAIL_URL.format(comments[-1].id))
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['comments'][-1]['content'], 'updated')
+        self.assertEqual(comments[-1].id in [c['id'] for c in response.data['comments']], False)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_list_pagination_in_sorted_set(self):
+        self.test_list_pagination()
+
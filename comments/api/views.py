@@ -5,17 +5,21 @@ from comments.api.serializers import (
     CommentSerializerForUpdate,
 )
 from comments.models import Comment
+from comments.services import CommentService
+from functools import partial
 from inbox.services import NotificationService
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
 from utils.permissions import IsObjectOwner
 
 class CommentViewSet(viewsets.GenericViewSet):
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
     filterset_fields = ('tweet_id',)
+    pagination_class = EndlessPagination
 
     def get_permissions(self):
         if self.action == 'create':
@@ -26,17 +30,25 @@ class CommentViewSet(viewsets.GenericViewSet):
 
     @required_params(params=['tweet_id'])
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        comments = self.filter_queryset(queryset) \
-            .prefetch_related('user') \
-            .order_by('created_at')
+        tweet_id = request.query_params['tweet_id']
+        # pages go back in time from the latest comments, only the page
+        # needed is loaded from cache and completed from db past it
+        page = self.paginator.paginate_stitched_window(
+            partial(CommentService.get_cached_comments_window, tweet_id),
+            Comment.objects.filter(tweet_id=tweet_id),
+            request,
+        )
+        # comments of a page are shown in created_at order
         serializer = CommentSerializer(
-            comments,
+            list(page)[::-1],
             context={'request': request},
             many=True,
         )
         return Response({
-            'comments': serializer.data
+            'comments': serializer.data,
+            'has_next_page': self.paginator.has_next_page,
+            'next_cursor': self.paginator.get_next_cursor(),
+            'previous_cursor': self.paginator.get_previous_cursor(),
         }, status=status.HTTP_200_OK)
 
     def create(self, request, *args, **kwargs):
@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
@@ -9,6 +10,13 @@ def incr_comments_count(sender, instance, created, **kwargs):
     if not created:
         return
 
+    if settings.COUNTER_WRITE_BEHIND:
+        # only touch redis, the delta is flushed to db in batch
+        tweet = Tweet(id=instance.tweet_id)
+        RedisHelper.add_pending_count(tweet, 'comments_count', 1)
+        RedisHelper.incr_count(tweet, 'comments_count')
+        return
+
     Tweet.objects.filter(id=instance.tweet_id) \
         .update(comments_count=F('comments_count') + 1)
     RedisHelper.incr_count(instance.tweet, 'comments_count')
@@ -18,6 +26,30 @@ def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
+    if settings.COUNTER_WRITE_BEHIND:
+        tweet = Tweet(id=instance.tweet_id)
+        RedisHelper.add_pending_count(tweet, 'comments_count', -1)
+        RedisHelper.decr_count(tweet, 'comments_count')
+        return
+
     Tweet.objects.filter(id=instance.tweet_id) \
         .update(comments_count=F('comments_count') - 1)
     RedisHelper.decr_count(instance.tweet, 'comments_count')
+
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    from comments.services import CommentService
+    if created:
+        CommentService.push_comment_to_cache(instance)
+    else:
+        CommentService.update_comment_in_cache(instance)
+
+
+def remove_comment_from_cache(sender, instance, **kwargs):
+    from comments.services import CommentService
+    CommentService.remove_comment_from_cache(instance)
+
+
+def invalidate_tweet_detail(sender, instance, **kwargs):
+    from tweets.services import TweetService
+    TweetService.invalidate_cached_detail(instance.tweet_id)
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.3 on 2026-10-17 13:22
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_likes_count(apps, schema_editor):
+    Comment = apps.get_model('comments', 'Comment')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Like = apps.get_model('likes', 'Like')
+    content_type = ContentType.objects.filter(app_label='comments', model='comment').first()
+    if content_type is None:
+        return
+    likes_counts = Like.objects.filter(content_type=content_type) \
+        .values('object_id') \
+        .annotate(count=Count('id')) \
+        .values_list('object_id', 'count')
+    for comment_id, count in likes_counts:
+        Comment.objects.filter(id=comment_id).update(likes_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0001_initial'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('likes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='likes_count',
+            field=models.IntegerField(default=0, null=True),
+        ),
+        migrations.RunPython(backfill_likes_count, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,25 @@
-from comments.listeners import incr_comments_count, decr_comments_count
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    invalidate_tweet_detail,
+    push_comment_to_cache,
+    remove_comment_from_cache,
+)
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
+from django.db.models.signals import post_delete, pre_delete, post_save
 from likes.models import Like
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_serializers import CompactModelSerializer
 
 
 class Comment(models.Model):
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     tweet = models.ForeignKey(Tweet, null=True, on_delete=models.SET_NULL)
     content = models.TextField(max_length=140)
+    likes_count = models.IntegerField(default=0, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -35,8 +43,28 @@ class Comment(models.Model):
 
     @property
     def cached_user(self):
+        # hydrated in bulk by UserService.prefetch_users
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
 pre_delete.connect(decr_comments_count, sender=Comment)
 post_save.connect(incr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+# removed and invalidated once the row is gone, a read in between would
+# cache it again
+post_delete.connect(remove_comment_from_cache, sender=Comment)
+post_save.connect(invalidate_tweet_detail, sender=Comment)
+post_delete.connect(invalidate_tweet_detail, sender=Comment)
+
+# field layout of comments cached in redis lists, likes_count is left out
+# since it is served by the redis counters
+CompactModelSerializer.register(Comment, code=3, version=1, fields=(
+    'id',
+    'user_id',
+    'tweet_id',
+    'content',
+    'created_at',
+    'updated_at',
+))
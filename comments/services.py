@@ -0,0 +1,47 @@
+from comments.models import Comment
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_helper import get_timeline_helper
+
+
+class CommentService(object):
+
+    @classmethod
+    def get_cached_comments_window(cls, tweet_id, count, created_at__lt=None, created_at__gt=None):
+        queryset = Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at', '-id')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return get_timeline_helper().load_objects_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+
+    @classmethod
+    def get_comments_window(cls, tweet_id, count, created_at__lt=None, created_at__gt=None):
+        # complete window, comments beyond the cached list are read from db
+        queryset = Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at', '-id')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return get_timeline_helper().load_complete_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        queryset = Comment.objects.filter(tweet_id=comment.tweet_id).order_by('-created_at', '-id')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        get_timeline_helper().push_object(key, comment, queryset)
+
+    @classmethod
+    def update_comment_in_cache(cls, comment):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        get_timeline_helper().replace_object(key, comment)
+
+    @classmethod
+    def remove_comment_from_cache(cls, comment):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        get_timeline_helper().remove_objects(key, [comment.id])
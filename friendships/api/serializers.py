@@ -1,25 +1,44 @@
 from accounts.api.serializers import UserSerializerForFriendship
+from accounts.services import UserService
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from rest_framework import serializers
 
 from rest_framework.exceptions import ValidationError
+from utils.serializers import PrefetchListSerializer
 
 
 class FollowingUserIdSetMixin:
-    @property
-    def following_user_id_set(self: serializers.ModelSerializer):
-        if self.context['request'].user.is_anonymous:
-            return {}
+    """
+    has_followed of the request user, resolved for a whole page by
+    prefetch_followed_user_ids in one batched membership query
+    """
+
+    def prefetch_followed_user_ids(self: serializers.ModelSerializer, user_ids):
+        user = self.context['request'].user
+        user_ids = set(user_ids)
+        followed_user_ids = set()
+        if not user.is_anonymous:
+            followed_user_ids = FriendshipService.get_followed_user_ids(user.id, user_ids)
         # first layer of cache, in request
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
-            self.context['request'].user.id,
-        )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        # user_id_set is a set of the following users id of the request user
-        return user_id_set
+        self._cached_has_followed = {
+            user_id: user_id in followed_user_ids
+            for user_id in user_ids
+        }
+
+    def has_followed(self: serializers.ModelSerializer, user_id):
+        if self.context['request'].user.is_anonymous:
+            return False
+        if not hasattr(self, '_cached_has_followed'):
+            self._cached_has_followed = {}
+        if user_id not in self._cached_has_followed:
+            # not prefetched, such as a single object
+            followed_user_ids = FriendshipService.get_followed_user_ids(
+                self.context['request'].user.id,
+                [user_id],
+            )
+            self._cached_has_followed[user_id] = user_id in followed_user_ids
+        return self._cached_has_followed[user_id]
 
 
 class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
@@ -30,10 +49,19 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        UserService.prefetch_users(
+            friendships,
+            user_id_field='from_user_id',
+            cached_field='_cached_from_user',
+        )
+        self.prefetch_followed_user_ids(f.from_user_id for f in friendships)
 
     def get_has_followed(self, obj):
         # if the request user followed users in the followers list
-        return obj.from_user_id in self.following_user_id_set
+        return self.has_followed(obj.from_user_id)
 
 
 class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
@@ -43,10 +71,19 @@ class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        UserService.prefetch_users(
+            friendships,
+            user_id_field='to_user_id',
+            cached_field='_cached_to_user',
+        )
+        self.prefetch_followed_user_ids(f.to_user_id for f in friendships)
 
     def get_has_followed(self, obj):
         # if the request user followed users in the following list
-        return obj.to_user_id in self.following_user_id_set
+        return self.has_followed(obj.to_user_id)
 
 
 class FriendshipSerializerForCreate(serializers.ModelSerializer):
@@ -1,4 +1,9 @@
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from friendships.models import Friendship
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
@@ -8,6 +13,7 @@ FOLLOW_URL = '/api/friendships/{}/follow/'
 UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 FOLLOWERS_URL = '/api/friendships/{}/followers/'
 FOLLOWINGS_URL = '/api/friendships/{}/followings/'
+NEWSFEEDS_URL = '/api/newsfeeds/'
 
 
 class FriendshipApiTests(TestCase):
@@ -237,3 +243,97 @@ class FriendshipApiTests(TestCase):
         self.assertEqual(response.data['total_pages'], 2)
         self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
+
+    def test_followers_pagination_by_cursor(self):
+        page_size = FriendshipPagination.page_size
+        Friendship.objects.all().delete()
+        followers = []
+        for i in range(page_size * 2 + 1):
+            follower = self.create_user('user1_follower_{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.user1)
+            followers.append(follower)
+        # all created in the same microsecond
+        created_at = Friendship.objects.first().created_at
+        Friendship.objects.filter(to_user=self.user1).update(created_at=created_at)
+
+        url = FOLLOWERS_URL.format(self.user1.id)
+        params, user_ids = {'cursor': ''}, []
+        while True:
+            with CaptureQueriesContext(connection) as context:
+                response = self.anonymous_client.get(url, params)
+            for query in context.captured_queries:
+                self.assertNotIn('COUNT(', query['sql'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('total_results', response.data)
+            user_ids.extend(result['user']['id'] for result in response.data['results'])
+            if not response.data['has_next_page']:
+                self.assertEqual(response.data['next_cursor'], None)
+                break
+            params = {'cursor': response.data['next_cursor']}
+        self.assertEqual(user_ids, [follower.id for follower in reversed(followers)])
+
+        # invalid cursor
+        response = self.anonymous_client.get(url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_followers_total_results_from_cached_count(self):
+        url = FOLLOWERS_URL.format(self.user1.id)
+        response = self.anonymous_client.get(url, {'page': 1})
+        self.assertEqual(response.data['total_results'], 2)
+
+        response = self.user2_client.post(FOLLOW_URL.format(self.user1.id))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with CaptureQueriesContext(connection) as context:
+            response = self.anonymous_client.get(url, {'page': 1})
+        for query in context.captured_queries:
+            self.assertNotIn('COUNT(', query['sql'])
+        self.assertEqual(response.data['total_results'], 3)
+        self.assertEqual(len(response.data['results']), 3)
+
+        self.user2_client.post(UNFOLLOW_URL.format(self.user1.id))
+        response = self.anonymous_client.get(url, {'page': 1})
+        self.assertEqual(response.data['total_results'], 2)
+        response = self.anonymous_client.get(FOLLOWINGS_URL.format(self.user1.id), {'page': 1})
+        self.assertEqual(response.data['total_results'], 3)
+
+    def test_follow_and_unfollow_update_newsfeeds(self):
+        # user2 reads the newsfeeds, so they are active and cached
+        followed_user = self.create_user('followed')
+        self.create_friendship(self.user2, followed_user)
+        tweet_ids = []
+        for i in range(4):
+            user = [self.user1, followed_user][i % 2]
+            tweet = self.create_tweet(user, 'tweet {}'.format(i))
+            if user == followed_user:
+                NewsFeedService.fanout_to_followers(tweet)
+            tweet_ids.append(tweet.id)
+        tweet_ids = tweet_ids[::-1]
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['results']), 2)
+
+        # the tweets of user1 are merged in order
+        self.user2_client.post(FOLLOW_URL.format(self.user1.id))
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], tweet_ids)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 4)
+        # duplicated follow events change nothing
+        NewsFeedService.backfill_followed_tweets(self.user2.id, self.user1.id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 4)
+
+        self.user2_client.post(UNFOLLOW_URL.format(self.user1.id))
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], tweet_ids[::2])
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 2)
+
+        # a follow event handled after the unfollow is ignored
+        NewsFeedService.backfill_followed_tweets(self.user2.id, self.user1.id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 2)
+        # an unfollow event handled after a new follow is ignored
+        self.user2_client.post(FOLLOW_URL.format(self.user1.id))
+        NewsFeedService.purge_unfollowed_tweets(self.user2.id, self.user1.id)
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], tweet_ids)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_follow_and_unfollow_update_newsfeeds_in_sorted_set(self):
+        self.test_follow_and_unfollow_update_newsfeeds()
@@ -5,6 +5,9 @@ from friendships.api.serializers import (
     FriendshipSerializerForCreate,
 )
 from friendships.models import Friendship
+from friendships.services import FriendshipService
+from functools import partial
+from newsfeeds.services import NewsFeedService
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -21,11 +24,19 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     def followers(self, request, pk):
         # check if user with id=pk exists
         # if non exist, will raise 404 error
-        self.get_object()
+        user = self.get_object()
 
         # GET /api/friendships/<pk>/followers/
-        friendships = Friendship.objects.filter(to_user_id=pk)
-        page = self.paginate_queryset(friendships)
+        # pages are read from the cached follower ids, from db while they
+        # are loaded, total_results is served by the cached follower count
+        friendships, load_window = FriendshipService.get_followers_to_page(user.id)
+        page = self.paginator.paginate_queryset(
+            friendships,
+            request,
+            view=self,
+            get_count=partial(FriendshipService.get_follower_count, user.id),
+            load_window=load_window,
+        )
         serializer = FollowerSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
@@ -33,10 +44,16 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     def followings(self, request, pk):
         # check if user with id=pk exists
         # if non exist, will raise 404 error
-        self.get_object()
+        user = self.get_object()
 
-        friendships = Friendship.objects.filter(from_user_id=pk)
-        page = self.paginate_queryset(friendships)
+        friendships, load_window = FriendshipService.get_followings_to_page(user.id)
+        page = self.paginator.paginate_queryset(
+            friendships,
+            request,
+            view=self,
+            get_count=partial(FriendshipService.get_following_count, user.id),
+            load_window=load_window,
+        )
         serializer = FollowingSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
@@ -67,6 +84,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         instance = serializer.save()
+        NewsFeedService.backfill_followed_tweets(request.user.id, instance.to_user_id)
         return Response(
             FollowingSerializer(instance, context={'request': request}).data,
             status=status.HTTP_201_CREATED,
@@ -89,6 +107,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             from_user=request.user,
             to_user=unfollow_user,
         ).delete()
+        if deleted:
+            NewsFeedService.purge_unfollowed_tweets(request.user.id, unfollow_user.id)
         return Response({'success': True, 'deleted': deleted})
 
     def list(self, request):
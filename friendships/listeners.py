@@ -1,3 +1,22 @@
-def invalidate_following_cache(sender, instance, **kwargs):
+def incr_friendship_counts(sender, instance, created, **kwargs):
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    if not created:
+        return
+    FriendshipService.update_counts(instance, 1)
+
+
+def decr_friendship_counts(sender, instance, **kwargs):
+    from friendships.services import FriendshipService
+    FriendshipService.update_counts(instance, -1)
+
+
+def push_friendship_to_cache(sender, instance, created, **kwargs):
+    from friendships.services import FriendshipService
+    if not created:
+        return
+    FriendshipService.push_friendship_to_cache(instance)
+
+
+def remove_friendship_from_cache(sender, instance, **kwargs):
+    from friendships.services import FriendshipService
+    FriendshipService.remove_friendship_from_cache(instance)
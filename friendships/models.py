@@ -1,8 +1,13 @@
 from accounts.services import UserService
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save, pre_delete
-from friendships.listeners import invalidate_following_cache
+from django.db.models.signals import post_delete, post_save
+from friendships.listeners import (
+    decr_friendship_counts,
+    incr_friendship_counts,
+    push_friendship_to_cache,
+    remove_friendship_from_cache,
+)
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -36,13 +41,20 @@ class Friendship(models.Model):
 
     @property
     def cached_from_user(self):
+        # hydrated in bulk by UserService.prefetch_users
+        if hasattr(self, '_cached_from_user'):
+            return self._cached_from_user
         return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
 
     @property
     def cached_to_user(self):
+        if hasattr(self, '_cached_to_user'):
+            return self._cached_to_user
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
 
-# hook up with listeners to invalidate cache
-pre_delete.connect(invalidate_following_cache, sender=Friendship)
-post_save.connect(invalidate_following_cache, sender=Friendship)
+# hook up with listeners to update cache
+post_save.connect(incr_friendship_counts, sender=Friendship)
+post_delete.connect(decr_friendship_counts, sender=Friendship)
+post_save.connect(push_friendship_to_cache, sender=Friendship)
+post_delete.connect(remove_friendship_from_cache, sender=Friendship)
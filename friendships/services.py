@@ -1,9 +1,150 @@
+import struct
+import uuid
+
 from django.conf import settings
-from django.core.cache import caches
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from friendships.tasks import load_follower_ids_task, load_following_ids_task
+from twitter.cache import (
+    CELEBRITY_USER_IDS_KEY,
+    COUNT_BACKFILL_PATTERN,
+    FOLLOWER_COUNT_PATTERN,
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWING_COUNT_PATTERN,
+    FOLLOWING_IDS_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.cursors import to_upper_keyset
+from utils.redis_client import RedisClient
+from utils.redis_serializers import EPOCH, ONE_MICROSECOND
+from utils.redis_set_helper import RedisSetHelper
+
+# KEYS are pairs of a counter and its back-fill token. Counters missing
+# from cache are back-filled from db on read, not created here from a
+# partial count, and a back-fill which may have counted before this write
+# is not cached
+COUNTS_INCR_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('INCRBY', KEYS[i], ARGV[1])
+    else
+        redis.call('DEL', KEYS[i + 1])
+    end
+end
+return 1
+"""
+
+# cache the count only if no write happened since the back-fill started
+COUNT_BACKFILL_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX')
+return 1
+"""
+
+
+class CachedFriendshipList(object):
+    """
+    Friendships of one user read from the sorted set of friend ids, newest
+    first. Members are the 8-byte big-endian friendship id followed by the
+    8-byte friend id, scored by created_at in microseconds, so friendships
+    sharing a created_at are ordered by id as in db.
+
+    Sliced by rank when paging by number, load_window reads a keyset
+    window when paging by cursor.
+    """
+    MEMBER = struct.Struct('>QQ')
+
+    def __init__(self, key, user_id_field, friend_id_field, user_id):
+        self.key = key
+        self.user_id_field = user_id_field
+        self.friend_id_field = friend_id_field
+        self.user_id = user_id
+
+    @classmethod
+    def get_score(cls, created_at):
+        return (created_at - EPOCH) // ONE_MICROSECOND
+
+    @classmethod
+    def get_member(cls, friendship_id, friend_id):
+        return cls.MEMBER.pack(friendship_id, friend_id)
+
+    def to_friendship(self, member, score):
+        friendship_id, friend_id = self.MEMBER.unpack(member)
+        return Friendship(
+            id=friendship_id,
+            created_at=EPOCH + int(score) * ONE_MICROSECOND,
+            **{self.user_id_field: self.user_id, self.friend_id_field: friend_id},
+        )
+
+    def _to_friendships(self, members_and_scores):
+        return [
+            self.to_friendship(member, score)
+            for member, score in members_and_scores
+            # skip the empty member
+            if member
+        ]
+
+    def count(self):
+        conn = RedisClient.get_connection()
+        return max(conn.zcard(self.key) - 1, 0)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError('Only slices without step are supported')
+        start, stop = index.start or 0, index.stop
+        if stop is not None and stop <= start:
+            return []
+        conn = RedisClient.get_connection()
+        members_and_scores = conn.zrevrange(
+            self.key,
+            start,
+            -1 if stop is None else stop - 1,
+            withscores=True,
+        )
+        return self._to_friendships(members_and_scores)
+
+    def range_after(self, count, score=None, member=None, reverse=True):
+        """
+        (member, score) pairs of count friends after (score, member), which
+        is excluded, newest first if reverse. Members tied on score with
+        the bound are read whole in the same round trip.
+        """
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        if score is None:
+            if reverse:
+                pipe.zrevrangebyscore(self.key, '+inf', '(-inf', 0, count, withscores=True)
+            else:
+                pipe.zrangebyscore(self.key, '(-inf', '+inf', 0, count, withscores=True)
+            return pipe.execute()[0]
 
-cache = caches['testing'] if settings.TESTING else caches['default']
+        pipe.zrangebyscore(self.key, score, score, withscores=True)
+        if reverse:
+            pipe.zrevrangebyscore(self.key, '({}'.format(score), '(-inf', 0, count, withscores=True)
+        else:
+            pipe.zrangebyscore(self.key, '({}'.format(score), '+inf', 0, count, withscores=True)
+        tied, others = pipe.execute()
+        if reverse:
+            tied = [(m, s) for m, s in reversed(tied) if m < member]
+        else:
+            tied = [(m, s) for m, s in tied if m > member]
+        return (tied + others)[:count]
+
+    def load_window(self, count, created_at__lt=None):
+        if created_at__lt is None:
+            return self._to_friendships(self.range_after(count))
+        upper = to_upper_keyset(created_at__lt)
+        members_and_scores = self.range_after(
+            count,
+            score=self.get_score(upper.created_at),
+            member=self.get_member(upper.id, 0),
+        )
+        return self._to_friendships(members_and_scores)
 
 
 class FriendshipService(object):
@@ -22,23 +163,255 @@ class FriendshipService(object):
         return [friendship.from_user for friendship in friendships]
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
+    def get_follower_ids_in_batches(cls, user_id, batch_size):
+        """
+        Yield follower ids in batches, oldest first, paging the cached
+        follower ids by (created_at, id) instead of loading every follower
+        """
+        followers = cls.get_cached_followers(user_id)
+        score, member = None, None
+        while True:
+            members_and_scores = followers.range_after(
+                batch_size,
+                score=score,
+                member=member,
+                reverse=False,
+            )
+            if not members_and_scores:
+                return
+            member, score = members_and_scores[-1]
+            score = int(score)
+            yield [
+                CachedFriendshipList.MEMBER.unpack(member)[1]
+                for member, _ in members_and_scores
+            ]
+
+    @classmethod
+    def _load_friend_ids(cls, key, queryset, friend_id_field):
+        conn = RedisClient.get_connection()
+        if conn.exists(key):
+            return
+
+        rows = queryset.values_list('id', 'created_at', friend_id_field) \
+            .iterator(chunk_size=settings.REDIS_SET_LOAD_BATCH_SIZE)
+        # the empty member at -inf is skipped by readers
+        RedisSetHelper.load(
+            key,
+            'ZADD',
+            (
+                (
+                    CachedFriendshipList.get_score(created_at),
+                    CachedFriendshipList.get_member(friendship_id, friend_id),
+                )
+                for friendship_id, created_at, friend_id in rows
+                if friend_id is not None
+            ),
+            ('-inf', b''),
+            settings.REDIS_SET_LOAD_BATCH_SIZE,
+        )
+
+    @classmethod
+    def get_cached_followers(cls, user_id):
+        key = FOLLOWER_IDS_PATTERN.format(user_id=user_id)
+        cls._load_friend_ids(key, Friendship.objects.filter(to_user_id=user_id), 'from_user_id')
+        return CachedFriendshipList(key, 'to_user_id', 'from_user_id', user_id)
+
+    @classmethod
+    def get_cached_followings(cls, user_id):
+        key = FOLLOWING_IDS_PATTERN.format(user_id=user_id)
+        cls._load_friend_ids(key, Friendship.objects.filter(from_user_id=user_id), 'to_user_id')
+        return CachedFriendshipList(key, 'from_user_id', 'to_user_id', user_id)
+
+    @classmethod
+    def _get_friendships_to_page(cls, key, queryset, load_task, user_id_field, friend_id_field, user_id):
+        """
+        Friendships to page through and their load_window: the cached friend
+        ids, or db while they are not cached. All the friends of a popular
+        user do not fit in a request, they are loaded by load_task.
+        """
+        conn = RedisClient.get_connection()
+        if conn.exists(key):
+            friendships = CachedFriendshipList(key, user_id_field, friend_id_field, user_id)
+            return friendships, friendships.load_window
+        if RedisSetHelper.mark_loading(key):
+            load_task.delay(user_id)
+        return queryset, None
+
+    @classmethod
+    def get_followers_to_page(cls, user_id):
+        return cls._get_friendships_to_page(
+            FOLLOWER_IDS_PATTERN.format(user_id=user_id),
+            Friendship.objects.filter(to_user_id=user_id),
+            load_follower_ids_task,
+            'to_user_id',
+            'from_user_id',
+            user_id,
+        )
+
+    @classmethod
+    def get_followings_to_page(cls, user_id):
+        return cls._get_friendships_to_page(
+            FOLLOWING_IDS_PATTERN.format(user_id=user_id),
+            Friendship.objects.filter(from_user_id=user_id),
+            load_following_ids_task,
+            'from_user_id',
+            'to_user_id',
+            user_id,
+        )
+
+    @classmethod
+    def push_friendship_to_cache(cls, friendship):
+        cls._update_friend_ids(friendship, 'ZADD', 'SADD')
+
+    @classmethod
+    def remove_friendship_from_cache(cls, friendship):
+        cls._update_friend_ids(friendship, 'ZREM', 'SREM')
+
+    @classmethod
+    def _update_friend_ids(cls, friendship, command, followings_command):
+        if friendship.from_user_id is None or friendship.to_user_id is None:
+            return
+        score = CachedFriendshipList.get_score(friendship.created_at)
+        pipe = RedisClient.get_connection().pipeline()
+        for user_id, friend_id, pattern in (
+            (friendship.to_user_id, friendship.from_user_id, FOLLOWER_IDS_PATTERN),
+            (friendship.from_user_id, friendship.to_user_id, FOLLOWING_IDS_PATTERN),
+        ):
+            member = CachedFriendshipList.get_member(friendship.id, friend_id)
+            args = [score, member] if command == 'ZADD' else [member]
+            RedisSetHelper.update(pattern.format(user_id=user_id), command, *args, client=pipe)
+        RedisSetHelper.update(
+            FOLLOWINGS_PATTERN.format(user_id=friendship.from_user_id),
+            followings_command,
+            friendship.to_user_id,
+            client=pipe,
+        )
+        pipe.execute()
+
+    @classmethod
+    def _get_count(cls, key, queryset):
+        conn = RedisClient.get_connection()
+        count = conn.get(key)
+        if count is not None:
+            return int(count)
+        # back-fill cache from db, writes made meanwhile drop the token
+        backfill_key = COUNT_BACKFILL_PATTERN.format(key=key)
+        token = uuid.uuid4().hex
+        conn.set(backfill_key, token, ex=settings.REDIS_SET_LOAD_TIMEOUT)
+        count = queryset.count()
+        script = RedisClient.get_script(COUNT_BACKFILL_SCRIPT)
+        script(keys=[key, backfill_key], args=[token, count, settings.REDIS_KEY_EXPIRE_TIME])
+        return count
+
+    @classmethod
+    def get_follower_count(cls, user_id):
+        key = FOLLOWER_COUNT_PATTERN.format(user_id=user_id)
+        return cls._get_count(key, Friendship.objects.filter(to_user_id=user_id))
+
+    @classmethod
+    def get_following_count(cls, user_id):
+        key = FOLLOWING_COUNT_PATTERN.format(user_id=user_id)
+        return cls._get_count(key, Friendship.objects.filter(from_user_id=user_id))
+
+    @classmethod
+    def update_counts(cls, friendship, delta):
+        keys = []
+        if friendship.to_user_id is not None:
+            keys.append(FOLLOWER_COUNT_PATTERN.format(user_id=friendship.to_user_id))
+        if friendship.from_user_id is not None:
+            keys.append(FOLLOWING_COUNT_PATTERN.format(user_id=friendship.from_user_id))
+        keys = [
+            pair_key
+            for key in keys
+            for pair_key in (key, COUNT_BACKFILL_PATTERN.format(key=key))
+        ]
+        if not keys:
+            return
+        script = RedisClient.get_script(COUNTS_INCR_SCRIPT)
+        script(keys=keys, args=[delta])
+
+    @classmethod
+    def update_celebrity(cls, user_id):
+        """
+        Users with at least CELEBRITY_FOLLOWER_THRESHOLD followers are
+        celebrities, their tweets are not fanned out but pulled by their
+        followers at read time. Returns whether user is a celebrity.
+        """
+        conn = RedisClient.get_connection()
+        if cls.get_follower_count(user_id) >= settings.CELEBRITY_FOLLOWER_THRESHOLD:
+            conn.sadd(CELEBRITY_USER_IDS_KEY, user_id)
+            return True
+        conn.srem(CELEBRITY_USER_IDS_KEY, user_id)
+        return False
+
+    @classmethod
+    def is_celebrity(cls, user_id):
+        conn = RedisClient.get_connection()
+        return bool(conn.sismember(CELEBRITY_USER_IDS_KEY, user_id))
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        # intersected in redis, followings are not read back whole
+        key = cls._get_followings_key(user_id)
+        conn = RedisClient.get_connection()
+        return set(int(user_id) for user_id in conn.sinter(CELEBRITY_USER_IDS_KEY, key))
+
+    @classmethod
+    def _get_followings_key(cls, from_user_id):
+        """
+        Key of the redis set of the ids of the users from_user follows,
+        loaded from db on a miss
+        """
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)
-        # second layer of cache, in memcached
-        # data exist in cache
-        if user_id_set is not None:
-            return user_id_set
-        # data not exist in cache, fetch from database
-        friendships = Friendship.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
-        ])
-        cache.set(key, user_id_set)
-        return user_id_set
-
-    @classmethod
-    def invalidate_following_cache(cls, from_user_id):
+        conn = RedisClient.get_connection()
+        if conn.exists(key):
+            return key
+
+        rows = Friendship.objects.filter(from_user_id=from_user_id) \
+            .values_list('to_user_id', flat=True) \
+            .iterator(chunk_size=settings.REDIS_SET_LOAD_BATCH_SIZE)
+        # 0 keeps users without followings cached
+        RedisSetHelper.load(
+            key,
+            'SADD',
+            ((to_user_id,) for to_user_id in rows if to_user_id is not None),
+            (0,),
+            settings.REDIS_SET_LOAD_BATCH_SIZE,
+        )
+        return key
+
+    @classmethod
+    def get_following_user_id_set(cls, from_user_id):
+        key = cls._get_followings_key(from_user_id)
+        conn = RedisClient.get_connection()
+        return set(int(user_id) for user_id in conn.smembers(key)) - {0}
+
+    @classmethod
+    def get_followed_user_ids(cls, from_user_id, user_ids):
+        """
+        Which of user_ids from_user follows, resolved for a whole page by
+        one round trip to the redis set of the users from_user follows
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        pipe.exists(key)
+        for user_id in user_ids:
+            pipe.sismember(key, user_id)
+        exists, *is_members = pipe.execute()
+        if not exists:
+            # cache miss, load every user from_user follows and ask again
+            key = cls._get_followings_key(from_user_id)
+            pipe = conn.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.sismember(key, user_id)
+            is_members = pipe.execute()
+        return set(
+            user_id
+            for user_id, is_member in zip(user_ids, is_members)
+            if is_member
+        )
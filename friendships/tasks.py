@@ -0,0 +1,14 @@
+from celery import shared_task
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(time_limit=ONE_HOUR)  # avoid indefinite task process
+def load_follower_ids_task(user_id):
+    from friendships.services import FriendshipService
+    return FriendshipService.get_cached_followers(user_id).count()
+
+
+@shared_task(time_limit=ONE_HOUR)
+def load_following_ids_task(user_id):
+    from friendships.services import FriendshipService
+    return FriendshipService.get_cached_followings(user_id).count()
@@ -1,6 +1,14 @@
 from friendships.models import Friendship
 from testing.testcases import TestCase
-from friendships.services import FriendshipService
+from friendships.services import CachedFriendshipList, FriendshipService
+from twitter.cache import (
+    FOLLOWER_COUNT_PATTERN,
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.cursors import get_keyset
+from utils.redis_client import RedisClient
+from utils.redis_set_helper import RedisSetHelper
 
 
 class FriendshipServiceTests(TestCase):
@@ -15,14 +23,194 @@ class FriendshipServiceTests(TestCase):
         user4 = self.create_user('user4')
         for to_user in [self.user2, user3, user4]:
             Friendship.objects.create(from_user=self.user1, to_user=to_user)
-        FriendshipService.invalidate_following_cache(self.user1)
 
         # get following user id set success
         user_id_set = FriendshipService.get_following_user_id_set(self.user1.id)
         self.assertEqual(user_id_set, {self.user2.id, user3.id, user4.id})
 
-        # invalidate following cache success
+        # following cache updated in place
         Friendship.objects.filter(from_user=self.user1, to_user=self.user2).delete()
-        FriendshipService.invalidate_following_cache(self.user1)
         user_id_set = FriendshipService.get_following_user_id_set(self.user1.id)
         self.assertEqual(user_id_set, {user3.id, user4.id})
+
+    def test_follower_and_following_counts(self):
+        user3 = self.create_user('user3')
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        # back-filled from db
+        self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 1)
+
+        # updated by the friendship signals
+        Friendship.objects.create(from_user=user3, to_user=self.user2)
+        Friendship.objects.create(from_user=self.user1, to_user=user3)
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 2)
+            self.assertEqual(FriendshipService.get_following_count(self.user1.id), 2)
+        Friendship.objects.filter(from_user=self.user1).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 1)
+            self.assertEqual(FriendshipService.get_following_count(self.user1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(user3.id), 0)
+
+        # counters missing from cache are not created by the signals
+        self.clear_cache()
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 2)
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 1)
+
+    def test_cached_followers(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(4)]
+        friendships = [
+            Friendship.objects.create(from_user=follower, to_user=self.user1)
+            for follower in followers[:3]
+        ]
+        # friendships sharing a created_at are ordered by id
+        Friendship.objects.filter(id__in=[f.id for f in friendships[1:]]) \
+            .update(created_at=friendships[1].created_at)
+
+        cached_followers = FriendshipService.get_cached_followers(self.user1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_followers.count(), 3)
+            self.assertEqual(
+                [f.from_user_id for f in cached_followers[0:3]],
+                [followers[2].id, followers[1].id, followers[0].id],
+            )
+            window = cached_followers.load_window(2)
+            self.assertEqual([f.id for f in window], [friendships[2].id, friendships[1].id])
+            window = cached_followers.load_window(2, created_at__lt=get_keyset(window[0]))
+            self.assertEqual([f.id for f in window], [friendships[1].id, friendships[0].id])
+            self.assertEqual(
+                list(FriendshipService.get_follower_ids_in_batches(self.user1.id, 2)),
+                [[followers[0].id, followers[1].id], [followers[2].id]],
+            )
+
+        # updated by the friendship signals
+        friendship = Friendship.objects.create(from_user=followers[3], to_user=self.user1)
+        Friendship.objects.filter(id=friendships[0].id).delete()
+        with self.assertNumQueries(0):
+            cached_followers = FriendshipService.get_cached_followers(self.user1.id)
+            self.assertEqual(
+                [f.id for f in cached_followers[0:10]],
+                [friendship.id, friendships[2].id, friendships[1].id],
+            )
+        # users without friends are cached too
+        cached_followings = FriendshipService.get_cached_followings(followers[0].id)
+        with self.assertNumQueries(0):
+            cached_followings = FriendshipService.get_cached_followings(followers[0].id)
+            self.assertEqual(cached_followings.count(), 0)
+            self.assertEqual(cached_followings[0:10], [])
+
+    def test_followers_to_page_from_db_while_loading(self):
+        friendship = Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        key = FOLLOWER_IDS_PATTERN.format(user_id=self.user1.id)
+
+        # a load in progress, no other load is scheduled
+        RedisSetHelper.mark_loading(key)
+        friendships, load_window = FriendshipService.get_followers_to_page(self.user1.id)
+        self.assertEqual(load_window, None)
+        self.assertEqual([f.id for f in friendships], [friendship.id])
+        self.assertEqual(RedisClient.get_connection().exists(key), 0)
+
+        # the set is loaded by a task, pages are read from it then
+        self.clear_cache()
+        friendships, load_window = FriendshipService.get_followers_to_page(self.user1.id)
+        self.assertEqual(load_window, None)
+        self.assertEqual([f.id for f in friendships], [friendship.id])
+        friendships, load_window = FriendshipService.get_followers_to_page(self.user1.id)
+        self.assertIsInstance(friendships, CachedFriendshipList)
+        with self.assertNumQueries(0):
+            self.assertEqual([f.id for f in load_window(10)], [friendship.id])
+
+    def test_get_followed_user_ids(self):
+        user3 = self.create_user('user3')
+        user4 = self.create_user('user4')
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        user_ids = [self.user2.id, user3.id, user4.id]
+        # loaded from db on a miss
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.user1.id, user_ids),
+            {self.user2.id},
+        )
+        # users without followings are cached too
+        self.assertEqual(FriendshipService.get_followed_user_ids(self.user2.id, user_ids), set())
+
+        # updated by the friendship signals, without reloading
+        Friendship.objects.create(from_user=self.user1, to_user=user3)
+        Friendship.objects.create(from_user=self.user2, to_user=user4)
+        Friendship.objects.filter(from_user=self.user1, to_user=self.user2).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.get_followed_user_ids(self.user1.id, user_ids),
+                {user3.id},
+            )
+            self.assertEqual(
+                FriendshipService.get_followed_user_ids(self.user2.id, user_ids),
+                {user4.id},
+            )
+            self.assertEqual(FriendshipService.get_following_user_id_set(self.user1.id), {user3.id})
+
+    def test_writes_during_load_are_replayed(self):
+        user3 = self.create_user('user3')
+        friendship = Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        key = FOLLOWER_IDS_PATTERN.format(user_id=self.user1.id)
+        new_friendships = []
+
+        def load_items():
+            # db snapshot read before the writes below
+            snapshot = [(
+                CachedFriendshipList.get_score(friendship.created_at),
+                CachedFriendshipList.get_member(friendship.id, self.user2.id),
+            )]
+            Friendship.objects.filter(id=friendship.id).delete()
+            new_friendships.append(
+                Friendship.objects.create(from_user=user3, to_user=self.user1),
+            )
+            yield from snapshot
+
+        self.assertEqual(RedisSetHelper.load(key, 'ZADD', load_items(), ('-inf', b''), 10), True)
+        cached_followers = FriendshipService.get_cached_followers(self.user1.id)
+        self.assertEqual([f.id for f in cached_followers[0:10]], [new_friendships[0].id])
+        self.assertEqual(
+            list(FriendshipService.get_follower_ids_in_batches(self.user1.id, 10)),
+            [[user3.id]],
+        )
+
+    def test_followings_writes_during_load_are_replayed(self):
+        user3 = self.create_user('user3')
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        key = FOLLOWINGS_PATTERN.format(user_id=self.user1.id)
+
+        def load_items():
+            # db snapshot read before the writes below
+            snapshot = [(self.user2.id,)]
+            Friendship.objects.filter(from_user=self.user1).delete()
+            Friendship.objects.create(from_user=self.user1, to_user=user3)
+            yield from snapshot
+
+        self.assertEqual(RedisSetHelper.load(key, 'SADD', load_items(), (0,), 10), True)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.get_followed_user_ids(self.user1.id, [self.user2.id, user3.id]),
+                {user3.id},
+            )
+            self.assertEqual(FriendshipService.get_following_user_id_set(self.user1.id), {user3.id})
+
+    def test_write_during_count_backfill(self):
+        user3 = self.create_user('user3')
+        Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        key = FOLLOWER_COUNT_PATTERN.format(user_id=self.user1.id)
+        user1 = self.user1
+        followers = Friendship.objects.filter(to_user=user1)
+
+        class FollowedWhileCounting:
+            # a follow lands between the count and caching it
+            def count(self):
+                count = followers.count()
+                Friendship.objects.create(from_user=user3, to_user=user1)
+                return count
+
+        self.assertEqual(FriendshipService._get_count(key, FollowedWhileCounting()), 1)
+        # the stale count was not cached
+        self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 2)
@@ -1,10 +1,12 @@
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
 from comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.serializers import PrefetchListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -13,6 +15,10 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, likes):
+        UserService.prefetch_users(likes)
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -36,7 +42,11 @@ class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
             raise ValidationError({
                 'content_type': 'Content type dose not exist',
             })
-        liked_object = model_class.objects.filter(id=data['object_id']).first()
+        queryset = model_class.objects.filter(id=data['object_id'])
+        if model_class == Tweet:
+            # counters of deleted tweets are dropped by their cleanup
+            queryset = queryset.filter(has_deleted=False)
+        liked_object = queryset.first()
         if liked_object is None:
             raise ValidationError({
                 'object_id': 'Object does not exist',
@@ -1,5 +1,10 @@
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from likes.services import LikeService
 from rest_framework import status
 from testing.testcases import TestCase
+from tweets.models import Tweet
 
 LIKE_BASE_URL = '/api/likes/'
 LIKE_CANCEL_URL = '/api/likes/cancel/'
@@ -42,6 +47,16 @@ class LikeApiTests(TestCase):
         self.user2_client.post(LIKE_BASE_URL, data)
         self.assertEqual(tweet.like_set.count(), 2)
 
+        # deleted tweets can not be liked
+        deleted_tweet = self.create_tweet(self.user1)
+        Tweet.objects.filter(id=deleted_tweet.id).update(has_deleted=True)
+        response = self.user2_client.post(LIKE_BASE_URL, {
+            'content_type': 'tweet',
+            'object_id': deleted_tweet.id,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(deleted_tweet.like_set.count(), 0)
+
     def test_comment_likes(self):
         tweet = self.create_tweet(self.user1)
         comment = self.create_comment(self.user2, tweet)
@@ -269,3 +284,89 @@ class LikeApiTests(TestCase):
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
         response = self.user2_client.get(NEWSFEED_LIST_API)
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
+
+    def test_has_liked_in_batch(self):
+        tweets = [self.create_tweet(self.user1) for _ in range(3)]
+        for tweet in tweets:
+            self.create_newsfeed(self.user2, tweet)
+        self.create_like(self.user2, tweets[0])
+        comment = self.create_comment(self.user1, tweets[0])
+
+        def like_queries():
+            return [
+                query for query in queries.captured_queries
+                if 'likes_like' in query['sql']
+            ]
+
+        # the liked set is loaded with one query on cache miss
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user2_client.get(NEWSFEED_LIST_API)
+        self.assertEqual(len(like_queries()), 1)
+        has_liked = {r['tweet']['id']: r['tweet']['has_liked'] for r in response.data['results']}
+        self.assertEqual(has_liked, {tweets[0].id: True, tweets[1].id: False, tweets[2].id: False})
+
+        # then kept up to date by like and cancel
+        self.create_like(self.user2, tweets[1])
+        self.user2_client.post(LIKE_CANCEL_URL, {'content_type': 'tweet', 'object_id': tweets[0].id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user2_client.get(NEWSFEED_LIST_API)
+        self.assertEqual(len(like_queries()), 0)
+        has_liked = {r['tweet']['id']: r['tweet']['has_liked'] for r in response.data['results']}
+        self.assertEqual(has_liked, {tweets[0].id: False, tweets[1].id: True, tweets[2].id: False})
+
+        # comments have their own set
+        response = self.user2_client.get(COMMENT_LIST_API, {'tweet_id': tweets[0].id})
+        self.assertEqual(response.data['comments'][0]['has_liked'], False)
+        self.create_like(self.user2, comment)
+        response = self.user2_client.get(COMMENT_LIST_API, {'tweet_id': tweets[0].id})
+        self.assertEqual(response.data['comments'][0]['has_liked'], True)
+
+    def test_has_liked_of_users_with_many_likes(self):
+        tweets = [
+            self.create_tweet(self.user1)
+            for _ in range(settings.LIKED_SET_LOAD_LIMIT + 2)
+        ]
+        for tweet in tweets[1:]:
+            self.create_like(self.user2, tweet)
+        tweet_ids = [tweet.id for tweet in tweets[:2]]
+
+        # too many likes to be cached, the page is looked up in db
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.user2, Tweet, tweet_ids),
+            {tweets[1].id},
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                LikeService.get_liked_object_ids(self.user2, Tweet, tweet_ids),
+                {tweets[1].id},
+            )
+        self.create_like(self.user2, tweets[0])
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.user2, Tweet, tweet_ids),
+            set(tweet_ids),
+        )
+
+    def test_comment_likes_count(self):
+        tweet = self.create_tweet(self.user1)
+        comments = [self.create_comment(self.user1, tweet) for _ in range(3)]
+        data = {'content_type': 'comment', 'object_id': comments[0].id}
+        self.user1_client.post(LIKE_BASE_URL, data)
+        self.user2_client.post(LIKE_BASE_URL, data)
+        comments[0].refresh_from_db()
+        self.assertEqual(comments[0].likes_count, 2)
+
+        # counters of the page are read from redis, no COUNT per comment
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user1_client.get(COMMENT_LIST_API, {'tweet_id': tweet.id})
+        self.assertEqual(
+            [q for q in queries.captured_queries if 'COUNT' in q['sql']],
+            [],
+        )
+        likes_counts = {c['id']: c['likes_count'] for c in response.data['comments']}
+        self.assertEqual(likes_counts, {comments[0].id: 2, comments[1].id: 0, comments[2].id: 0})
+
+        self.user1_client.post(LIKE_CANCEL_URL, data)
+        comments[0].refresh_from_db()
+        self.assertEqual(comments[0].likes_count, 1)
+        response = self.user1_client.get(COMMENT_LIST_API, {'tweet_id': tweet.id})
+        self.assertEqual(response.data['comments'][0]['likes_count'], 1)
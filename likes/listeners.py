@@ -1,16 +1,27 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 
 def incr_likes_count(sender, instance, created, **kwargs):
+    from comments.models import Comment
+    from likes.services import LikeService
     from tweets.models import Tweet
     from django.db.models import F
 
     if not created:
         return
 
+    LikeService.add_liked(instance)
+
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO: get likes count for Comment
+    if model_class not in (Tweet, Comment):
+        return
+
+    if settings.COUNTER_WRITE_BEHIND:
+        # only touch redis, the delta is flushed to db in batch
+        obj = model_class(id=instance.object_id)
+        RedisHelper.add_pending_count(obj, 'likes_count', 1)
+        RedisHelper.incr_count(obj, 'likes_count')
         return
 
     """
@@ -20,21 +31,49 @@ def incr_likes_count(sender, instance, created, **kwargs):
     tweet.save()
     NOT ATOMIC OPERATION
     """
-    Tweet.objects.filter(id=instance.object_id) \
+    model_class.objects.filter(id=instance.object_id) \
         .update(likes_count=F('likes_count') + 1)
     # SQL Query: UPDATE likes_count = likes_count + 1 FROM tweets_table WHERE id=<instance.object_id>
     RedisHelper.incr_count(instance.content_object, 'likes_count')
 
 
 def decr_likes_count(sender, instance, **kwargs):
+    from comments.models import Comment
+    from likes.services import LikeService
     from tweets.models import Tweet
     from django.db.models import F
 
+    LikeService.remove_liked(instance)
+
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO: get likes count for Comment
+    if model_class not in (Tweet, Comment):
+        return
+
+    if settings.COUNTER_WRITE_BEHIND:
+        obj = model_class(id=instance.object_id)
+        RedisHelper.add_pending_count(obj, 'likes_count', -1)
+        RedisHelper.decr_count(obj, 'likes_count')
         return
 
-    Tweet.objects.filter(id=instance.object_id) \
+    model_class.objects.filter(id=instance.object_id) \
         .update(likes_count=F('likes_count') - 1)
     RedisHelper.decr_count(instance.content_object, 'likes_count')
+
+
+def invalidate_tweet_detail(sender, instance, **kwargs):
+    from comments.models import Comment
+    from tweets.models import Tweet
+    from tweets.services import TweetService
+
+    model_class = instance.content_type.model_class()
+    if model_class == Tweet:
+        tweet_id = instance.object_id
+    elif model_class == Comment:
+        # likes_count of the comment is rendered in the detail of its tweet
+        tweet_id = Comment.objects.filter(id=instance.object_id) \
+            .values_list('tweet_id', flat=True) \
+            .first()
+    else:
+        return
+    if tweet_id is not None:
+        TweetService.invalidate_cached_detail(tweet_id)
@@ -2,8 +2,12 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
-from likes.listeners import incr_likes_count, decr_likes_count
+from django.db.models.signals import post_delete, pre_delete, post_save
+from likes.listeners import (
+    decr_likes_count,
+    incr_likes_count,
+    invalidate_tweet_detail,
+)
 from utils.memcached_helper import MemcachedHelper
 
 class Like(models.Model):
@@ -31,7 +35,12 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        # hydrated in bulk by UserService.prefetch_users
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 pre_delete.connect(decr_likes_count, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
+post_save.connect(invalidate_tweet_detail, sender=Like)
+post_delete.connect(invalidate_tweet_detail, sender=Like)
@@ -1,5 +1,9 @@
-from likes.models import Like
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from likes.models import Like
+from twitter.cache import USER_LIKED_OVERFLOW_PATTERN, USER_LIKED_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_set_helper import RedisSetHelper
 
 
 class LikeService(object):
@@ -13,3 +17,85 @@ class LikeService(object):
             object_id=target.id,
             user=user,
         ).exists()
+
+    @classmethod
+    def get_liked_key(cls, user_id, model_class):
+        return USER_LIKED_PATTERN.format(user_id=user_id, model=model_class.__name__)
+
+    @classmethod
+    def get_liked_object_ids(cls, user, model_class, object_ids):
+        """
+        Which of object_ids the user has liked, resolved for a whole page by
+        one round trip to the redis set of objects the user liked. Users
+        with more than LIKED_SET_LOAD_LIMIT likes of the type are not cached,
+        the page is looked up in db instead.
+        """
+        object_ids = list(object_ids)
+        if user.is_anonymous or not object_ids:
+            return set()
+
+        key = cls.get_liked_key(user.id, model_class)
+        overflow_key = USER_LIKED_OVERFLOW_PATTERN.format(key=key)
+        conn = RedisClient.get_connection()
+        for attempt in range(2):
+            pipe = conn.pipeline(transaction=False)
+            pipe.exists(key)
+            pipe.exists(overflow_key)
+            for object_id in object_ids:
+                pipe.sismember(key, object_id)
+            exists, overflows, *is_members = pipe.execute()
+            if exists:
+                return set(
+                    object_id
+                    for object_id, is_member in zip(object_ids, is_members)
+                    if is_member
+                )
+            if overflows or attempt:
+                break
+            # cache miss, load every object of the type the user liked
+            if not cls._load_liked(key, user.id, model_class):
+                conn.set(overflow_key, 1, ex=settings.REDIS_KEY_EXPIRE_TIME)
+                break
+
+        return set(Like.objects.filter(
+            user_id=user.id,
+            content_type=ContentType.objects.get_for_model(model_class),
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+
+    @classmethod
+    def _load_liked(cls, key, user_id, model_class):
+        """
+        Returns False if the user liked too many objects of the type for
+        them to be cached
+        """
+        rows = Like.objects.filter(
+            user_id=user_id,
+            content_type=ContentType.objects.get_for_model(model_class),
+        ).values_list('object_id', flat=True) \
+            .iterator(chunk_size=settings.REDIS_SET_LOAD_BATCH_SIZE)
+        # 0 keeps users without likes cached
+        loaded = RedisSetHelper.load(
+            key,
+            'SADD',
+            ((object_id,) for object_id in rows),
+            (0,),
+            settings.REDIS_SET_LOAD_BATCH_SIZE,
+            max_items=settings.LIKED_SET_LOAD_LIMIT,
+        )
+        return loaded is not None
+
+    @classmethod
+    def add_liked(cls, like):
+        cls._update_liked(like, 'SADD')
+
+    @classmethod
+    def remove_liked(cls, like):
+        cls._update_liked(like, 'SREM')
+
+    @classmethod
+    def _update_liked(cls, like, command):
+        if like.user_id is None:
+            return
+        key = cls.get_liked_key(like.user_id, like.content_type.model_class())
+        RedisSetHelper.update(key, command, like.object_id)
@@ -1,6 +1,9 @@
 from newsfeeds.models import NewsFeed
 from rest_framework import serializers
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
@@ -9,3 +12,13 @@ class NewsFeedSerializer(serializers.ModelSerializer):
     class Meta:
         model = NewsFeed
         fields = ('id', 'created_at', 'tweet')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, newsfeeds):
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        for newsfeed in newsfeeds:
+            newsfeed._cached_tweet = tweets.get(newsfeed.tweet_id)
+        self.fields['tweet'].prefetch(list(tweets.values()))
@@ -1,11 +1,15 @@
 from django.conf import settings
+from django.test import override_settings
 from friendships.models import Friendship
+from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from twitter.cache import ACTIVE_USER_PATTERN, NEWSFEED_MATERIALIZING_PATTERN
 from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEET_URL = '/api/tweets/'
@@ -181,6 +185,40 @@ class NewsFeedApiTests(TestCase):
             results.extend(response.data['results'])
         return results
 
+    def test_pagination_with_same_created_at(self):
+        page_size = EndlessPagination.page_size
+        tweets = [
+            self.create_tweet(self.user2, 'tweet {}'.format(i))
+            for i in range(settings.REDIS_LIST_LENGTH_LIMIT + page_size)
+        ]
+        # newsfeed ids in reverse order of their tweets
+        for tweet in tweets[::-1]:
+            self.create_newsfeed(self.user1, tweet)
+        newsfeeds = NewsFeed.objects.filter(user=self.user1)
+        newsfeeds.update(created_at=newsfeeds.first().created_at)
+        self.clear_cache()
+        NewsFeedService.mark_active_user(self.user1.id)
+        # pages are read from the cache, which holds more than a page
+        NewsFeedService.get_cached_newsfeeds(self.user1.id)
+
+        # newsfeeds sharing a created_at are ordered by their tweets
+        tweet_ids = []
+        params = {}
+        while True:
+            response = self.user1_client.get(NEWSFEEDS_URL, params)
+            tweet_ids.extend(r['tweet']['id'] for r in response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            params = {'cursor': response.data['next_cursor']}
+        self.assertEqual(
+            tweet_ids,
+            sorted(newsfeeds.values_list('tweet_id', flat=True), reverse=True),
+        )
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_pagination_with_same_created_at_in_sorted_set(self):
+        self.test_pagination_with_same_created_at()
+
     def test_redis_list_limit(self):
         list_limit = settings.REDIS_LIST_LENGTH_LIMIT
         page_size = EndlessPagination.page_size
@@ -215,3 +253,82 @@ class NewsFeedApiTests(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    @override_settings(CELEBRITY_FOLLOWER_THRESHOLD=2)
+    def test_celebrity_tweets_are_pulled(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        followed_user = self.create_user('followed')
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.user2, followed_user)
+        self.create_friendship(self.user2, celebrity)
+        NewsFeedService.mark_active_user(self.user2.id)
+
+        # pushed before the author became a celebrity
+        early_tweet = self.create_tweet(celebrity, 'early tweet')
+        NewsFeedService.fanout_to_followers(early_tweet)
+        self.assertEqual(NewsFeed.objects.filter(tweet=early_tweet).count(), 2)
+
+        self.create_friendship(self.user1, celebrity)
+        tweet_ids = [early_tweet.id]
+        for i in range(list_limit + 5):
+            celebrity_tweet = self.create_tweet(celebrity, 'celebrity tweet {}'.format(i))
+            NewsFeedService.fanout_to_followers(celebrity_tweet)
+            tweet_ids.append(celebrity_tweet.id)
+            if i % 2 == 0:
+                tweet = self.create_tweet(followed_user, 'tweet {}'.format(i))
+                NewsFeedService.fanout_to_followers(tweet)
+                tweet_ids.append(tweet.id)
+        tweet_ids = tweet_ids[::-1]
+        # only the author's own newsfeed is created for celebrity tweets
+        self.assertEqual(NewsFeed.objects.filter(tweet=celebrity_tweet).count(), 1)
+
+        results = self._paginate_to_get_newsfeeds(self.user2_client)
+        self.assertEqual([r['tweet']['id'] for r in results], tweet_ids)
+        # celebrities are pulled from cache and db alike
+        self.clear_cache()
+        FriendshipService.update_celebrity(celebrity.id)
+        results = self._paginate_to_get_newsfeeds(self.user2_client)
+        self.assertEqual([r['tweet']['id'] for r in results], tweet_ids)
+
+        # load latest posts
+        new_tweet = self.create_tweet(celebrity, 'new tweet')
+        NewsFeedService.fanout_to_followers(new_tweet)
+        response = self.user2_client.get(NEWSFEEDS_URL, {
+            'created_at__gt': results[0]['created_at'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], [new_tweet.id])
+
+    @override_settings(NEWSFEED_SKIP_INACTIVE_USERS=True)
+    def test_inactive_users_pull_newsfeeds(self):
+        # user2 never read the newsfeeds, fanout skips them
+        self.create_friendship(self.user2, self.user1)
+        tweet = self.create_tweet(self.user1, 'skipped')
+        NewsFeedService.fanout_to_followers(tweet)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).exists(), False)
+
+        # pull mode while the newsfeeds are materialized
+        conn = RedisClient.get_connection()
+        NewsFeedService.mark_active_user(self.user2.id)
+        conn.set(NEWSFEED_MATERIALIZING_PATTERN.format(user_id=self.user2.id), 1)
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], [tweet.id])
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).exists(), False)
+        conn.delete(NEWSFEED_MATERIALIZING_PATTERN.format(user_id=self.user2.id))
+        conn.delete(ACTIVE_USER_PATTERN.format(user_id=self.user2.id))
+
+        # materialized by a task on first read
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual([r['tweet']['id'] for r in response.data['results']], [tweet.id])
+        newsfeed = NewsFeed.objects.get(user=self.user2)
+        self.assertEqual(newsfeed.created_at, tweet.created_at)
+
+        # active users are fanned out to
+        new_tweet = self.create_tweet(self.user1, 'pushed')
+        NewsFeedService.fanout_to_followers(new_tweet)
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2).count(), 2)
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(
+            [r['tweet']['id'] for r in response.data['results']],
+            [new_tweet.id, tweet.id],
+        )
@@ -1,8 +1,11 @@
+from django.conf import settings
+from functools import partial
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
+from tweets.services import TweetService
 from utils.paginations import EndlessPagination
 
 
@@ -11,11 +14,42 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
     pagination_class = EndlessPagination
 
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
-        if page is None:  # retrieve data from db
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+        was_active = NewsFeedService.mark_active_user(request.user.id)
+        if not was_active and settings.NEWSFEED_SKIP_INACTIVE_USERS:
+            # first read after being skipped by fanouts
+            NewsFeedService.schedule_materialize_newsfeeds(request.user.id)
+
+        materializing = NewsFeedService.is_materializing(request.user.id)
+        if materializing:
+            # pull mode until the newsfeeds are materialized
+            load_windows = [partial(NewsFeedService.get_pulled_newsfeeds, request.user.id)]
+        else:
+            load_windows = NewsFeedService.get_newsfeed_windows(request.user.id)
+        if materializing or len(load_windows) > 1:
+            # merge the tweets of followed celebrities, a tweet pushed
+            # before its author became a celebrity is returned once
+            page = self.paginator.paginate_merged_windows(
+                load_windows,
+                request,
+                key=lambda newsfeed: newsfeed.tweet_id,
+            )
+            page = TweetService.exclude_deleted_tweets(page, 'tweet_id')
+            serializer = NewsFeedSerializer(
+                page,
+                context={'request': request},
+                many=True,
+            )
+            return self.get_paginated_response(serializer.data)
+
+        # pages past the cached newsfeeds are completed from db
+        page = self.paginator.paginate_stitched_window(
+            partial(NewsFeedService.get_cached_newsfeeds_window, request.user.id),
+            NewsFeed.objects.filter(user=request.user),
+            request,
+            extend_cache=partial(NewsFeedService.extend_cached_newsfeeds, request.user.id),
+        )
+        # deleted tweets may still be in newsfeeds until cleaned up
+        page = TweetService.exclude_deleted_tweets(page, 'tweet_id')
         serializer = NewsFeedSerializer(
             page,
             context={'request': request},
@@ -0,0 +1,98 @@
+"""
+Push vs hybrid push/pull newsfeeds, not collected by the test suite:
+
+    python manage.py test newsfeeds.benchmarks
+
+For each follower count an author posts TWEETS tweets, fanned out either to
+every follower (push) or to nobody since the author is a celebrity (hybrid).
+Reports the newsfeed rows written per tweet, the fanout time per tweet, and
+the latency of the first newsfeed page of READERS followers.
+"""
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.test import override_settings
+from friendships.models import Friendship
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import fanout_newsfeeds_task
+from rest_framework.test import APIClient
+from testing.testcases import TestCase
+
+NEWSFEEDS_URL = '/api/newsfeeds/'
+FOLLOWER_COUNTS = (10, 100, 1000)
+TWEETS = 10
+READERS = 20
+
+
+class HybridTimelineBenchmark(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def _create_followed_user(self, username, followers):
+        user = self.create_user(username)
+        Friendship.objects.bulk_create([
+            Friendship(from_user=follower, to_user=user)
+            for follower in followers
+        ])
+        return user
+
+    def _run(self, follower_count, mode):
+        prefix = '{}_{}_'.format(mode, follower_count)
+        User.objects.bulk_create([
+            User(username='{}{}'.format(prefix, i))
+            for i in range(follower_count)
+        ])
+        # bulk_create does not set ids on mysql and sqlite
+        followers = list(User.objects.filter(username__startswith=prefix))
+        # inactive followers would be skipped by the fanout
+        for follower in followers:
+            NewsFeedService.mark_active_user(follower.id)
+        readers = followers[:READERS]
+        author = self._create_followed_user(prefix + 'author', followers)
+        # readers also follow a regular author, so reads merge both
+        regular_author = self._create_followed_user(prefix + 'regular', readers)
+
+        threshold = follower_count if mode == 'hybrid' else follower_count + 1
+        with override_settings(CELEBRITY_FOLLOWER_THRESHOLD=threshold):
+            fanout_seconds = 0
+            for i in range(TWEETS):
+                tweet = self.create_tweet(author, 'tweet {}'.format(i))
+                start = time.perf_counter()
+                fanout_newsfeeds_task(tweet.id)
+                fanout_seconds += time.perf_counter() - start
+                tweet = self.create_tweet(regular_author, 'regular tweet {}'.format(i))
+                fanout_newsfeeds_task(tweet.id)
+
+            latencies = []
+            for reader in readers:
+                client = APIClient()
+                client.force_authenticate(reader)
+                start = time.perf_counter()
+                response = client.get(NEWSFEEDS_URL)
+                latencies.append(time.perf_counter() - start)
+                self.assertEqual(len(response.data['results']), 10)
+
+        rows = NewsFeed.objects.filter(tweet__user=author).count()
+        latencies.sort()
+        return (
+            rows / TWEETS,
+            fanout_seconds / TWEETS * 1000,
+            statistics.mean(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        )
+
+    def test_write_amplification_and_read_latency(self):
+        lines = ['{:>9} {:>7} {:>12} {:>14} {:>13} {:>12}'.format(
+            'followers', 'mode', 'rows/tweet', 'fanout ms/tw', 'read ms mean', 'read ms p95',
+        )]
+        for follower_count in FOLLOWER_COUNTS:
+            for mode in ('push', 'hybrid'):
+                lines.append('{:>9} {:>7} {:>12.1f} {:>14.2f} {:>13.2f} {:>12.2f}'.format(
+                    follower_count,
+                    mode,
+                    *self._run(follower_count, mode),
+                ))
+        print('\n' + '\n'.join(lines))
@@ -4,6 +4,7 @@ from django.db.models.signals import post_save
 from newsfeeds.listeners import push_newsfeed_to_cache
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_serializers import CompactModelSerializer
 
 
 class NewsFeed(models.Model):
@@ -11,6 +12,10 @@ class NewsFeed(models.Model):
     tweet = models.ForeignKey(Tweet, on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # newsfeeds sharing a created_at are ordered by their tweets, so that
+    # newsfeeds pulled from tweets, which have no id, are ordered the same
+    keyset_id_field = 'tweet_id'
+
     class Meta:
         index_together = (('user', 'created_at'),)
         unique_together = (('user', 'tweet'),)
@@ -21,7 +26,25 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # hydrated in bulk by NewsFeedSerializer.prefetch
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
+
+# field layout of newsfeeds cached in redis lists
+CompactModelSerializer.register(NewsFeed, code=2, version=1, fields=(
+    'id',
+    'user_id',
+    'tweet_id',
+    'created_at',
+))
+# user_id is implied by the key of the cached newsfeeds, only the tweet
+# reference is cached, tweets and users are hydrated per page in bulk
+CompactModelSerializer.register(NewsFeed, code=2, version=2, fields=(
+    'id',
+    'tweet_id',
+    'created_at',
+))
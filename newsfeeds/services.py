@@ -1,7 +1,33 @@
+import heapq
+from functools import partial
+from itertools import islice
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
-from newsfeeds.tasks import fanout_newsfeeds_task
-from twitter.cache import USER_NEWSFEEDS_PATTERN
-from utils.redis_helper import RedisHelper
+from newsfeeds.tasks import (
+    backfill_newsfeeds_task,
+    extend_cached_newsfeeds_task,
+    fanout_newsfeeds_task,
+    materialize_newsfeeds_task,
+    purge_newsfeeds_task,
+)
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    ACTIVE_USER_PATTERN,
+    FANOUT_PROGRESS_PATTERN,
+    NEWSFEED_MATERIALIZING_PATTERN,
+    USER_NEWSFEEDS_PATTERN,
+)
+from utils.cursors import get_keyset
+from utils.redis_client import RedisClient
+from utils.redis_helper import get_timeline_helper
+from utils.time_helpers import utc_now
+
+logger = get_task_logger(__name__)
 
 
 class NewsFeedService(object):
@@ -15,12 +41,381 @@ class NewsFeedService(object):
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
         # queryset is lazy loading
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-tweet_id')
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        newsfeeds = get_timeline_helper().load_objects(key, queryset)
+        return cls._fill_user_id(user_id, newsfeeds)
+
+    @classmethod
+    def get_cached_newsfeeds_window(cls, user_id, count, created_at__lt=None, created_at__gt=None):
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-tweet_id')
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        newsfeeds, cached_length = get_timeline_helper().load_objects_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        return cls._fill_user_id(user_id, newsfeeds), cached_length
+
+    @classmethod
+    def extend_cached_newsfeeds(cls, user_id):
+        # a reader scrolled past the cached newsfeeds
+        if settings.REDIS_LIST_EXTEND_ON_DEEP_SCROLL:
+            extend_cached_newsfeeds_task.delay(user_id)
+
+    @classmethod
+    def load_older_newsfeeds_to_cache(cls, user_id):
+        queryset = NewsFeed.objects.filter(user_id=user_id)
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        return get_timeline_helper().extend_cache(
+            key,
+            queryset,
+            settings.REDIS_LIST_EXTENDED_LENGTH_LIMIT,
+        )
+
+    @classmethod
+    def get_newsfeeds_window(cls, user_id, count, created_at__lt=None, created_at__gt=None):
+        # complete window, newsfeeds beyond the cached list are read from db
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-tweet_id')
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        newsfeeds = get_timeline_helper().load_complete_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        return cls._fill_user_id(user_id, newsfeeds)
+
+    @classmethod
+    def _fill_user_id(cls, user_id, newsfeeds):
+        # user_id is not cached, it is implied by the key
+        for newsfeed in newsfeeds:
+            if newsfeed.user_id is None:
+                newsfeed.user_id = user_id
+        return newsfeeds
+
+    @classmethod
+    def get_pulled_newsfeeds_window(
+        cls,
+        user_id,
+        author_id,
+        count,
+        created_at__lt=None,
+        created_at__gt=None,
+    ):
+        """
+        Tweets of an author which are not fanned out (see
+        FriendshipService.update_celebrity), as unsaved newsfeeds of user
+        """
+        tweets = TweetService.get_tweets_window(
+            author_id,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        return [cls._to_newsfeed(user_id, tweet) for tweet in tweets]
+
+    @classmethod
+    def _to_newsfeed(cls, user_id, tweet):
+        newsfeed = NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+        newsfeed._cached_tweet = tweet
+        return newsfeed
+
+    @classmethod
+    def get_pulled_newsfeeds(
+        cls,
+        user_id,
+        count,
+        created_at__lt=None,
+        created_at__gt=None,
+        exclude_user_ids=(),
+    ):
+        """
+        Pull mode: newsfeeds of user built by a k-way merge of the cached
+        tweets of the users they follow, which stops once count newsfeeds
+        are merged. Returned newsfeeds are not saved.
+        """
+        author_ids = FriendshipService.get_following_user_id_set(user_id) | {user_id}
+        author_ids = [
+            author_id
+            for author_id in author_ids
+            if author_id not in exclude_user_ids
+        ]
+        tweet_windows = TweetService.get_tweets_windows(
+            author_ids,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        tweets = heapq.merge(*tweet_windows, key=get_keyset, reverse=True)
+        return [cls._to_newsfeed(user_id, tweet) for tweet in islice(tweets, count)]
+
+    @classmethod
+    def mark_active_user(cls, user_id):
+        """
+        Fanouts only write to users who read their newsfeeds within
+        NEWSFEED_ACTIVE_USER_TTL. Returns whether user was active already.
+        """
+        conn = RedisClient.get_connection()
+        key = ACTIVE_USER_PATTERN.format(user_id=user_id)
+        pipe = conn.pipeline()
+        pipe.exists(key)
+        pipe.set(key, 1, ex=settings.NEWSFEED_ACTIVE_USER_TTL)
+        was_active, _ = pipe.execute()
+        return bool(was_active)
+
+    @classmethod
+    def get_active_user_ids(cls, user_ids):
+        if not user_ids:
+            return []
+        conn = RedisClient.get_connection()
+        keys = [ACTIVE_USER_PATTERN.format(user_id=user_id) for user_id in user_ids]
+        return [
+            user_id
+            for user_id, active in zip(user_ids, conn.mget(keys))
+            if active is not None
+        ]
+
+    @classmethod
+    def schedule_materialize_newsfeeds(cls, user_id):
+        """
+        Materialize the newsfeeds of user in the background, their reads
+        are served in pull mode until it is done
+        """
+        conn = RedisClient.get_connection()
+        key = NEWSFEED_MATERIALIZING_PATTERN.format(user_id=user_id)
+        conn.set(key, 1, ex=settings.NEWSFEED_MATERIALIZE_TIMEOUT)
+        materialize_newsfeeds_task.delay(user_id)
+
+    @classmethod
+    def is_materializing(cls, user_id):
+        conn = RedisClient.get_connection()
+        return bool(conn.exists(NEWSFEED_MATERIALIZING_PATTERN.format(user_id=user_id)))
+
+    @classmethod
+    def materialize_newsfeeds(cls, user_id):
+        """
+        Fanouts skipped user while inactive, save the newsfeeds pulled from
+        the tweets they follow so their reads go on in push mode. Tweets of
+        celebrities are left out, they are merged at read time anyway.
+        """
+        newsfeeds = cls.get_pulled_newsfeeds(
+            user_id,
+            settings.REDIS_LIST_LENGTH_LIMIT,
+            exclude_user_ids=FriendshipService.get_followed_celebrity_ids(user_id),
+        )
+        newsfeeds = cls._save_newsfeeds(user_id, newsfeeds)
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        get_timeline_helper().merge_objects(key, newsfeeds)
+        RedisClient.get_connection().delete(
+            NEWSFEED_MATERIALIZING_PATTERN.format(user_id=user_id),
+        )
+        return len(newsfeeds)
+
+    @classmethod
+    def _save_newsfeeds(cls, user_id, newsfeeds):
+        """
+        Save unsaved newsfeeds of user in bulk with the created_at of their
+        tweets, newsfeeds which exist already are skipped. Returns the
+        saved newsfeeds as read back from db.
+        """
+        tweet_ids = [newsfeed.tweet_id for newsfeed in newsfeeds]
+        existing_tweet_ids = set(
+            NewsFeed.objects.filter(user_id=user_id, tweet_id__in=tweet_ids)
+            .values_list('tweet_id', flat=True)
+        )
+        new_tweet_ids = [
+            tweet_id
+            for tweet_id in tweet_ids
+            if tweet_id not in existing_tweet_ids
+        ]
+        if not new_tweet_ids:
+            return []
+
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet_id=tweet_id) for tweet_id in new_tweet_ids],
+            batch_size=settings.FANOUT_BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        queryset = NewsFeed.objects.filter(user_id=user_id, tweet_id__in=new_tweet_ids)
+        cls._set_tweet_created_at(queryset)
+        return list(queryset)
+
+    @classmethod
+    def _set_tweet_created_at(cls, queryset):
+        # created_at is auto_now_add, newsfeeds are ordered by their tweets
+        # instead, as pulled ones are, so that both copies of a tweet of a
+        # celebrity meet on the same page and are merged into one
+        queryset.update(created_at=Subquery(
+            Tweet.objects.filter(id=OuterRef('tweet_id')).values('created_at')[:1]
+        ))
+
+    @classmethod
+    def backfill_followed_tweets(cls, from_user_id, to_user_id):
+        backfill_newsfeeds_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def purge_unfollowed_tweets(cls, from_user_id, to_user_id):
+        purge_newsfeeds_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, author_id):
+        """
+        Merge the recent tweets of a newly followed author into the
+        newsfeeds of user, in db and in cache
+        """
+        tweets = TweetService.get_tweets_window(author_id, settings.REDIS_LIST_LENGTH_LIMIT)
+        newsfeeds = cls._save_newsfeeds(
+            user_id,
+            [cls._to_newsfeed(user_id, tweet) for tweet in tweets],
+        )
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        get_timeline_helper().merge_objects(key, newsfeeds)
+        return len(newsfeeds)
+
+    @classmethod
+    def purge_newsfeeds(cls, user_id, author_id):
+        """
+        Remove the tweets of an unfollowed author from the newsfeeds of
+        user, in db and in cache, batch by batch
+        """
+        queryset = NewsFeed.objects.filter(user_id=user_id, tweet__user_id=author_id)
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        purged = 0
+        while True:
+            ids = list(queryset.values_list('id', flat=True)[:settings.NEWSFEED_PURGE_BATCH_SIZE])
+            if not ids:
+                return purged
+            NewsFeed.objects.filter(id__in=ids).delete()
+            get_timeline_helper().remove_objects(key, ids)
+            purged += len(ids)
+
+    @classmethod
+    def get_newsfeed_windows(cls, user_id):
+        """
+        Window loaders to merge into the newsfeeds of user: the pushed
+        newsfeeds and the tweets of each followed celebrity
+        """
+        load_windows = [partial(cls.get_newsfeeds_window, user_id)]
+        for celebrity_id in FriendshipService.get_followed_celebrity_ids(user_id):
+            load_windows.append(partial(cls.get_pulled_newsfeeds_window, user_id, celebrity_id))
+        return load_windows
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
+        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id) \
+            .order_by('-created_at', '-tweet_id')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        return RedisHelper.push_object(key, newsfeed, queryset)
+        return get_timeline_helper().push_object(key, newsfeed, queryset)
+
+    @classmethod
+    def create_newsfeeds(cls, tweet_id, user_ids):
+        """
+        Create the newsfeeds of a tweet for a batch of users and push them
+        to the cached newsfeeds in one pipeline. Safe to retry, newsfeeds
+        which already exist are neither created nor pushed again.
+        """
+        existing_user_ids = set(
+            NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=user_ids)
+            .values_list('user_id', flat=True)
+        )
+        new_user_ids = [
+            user_id
+            for user_id in user_ids
+            if user_id not in existing_user_ids
+        ]
+        if not new_user_ids:
+            return 0
+
+        NewsFeed.objects.bulk_create(
+            [NewsFeed(user_id=user_id, tweet_id=tweet_id) for user_id in new_user_ids],
+            batch_size=settings.FANOUT_BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        newsfeeds = NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=new_user_ids)
+        cls._set_tweet_created_at(newsfeeds)
+        # bulk_create does not set ids on mysql, read the rows back, with
+        # their created_at
+        get_timeline_helper().push_objects([
+            (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+            for newsfeed in newsfeeds
+        ])
+        return len(newsfeeds)
+
+    @classmethod
+    def get_fanout_progress(cls, tweet_id):
+        """
+        batches is only set once all batches are dispatched,
+        completed_at once all of them finished
+        """
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        progress = {
+            field.decode(): value.decode()
+            for field, value in conn.hgetall(key).items()
+        }
+        for field in ('batches', 'finished_batches', 'followers', 'newsfeeds'):
+            if field in progress:
+                progress[field] = int(progress[field])
+        return progress
+
+    @classmethod
+    def reset_fanout_progress(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        conn.delete(FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def finish_fanout_dispatch(cls, tweet_id, batches):
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        pipe = conn.pipeline()
+        pipe.hset(key, 'batches', batches)
+        pipe.hincrby(key, 'finished_batches', 0)
+        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        _, finished_batches, _ = pipe.execute()
+        cls._check_fanout_completed(conn, key, tweet_id, batches, finished_batches)
+
+    @classmethod
+    def finish_fanout_batch(cls, tweet_id, followers, newsfeeds):
+        conn = RedisClient.get_connection()
+        key = FANOUT_PROGRESS_PATTERN.format(tweet_id=tweet_id)
+        pipe = conn.pipeline()
+        pipe.hincrby(key, 'followers', followers)
+        pipe.hincrby(key, 'newsfeeds', newsfeeds)
+        pipe.hincrby(key, 'finished_batches', 1)
+        pipe.hget(key, 'batches')
+        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        _, _, finished_batches, batches, _ = pipe.execute()
+        cls._check_fanout_completed(conn, key, tweet_id, batches, finished_batches)
+
+    @classmethod
+    def _check_fanout_completed(cls, conn, key, tweet_id, batches, finished_batches):
+        # batches is unknown until the coordinator dispatched all of them
+        if batches is None or finished_batches < int(batches):
+            return
+        # the coordinator and the last batch may both get here
+        if conn.hsetnx(key, 'completed_at', utc_now().isoformat()):
+            logger.info('fanout of tweet %s completed', tweet_id)
+
+    @classmethod
+    def remove_deleted_tweet(cls, tweet_id):
+        """
+        Delete the newsfeeds of a deleted tweet batch by batch, removing
+        them from the cached newsfeeds of their users in one pipeline once
+        the rows are gone, a rebuild in between would cache them again
+        """
+        queryset = NewsFeed.objects.filter(tweet_id=tweet_id).order_by('id')
+        removed = 0
+        while True:
+            newsfeeds = list(queryset[:settings.NEWSFEED_PURGE_BATCH_SIZE])
+            if not newsfeeds:
+                return removed
+            NewsFeed.objects.filter(id__in=[newsfeed.id for newsfeed in newsfeeds]).delete()
+            get_timeline_helper().remove_objects_by_value([
+                (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ])
+            removed += len(newsfeeds)
@@ -1,23 +1,103 @@
 from celery import shared_task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from friendships.models import Friendship
 from friendships.services import FriendshipService
-from newsfeeds.models import NewsFeed
 from tweets.models import Tweet
 from utils.time_constants import ONE_HOUR
 
+logger = get_task_logger(__name__)
+
 
 @shared_task(time_limit=ONE_HOUR)  # avoid indefinite task process
 def fanout_newsfeeds_task(tweet_id):
+    """
+    Coordinator of a fanout: the author's newsfeed is created at once,
+    followers are paged by id and fanned out by parallel batch tasks
+    """
     from newsfeeds.services import NewsFeedService
 
     tweet = Tweet.objects.get(id=tweet_id)
-    newsfeeds = [
-        NewsFeed(user=follower, tweet=tweet)
-        for follower in FriendshipService.get_followers(tweet.user)
-    ]
-    newsfeeds.append(NewsFeed(user=tweet.user, tweet=tweet))
-    # use bulk create instead of put db query inside for loop
-    NewsFeed.objects.bulk_create(newsfeeds)
-
-    # manually push to cache
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    NewsFeedService.reset_fanout_progress(tweet_id)
+    NewsFeedService.create_newsfeeds(tweet_id, [tweet.user_id])
+    if FriendshipService.update_celebrity(tweet.user_id):
+        # followers pull the tweets of celebrities at read time
+        NewsFeedService.finish_fanout_dispatch(tweet_id, 0)
+        return 0
+
+    batches = 0
+    for follower_ids in FriendshipService.get_follower_ids_in_batches(
+        tweet.user_id,
+        settings.FANOUT_BATCH_SIZE,
+    ):
+        fanout_newsfeeds_batch_task.delay(tweet_id, follower_ids)
+        batches += 1
+    logger.info('fanout of tweet %s dispatched in %s batches', tweet_id, batches)
+    NewsFeedService.finish_fanout_dispatch(tweet_id, batches)
+    return batches
+
+
+@shared_task(time_limit=ONE_HOUR)
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
+    from newsfeeds.services import NewsFeedService
+
+    user_ids = follower_ids
+    if settings.NEWSFEED_SKIP_INACTIVE_USERS:
+        # inactive followers pull their newsfeeds on their next read
+        user_ids = NewsFeedService.get_active_user_ids(follower_ids)
+    created = NewsFeedService.create_newsfeeds(tweet_id, user_ids)
+    NewsFeedService.finish_fanout_batch(tweet_id, len(follower_ids), created)
+    return created
+
+
+def _is_following(from_user_id, to_user_id):
+    return Friendship.objects.filter(
+        from_user_id=from_user_id,
+        to_user_id=to_user_id,
+    ).exists()
+
+
+@shared_task(time_limit=ONE_HOUR)
+def backfill_newsfeeds_task(from_user_id, to_user_id):
+    from newsfeeds.services import NewsFeedService
+
+    # follow and unfollow tasks may run duplicated or out of order,
+    # they act on the current friendship instead of the event
+    if not _is_following(from_user_id, to_user_id):
+        return 0
+    # tweets of celebrities are pulled at read time
+    if FriendshipService.is_celebrity(to_user_id):
+        return 0
+    # inactive users pull their newsfeeds on their next read
+    if settings.NEWSFEED_SKIP_INACTIVE_USERS and \
+            not NewsFeedService.get_active_user_ids([from_user_id]):
+        return 0
+
+    backfilled = NewsFeedService.backfill_newsfeeds(from_user_id, to_user_id)
+    # unfollowed while backfilling, its purge may have run already
+    if not _is_following(from_user_id, to_user_id):
+        NewsFeedService.purge_newsfeeds(from_user_id, to_user_id)
+        return 0
+    return backfilled
+
+
+@shared_task(time_limit=ONE_HOUR)
+def purge_newsfeeds_task(from_user_id, to_user_id):
+    from newsfeeds.services import NewsFeedService
+
+    # followed again meanwhile
+    if _is_following(from_user_id, to_user_id):
+        return 0
+    return NewsFeedService.purge_newsfeeds(from_user_id, to_user_id)
+
+
+@shared_task(time_limit=ONE_HOUR)
+def extend_cached_newsfeeds_task(user_id):
+    from newsfeeds.services import NewsFeedService
+    return NewsFeedService.load_older_newsfeeds_to_cache(user_id)
+
+
+@shared_task(time_limit=ONE_HOUR)
+def materialize_newsfeeds_task(user_id):
+    from newsfeeds.services import NewsFeedService
+    return NewsFeedService.materialize_newsfeeds(user_id)
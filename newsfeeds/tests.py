@@ -1,7 +1,11 @@
+from django.test import override_settings
+from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import fanout_newsfeeds_task
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_serializers import CompactModelSerializer
 
 
 class NewsFeedServiceTests(TestCase):
@@ -48,3 +52,102 @@ class NewsFeedServiceTests(TestCase):
 
         feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
+
+    @override_settings(FANOUT_BATCH_SIZE=2)
+    def test_fanout_in_batches(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            self.create_friendship(follower, self.user1)
+            NewsFeedService.mark_active_user(follower.id)
+        # warm the cache of one follower
+        NewsFeedService.get_cached_newsfeeds(followers[0].id)
+
+        tweet = self.create_tweet(self.user1)
+        self.assertEqual(fanout_newsfeeds_task(tweet.id), 3)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 6)
+        progress = NewsFeedService.get_fanout_progress(tweet.id)
+        self.assertEqual(progress['batches'], 3)
+        self.assertEqual(progress['finished_batches'], 3)
+        self.assertEqual(progress['followers'], 5)
+        self.assertEqual(progress['newsfeeds'], 5)
+        self.assertEqual('completed_at' in progress, True)
+
+        feeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+        self.assertEqual(feeds[0].id is not None, True)
+        feeds = NewsFeedService.get_cached_newsfeeds(followers[4].id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+
+        # retrying a fanout creates and pushes nothing twice
+        fanout_newsfeeds_task(tweet.id)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 6)
+        progress = NewsFeedService.get_fanout_progress(tweet.id)
+        self.assertEqual(progress['finished_batches'], 3)
+        self.assertEqual(progress['newsfeeds'], 0)
+        feeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+
+    @override_settings(FANOUT_BATCH_SIZE=2, REDIS_TIMELINE_STORE='sorted_set')
+    def test_fanout_in_batches_to_sorted_set(self):
+        self.test_fanout_in_batches()
+
+    def test_late_fanout_keeps_newsfeeds_ordered(self):
+        tweets = [self.create_tweet(self.user2, 'tweet {}'.format(i)) for i in range(3)]
+        NewsFeedService.create_newsfeeds(tweets[0].id, [self.user1.id])
+        NewsFeedService.get_cached_newsfeeds(self.user1.id)
+        NewsFeedService.create_newsfeeds(tweets[2].id, [self.user1.id])
+        # the fanout of tweets[1] ran late
+        NewsFeedService.create_newsfeeds(tweets[1].id, [self.user1.id])
+
+        feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+        self.assertEqual([f.tweet_id for f in feeds], [t.id for t in tweets[::-1]])
+        # stamped as their tweets, like newsfeeds pulled from them
+        self.assertEqual([f.created_at for f in feeds], [t.created_at for t in tweets[::-1]])
+        newsfeed = NewsFeed.objects.get(user=self.user1, tweet=tweets[1])
+        self.assertEqual(newsfeed.created_at, tweets[1].created_at)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_late_fanout_keeps_newsfeeds_ordered_in_sorted_set(self):
+        self.test_late_fanout_keeps_newsfeeds_ordered()
+
+    def test_get_pulled_newsfeeds(self):
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user1, self.user2)
+        self.create_friendship(self.user1, user3)
+        tweets = []
+        for i in range(3):
+            for user in [self.user1, self.user2, user3]:
+                tweets.append(self.create_tweet(user, 'tweet {}'.format(i)))
+        tweets = tweets[::-1]
+
+        newsfeeds = NewsFeedService.get_pulled_newsfeeds(self.user1.id, 4)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [t.id for t in tweets[:4]])
+        self.assertEqual(newsfeeds[0].user_id, self.user1.id)
+        self.assertEqual(newsfeeds[0].created_at, tweets[0].created_at)
+
+        newsfeeds = NewsFeedService.get_pulled_newsfeeds(
+            self.user1.id,
+            4,
+            created_at__lt=tweets[3].created_at,
+            exclude_user_ids={user3.id},
+        )
+        expected = [t.id for t in tweets[4:] if t.user_id != user3.id][:4]
+        self.assertEqual([f.tweet_id for f in newsfeeds], expected)
+
+    def test_cache_only_tweet_reference(self):
+        tweet = self.create_tweet(self.user2)
+        newsfeed = self.create_newsfeed(self.user1, tweet)
+        NewsFeedService.get_cached_newsfeeds(self.user1.id)
+
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.user1.id)
+        cached_newsfeed = CompactModelSerializer.deserialize(conn.lindex(key, 0))
+        self.assertEqual(cached_newsfeed.id, newsfeed.id)
+        self.assertEqual(cached_newsfeed.tweet_id, tweet.id)
+        self.assertEqual(cached_newsfeed.created_at, newsfeed.created_at)
+        self.assertEqual(cached_newsfeed.user_id, None)
+
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+        self.assertEqual(newsfeeds[0].user_id, self.user1.id)
+        newsfeeds, _ = NewsFeedService.get_cached_newsfeeds_window(self.user1.id, 1)
+        self.assertEqual(newsfeeds[0].user_id, self.user1.id)
@@ -8,6 +8,7 @@ from likes.models import Like
 from newsfeeds.models import NewsFeed
 from rest_framework.test import APIClient
 from tweets.models import Tweet
+from utils.local_cache import local_cache
 from utils.redis_client import RedisClient
 
 
@@ -15,6 +16,7 @@ class TestCase(DjangoTestCase):
 
     def clear_cache(self):
         caches['testing'].clear()
+        local_cache.clear()
         RedisClient.clear()
 
     @property
@@ -1,5 +1,8 @@
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
+from comments.models import Comment
+from comments.services import CommentService
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
 from rest_framework import serializers
@@ -7,7 +10,9 @@ from rest_framework.exceptions import ValidationError
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
+from utils.paginations import EndlessPagination
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -29,21 +34,47 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, tweets):
+        UserService.prefetch_users(tweets)
+        # load counters of the whole page in one round trip
+        self._prefetched_counts = RedisHelper.get_counts(
+            tweets,
+            ['likes_count', 'comments_count'],
+        )
+        self._prefetched_photo_urls = TweetService.get_photo_urls_through_cache(
+            [tweet.id for tweet in tweets],
+        )
+        self._prefetched_liked_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Tweet,
+            [tweet.id for tweet in tweets],
+        )
+
+    def _get_count(self, obj, attr):
+        counts = getattr(self, '_prefetched_counts', {}).get(obj.id, {})
+        if attr in counts:
+            return counts[attr]
+        return RedisHelper.get_count(obj, attr)
 
     def get_likes_count(self, obj):
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
+        liked_ids = getattr(self, '_prefetched_liked_ids', None)
+        if liked_ids is not None:
+            return obj.id in liked_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
-        photo_urls = []
-        for photo in obj.tweetphoto_set.all().order_by('order'):
-            photo_urls.append(photo.file.url)
-        return photo_urls
+        photo_urls = getattr(self, '_prefetched_photo_urls', {})
+        if obj.id in photo_urls:
+            return photo_urls[obj.id]
+        return TweetService.get_photo_urls_through_cache([obj.id])[obj.id]
 
 
 class TweetSerializerForCreate(serializers.ModelSerializer):
@@ -79,9 +110,13 @@ class TweetSerializerForCreate(serializers.ModelSerializer):
 
 
 class TweetSerializerForDetail(TweetSerializer):
-    user = UserSerializerForTweet()
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
+    """
+    Only the latest page of comments and likes is embedded, the rest is
+    paginated through the comments api and the likes action of tweets.
+    The rendered detail is cached, has_liked fields are filled per viewer.
+    """
+    comments = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
@@ -97,3 +132,39 @@ class TweetSerializerForDetail(TweetSerializer):
             'has_liked',
             'photo_urls',
         )
+
+    def get_comments(self, obj):
+        comments = CommentService.get_comments_window(obj.id, EndlessPagination.page_size)
+        # shown in created_at order, same as the comments api
+        return CommentSerializer(
+            comments[::-1],
+            context=self.context,
+            many=True,
+        ).data
+
+    def get_likes(self, obj):
+        return LikeSerializer(
+            obj.like_set[:EndlessPagination.page_size],
+            context=self.context,
+            many=True,
+        ).data
+
+    def to_representation(self, instance):
+        data = TweetService.get_cached_detail(instance.id)
+        if data is None:
+            data = super().to_representation(instance)
+            TweetService.set_cached_detail(instance.id, data)
+
+        user = self.context['request'].user
+        liked_comment_ids = LikeService.get_liked_object_ids(
+            user,
+            Comment,
+            [comment['id'] for comment in data['comments']],
+        )
+        data = dict(data)
+        data['has_liked'] = bool(LikeService.get_liked_object_ids(user, Tweet, [instance.id]))
+        data['comments'] = [
+            dict(comment, has_liked=comment['id'] in liked_comment_ids)
+            for comment in data['comments']
+        ]
+        return data
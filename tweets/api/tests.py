@@ -1,14 +1,26 @@
+from django.conf import settings
+from django.core.cache import caches
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet, TweetPhoto
+from tweets.services import TweetService
+from twitter.cache import DELETED_TWEET_IDS_KEY, TWEET_PHOTO_NAMES_PATTERN
+from utils.redis_client import RedisClient
 from utils.paginations import EndlessPagination
 
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_DELETE_API = '/api/tweets/{}/'
+NEWSFEEDS_URL = '/api/newsfeeds/'
 
 
 class TweetApiTests(TestCase):
@@ -178,6 +190,67 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['user']['nickname'], profile.nickname)
         self.assertEqual(response.data['user']['avatar_url'], None)
 
+    def test_retrieve_from_cache(self):
+        tweet = self.create_tweet(self.user1)
+        comment = self.create_comment(self.user2, tweet)
+        self.create_like(self.user2, tweet)
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        self.anonymous_client.get(url)
+
+        # the rendered detail is cached
+        with CaptureQueriesContext(connection) as queries:
+            response = self.anonymous_client.get(url)
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(response.data['has_liked'], False)
+        self.assertEqual(response.data['likes_count'], 1)
+
+        # has_liked is resolved per viewer
+        response = self.user2_client.get(url)
+        self.assertEqual(response.data['has_liked'], True)
+        self.assertEqual(response.data['comments'][0]['has_liked'], False)
+
+        # comments and likes invalidate the cached detail
+        self.create_like(self.user1, comment)
+        response = self.user1_client.get(url)
+        self.assertEqual(response.data['comments'][0]['likes_count'], 1)
+        self.assertEqual(response.data['comments'][0]['has_liked'], True)
+        self.create_like(self.user1, tweet)
+        self.create_comment(self.user1, tweet)
+        response = self.user2_client.get(url)
+        self.assertEqual(response.data['likes_count'], 2)
+        self.assertEqual(response.data['comments_count'], 2)
+        self.assertEqual(len(response.data['comments']), 2)
+        self.assertEqual(response.data['comments'][0]['has_liked'], False)
+        comment.delete()
+        response = self.user2_client.get(url)
+        self.assertEqual(len(response.data['comments']), 1)
+
+    def test_retrieve_likes(self):
+        page_size = EndlessPagination.page_size
+        tweet = self.create_tweet(self.user1)
+        likes = [
+            self.create_like(self.create_user('liker{}'.format(i)), tweet)
+            for i in range(page_size + 2)
+        ][::-1]
+
+        # the latest page is embedded in the detail
+        response = self.anonymous_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['likes']],
+            [like.user_id for like in likes[:page_size]],
+        )
+
+        url = TWEET_RETRIEVE_API.format(tweet.id) + 'likes/'
+        response = self.anonymous_client.get(url, {
+            'created_at__lt': likes[page_size - 1].created_at,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['results']],
+            [like.user_id for like in likes[page_size:]],
+        )
+
     def test_pagination(self):
         page_size = EndlessPagination.page_size
 
@@ -223,3 +296,189 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['has_next_page'], False)
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    def test_pagination_with_same_created_at(self):
+        page_size = EndlessPagination.page_size
+        # more tweets than cached, all in the same microsecond
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT + page_size * 2):
+            self.tweets1.append(self.create_tweet(self.user1, 'tweet {}'.format(i)))
+        created_at = self.tweets1[0].created_at
+        Tweet.objects.filter(user=self.user1).update(created_at=created_at)
+        self.clear_cache()
+
+        def paginate(params):
+            ids = []
+            while True:
+                response = self.user1_client.get(TWEET_LIST_API, params)
+                ids.extend(r['id'] for r in response.data['results'])
+                if not response.data['has_next_page']:
+                    self.assertEqual(response.data['next_cursor'], None)
+                    return ids
+                params = {'user_id': self.user1.id, 'cursor': response.data['next_cursor']}
+
+        tweet_ids = sorted([tweet.id for tweet in self.tweets1], reverse=True)
+        self.assertEqual(paginate({'user_id': self.user1.id}), tweet_ids)
+        # read from db only
+        RedisClient.get_connection().flushdb()
+        self.assertEqual(paginate({'user_id': self.user1.id}), tweet_ids)
+
+        # newer tweets of the same created_at
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        previous_cursor = response.data['previous_cursor']
+        new_tweet = self.create_tweet(self.user1, 'new tweet')
+        Tweet.objects.filter(id=new_tweet.id).update(created_at=created_at)
+        self.clear_cache()
+        response = self.user1_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': previous_cursor,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual([r['id'] for r in response.data['results']], [new_tweet.id])
+
+        # invalid cursor
+        response = self.user1_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': 'invalid',
+        })
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_pagination_with_same_created_at_in_sorted_set(self):
+        self.test_pagination_with_same_created_at()
+
+    def test_pagination_past_cached_tweets(self):
+        page_size = EndlessPagination.page_size
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        extended_limit = settings.REDIS_LIST_EXTENDED_LENGTH_LIMIT
+        for i in range(extended_limit + page_size):
+            self.tweets1.append(self.create_tweet(self.user1, 'tweet {}'.format(i)))
+        self.clear_cache()
+        tweet_ids = sorted([tweet.id for tweet in self.tweets1], reverse=True)
+
+        def get_cached_length():
+            _, cached_length = TweetService.get_cached_tweets_window(self.user1.id, 1)
+            return cached_length
+
+        params = {'user_id': self.user1.id}
+        ids = []
+        while True:
+            response = self.user1_client.get(TWEET_LIST_API, params)
+            ids.extend(r['id'] for r in response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            params = {'user_id': self.user1.id, 'cursor': response.data['next_cursor']}
+            if len(ids) == page_size:
+                self.assertEqual(get_cached_length(), list_limit)
+        self.assertEqual(ids, tweet_ids)
+        # the second page reached past the cached tweets, which were
+        # extended for the deeper pages
+        self.assertEqual(get_cached_length(), extended_limit)
+
+        # new tweets keep the extended length
+        new_tweet = self.create_tweet(self.user1, 'new tweet')
+        self.assertEqual(get_cached_length(), extended_limit)
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_pagination_past_cached_tweets_in_sorted_set(self):
+        self.test_pagination_past_cached_tweets()
+
+    def test_destroy(self):
+        # user2 follows user1 and reads the newsfeeds
+        self.create_friendship(self.user2, self.user1)
+        NewsFeedService.mark_active_user(self.user2.id)
+        response = self.user1_client.post(TWEET_CREATE_API, {'content': 'to be deleted'})
+        tweet = Tweet.objects.get(id=response.data['id'])
+        TweetPhoto.objects.create(
+            tweet=tweet,
+            user=self.user1,
+            file=SimpleUploadedFile('selfie.jpg', b'fake image', 'image/jpeg'),
+        )
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['results'][0]['tweet']['id'], tweet.id)
+
+        url = TWEET_DELETE_API.format(tweet.id)
+        response = self.anonymous_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.user2_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.user1_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.has_deleted, True)
+        # cleaned up in background
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).exists(), False)
+        self.assertEqual(TweetPhoto.objects.get(tweet=tweet).has_deleted, True)
+        self.assertEqual(TweetService.get_deleted_tweet_ids([tweet.id]), set())
+        ids = [t.id for t in TweetService.get_cached_tweets(self.user1.id)]
+        self.assertEqual(tweet.id in ids, False)
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(tweet.id in [r['tweet']['id'] for r in response.data['results']], False)
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(len(response.data['results']), 3)
+
+        response = self.anonymous_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.user1_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_destroy_in_sorted_set(self):
+        self.test_destroy()
+
+    def test_deleted_tweets_are_skipped_before_cleanup(self):
+        tweet = self.tweets1[-1]
+        self.create_newsfeed(self.user2, tweet)
+        conn = RedisClient.get_connection()
+        conn.sadd(DELETED_TWEET_IDS_KEY, tweet.id)
+
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual([r['id'] for r in response.data['results']], [
+            t.id for t in self.tweets1[:2][::-1]
+        ])
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(tweet.id in [r['tweet']['id'] for r in response.data['results']], False)
+
+    def test_photo_urls_are_prefetched(self):
+        for i, tweet in enumerate(self.tweets1):
+            TweetPhoto.objects.create(
+                user=self.user1,
+                tweet=tweet,
+                file=SimpleUploadedFile(f'selfie{i}.jpg', b'fake image', 'image/jpeg'),
+            )
+
+        def photo_queries():
+            return [
+                query for query in queries.captured_queries
+                if 'tweets_tweetphoto' in query['sql']
+            ]
+
+        # one query for the whole page on cache miss
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(len(photo_queries()), 1)
+        for result in response.data['results']:
+            self.assertEqual(len(result['photo_urls']), 1)
+        # none once cached
+        with CaptureQueriesContext(connection) as queries:
+            self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(len(photo_queries()), 0)
+        # file names are cached, the signed urls are built per read
+        photo = TweetPhoto.objects.get(tweet=self.tweets1[0])
+        cached_names = caches['testing'].get(
+            TWEET_PHOTO_NAMES_PATTERN.format(tweet_id=photo.tweet_id),
+        )
+        self.assertEqual(cached_names, [photo.file.name])
+        self.assertEqual(
+            TweetService.get_photo_urls_through_cache([photo.tweet_id]),
+            {photo.tweet_id: [photo.file.url]},
+        )
+
+        # deleting a photo invalidates the cached urls
+        tweet = self.tweets1[-1]
+        TweetPhoto.objects.filter(tweet=tweet).delete()
+        response = self.user1_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(response.data['results'][0]['id'], tweet.id)
+        self.assertEqual(response.data['results'][0]['photo_urls'], [])
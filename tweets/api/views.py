@@ -1,5 +1,9 @@
+from django.http import Http404
+from functools import partial
+from likes.api.serializers import LikeSerializer
 from newsfeeds.services import NewsFeedService
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from tweets.api.serializers import (
@@ -11,35 +15,56 @@ from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.decorators import required_params
 from utils.paginations import EndlessPagination
+from utils.permissions import IsObjectOwner
 
 
 class TweetViewSet(viewsets.GenericViewSet):
     serializer_class = TweetSerializerForCreate
-    queryset = Tweet.objects.all()
+    queryset = Tweet.objects.filter(has_deleted=False)
     pagination_class = EndlessPagination
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'likes']:
             return [AllowAny()]
+        if self.action == 'destroy':
+            return [IsAuthenticated(), IsObjectOwner()]
         return [IsAuthenticated()]
 
     def retrieve(self, request, *args, **kwargs):
-        tweet = self.get_object()
+        tweet = TweetService.get_tweet_through_cache(kwargs['pk'])
+        if tweet is None:
+            raise Http404
         serializer = TweetSerializerForDetail(
-            self.get_object(),
+            tweet,
             context={'request': request},
         )
         return Response(serializer.data)
 
+    @action(methods=['GET'], detail=True)
+    def likes(self, request, *args, **kwargs):
+        # likes of the tweet beyond the page embedded in the detail
+        tweet = self.get_object()
+        page = self.paginate_queryset(tweet.like_set)
+        serializer = LikeSerializer(
+            page,
+            context={'request': request},
+            many=True,
+        )
+        return self.get_paginated_response(serializer.data)
+
     @required_params(params=['user_id'])
     def list(self, request, *args, **kwargs):
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        # retrieve data from cache first
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
-        if page is None: # retrieve data from db
-            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-            page = self.paginate_queryset(queryset)
+        # retrieve data from cache first, only the page needed is loaded,
+        # and pages past the cached tweets are completed from db
+        page = self.paginator.paginate_stitched_window(
+            partial(TweetService.get_cached_tweets_window, user_id),
+            Tweet.objects.filter(user_id=user_id, has_deleted=False),
+            request,
+            extend_cache=partial(TweetService.extend_cached_tweets, user_id),
+        )
+        # deleted tweets may still be in cache until cleaned up
+        page = TweetService.exclude_deleted_tweets(page)
         serializer = TweetSerializer(
             page,
             context={'request': request},
@@ -66,3 +91,11 @@ class TweetViewSet(viewsets.GenericViewSet):
             TweetSerializer(tweet, context={'request': request}).data,
             status=status.HTTP_201_CREATED,
         )
+
+    def destroy(self, request, *args, **kwargs):
+        tweet = self.get_object()
+        # newsfeeds, cache and photos are cleaned up asynchronously
+        TweetService.delete_tweet(tweet)
+        return Response({
+            'success': True,
+        }, status=status.HTTP_200_OK)
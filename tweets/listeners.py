@@ -4,3 +4,15 @@ def push_tweet_to_cache(sender, instance, created, **kwargs):
 
     from tweets.services import TweetService
     TweetService.push_tweets_to_cache(instance)
+
+
+def invalidate_photo_urls(sender, instance, **kwargs):
+    # status or soft-delete changes of a photo
+    from tweets.services import TweetService
+    TweetService.invalidate_photo_urls(instance.tweet_id)
+    TweetService.invalidate_cached_detail(instance.tweet_id)
+
+
+def invalidate_tweet_detail(sender, instance, **kwargs):
+    from tweets.services import TweetService
+    TweetService.invalidate_cached_detail(instance.id)
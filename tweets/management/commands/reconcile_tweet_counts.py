@@ -0,0 +1,84 @@
+import time
+
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from likes.models import Like
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+
+# in seconds, a flush of the counter is running meanwhile
+LOCK_RETRY_INTERVAL = 1
+
+
+def count_likes(model_class, ids):
+    content_type = ContentType.objects.get_for_model(model_class)
+    return dict(
+        Like.objects.filter(content_type=content_type, object_id__in=ids)
+        .values('object_id')
+        .annotate(count=Count('id'))
+        .values_list('object_id', 'count')
+    )
+
+
+def count_comments(model_class, ids):
+    return dict(
+        Comment.objects.filter(tweet_id__in=ids)
+        .values('tweet_id')
+        .annotate(count=Count('id'))
+        .values_list('tweet_id', 'count')
+    )
+
+
+# write-behind counters of each model and how they are recounted
+RECOUNTS = (
+    (Tweet, {'likes_count': count_likes, 'comments_count': count_comments}),
+    (Comment, {'likes_count': count_likes}),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount likes_count and comments_count of tweets and likes_count of '
+        'comments from the like and comment tables, fixing drift of the '
+        'write-behind counters. Pending deltas are kept, db is fixed to the '
+        'recount minus the pending delta.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = {
+            model_class: self.reconcile(model_class, recounts, options['batch_size'])
+            for model_class, recounts in RECOUNTS
+        }
+        self.stdout.write('Reconciled {} tweets and {} comments'.format(
+            fixed[Tweet],
+            fixed[Comment],
+        ))
+
+    def reconcile(self, model_class, recounts, batch_size):
+        last_id, fixed = 0, 0
+        while True:
+            ids = list(
+                model_class.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return fixed
+            last_id = ids[-1]
+
+            fixed_ids = set()
+            for attr, recount in recounts.items():
+                counts = recount(model_class, ids)
+                counts = {object_id: counts.get(object_id, 0) for object_id in ids}
+                while True:
+                    attr_fixed_ids = RedisHelper.reconcile_counts(model_class, attr, counts)
+                    if attr_fixed_ids is not None:
+                        break
+                    time.sleep(LOCK_RETRY_INTERVAL)
+                fixed_ids.update(attr_fixed_ids)
+            fixed += len(fixed_ids)
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-17 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0003_auto_20230619_1045'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='has_deleted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -4,9 +4,14 @@ from django.db import models
 from django.db.models.signals import post_save, pre_delete
 from likes.models import Like
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
-from tweets.listeners import push_tweet_to_cache
+from tweets.listeners import (
+    invalidate_photo_urls,
+    invalidate_tweet_detail,
+    push_tweet_to_cache,
+)
 from utils.listeners import invalidate_object_cache
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_serializers import CompactModelSerializer
 from utils.time_helpers import utc_now
 
 
@@ -24,6 +29,10 @@ class Tweet(models.Model):
     likes_count = models.IntegerField(default=0, null=True)
     comments_count = models.IntegerField(default=0, null=True)
 
+    # soft-delete tag, the tweet is cleaned up by cleanup_deleted_tweet_task
+    has_deleted = models.BooleanField(default=False)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
     class Meta:
         index_together = (('user', 'created_at'),)
         ordering = ('user', '-created_at')
@@ -44,6 +53,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # hydrated in bulk by UserService.prefetch_users
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
@@ -83,3 +95,16 @@ class TweetPhoto(models.Model):
 post_save.connect(invalidate_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(push_tweet_to_cache, sender=Tweet)
+post_save.connect(invalidate_tweet_detail, sender=Tweet)
+post_save.connect(invalidate_photo_urls, sender=TweetPhoto)
+pre_delete.connect(invalidate_photo_urls, sender=TweetPhoto)
+
+# field layout of tweets cached in redis lists
+CompactModelSerializer.register(Tweet, code=1, version=1, fields=(
+    'id',
+    'user_id',
+    'content',
+    'created_at',
+    'likes_count',
+    'comments_count',
+))
@@ -1,6 +1,23 @@
+from django.conf import settings
+from django.core.cache import caches
 from tweets.models import TweetPhoto, Tweet
-from twitter.cache import USER_TWEETS_PATTERN
-from utils.redis_helper import RedisHelper
+from tweets.tasks import (
+    COUNTER_ATTRS,
+    cleanup_deleted_tweet_task,
+    extend_cached_tweets_task,
+)
+from twitter.cache import (
+    DELETED_TWEET_IDS_KEY,
+    TWEET_DETAIL_PATTERN,
+    TWEET_PHOTO_NAMES_PATTERN,
+    USER_TWEETS_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper, get_timeline_helper
+from utils.time_helpers import utc_now
+
+cache = caches['testing'] if settings.TESTING else caches['default']
 
 
 class TweetService(object):
@@ -17,16 +34,217 @@ class TweetService(object):
             )
             photos.append(photo)
         TweetPhoto.objects.bulk_create(photos)
+        # bulk_create does not send post_save
+        cls.invalidate_photo_urls(tweet.id)
+        cls.invalidate_cached_detail(tweet.id)
+
+    @classmethod
+    def get_photo_urls_through_cache(cls, tweet_ids):
+        """
+        Ordered photo urls of a page of tweets, cache misses are loaded by
+        one tweet_id__in query. Returns {tweet id: [photo url]}.
+        File names are cached and urls built at read time, urls signed by
+        the storage expire sooner than the cache.
+        """
+        keys = {
+            TWEET_PHOTO_NAMES_PATTERN.format(tweet_id=tweet_id): tweet_id
+            for tweet_id in set(tweet_ids)
+        }
+        photo_names = {
+            keys[key]: names
+            for key, names in cache.get_many(keys.keys()).items()
+        }
+        missing_ids = [
+            tweet_id
+            for tweet_id in keys.values()
+            if tweet_id not in photo_names
+        ]
+        if missing_ids:
+            # cache miss, tweets without photos are cached as empty lists
+            missing_photo_names = {tweet_id: [] for tweet_id in missing_ids}
+            photos = TweetPhoto.objects.filter(
+                tweet_id__in=missing_ids,
+                has_deleted=False,
+            ).order_by('tweet_id', 'order').values_list('tweet_id', 'file')
+            for tweet_id, name in photos:
+                missing_photo_names[tweet_id].append(name)
+            cache.set_many({
+                TWEET_PHOTO_NAMES_PATTERN.format(tweet_id=tweet_id): names
+                for tweet_id, names in missing_photo_names.items()
+            })
+            photo_names.update(missing_photo_names)
+
+        storage = TweetPhoto._meta.get_field('file').storage
+        return {
+            tweet_id: [storage.url(name) for name in names]
+            for tweet_id, names in photo_names.items()
+        }
+
+    @classmethod
+    def invalidate_photo_urls(cls, tweet_id):
+        cache.delete(TWEET_PHOTO_NAMES_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def get_tweet_through_cache(cls, tweet_id):
+        # None for tweets which do not exist or are deleted
+        try:
+            tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet_id)
+        except (Tweet.DoesNotExist, ValueError):
+            return None
+        if tweet.has_deleted:
+            return None
+        return tweet
+
+    @classmethod
+    def get_cached_detail(cls, tweet_id):
+        return cache.get(TWEET_DETAIL_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def set_cached_detail(cls, tweet_id, data):
+        cache.set(
+            TWEET_DETAIL_PATTERN.format(tweet_id=tweet_id),
+            data,
+            settings.TWEET_DETAIL_CACHE_TIMEOUT,
+        )
+
+    @classmethod
+    def invalidate_cached_detail(cls, tweet_id):
+        cache.delete(TWEET_DETAIL_PATTERN.format(tweet_id=tweet_id))
 
     @classmethod
     def get_cached_tweets(cls, user_id):
         # queryset is lazy loading
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False) \
+            .order_by('-created_at', '-id')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return get_timeline_helper().load_objects(key, queryset)
+
+    @classmethod
+    def get_cached_tweets_window(cls, user_id, count, created_at__lt=None, created_at__gt=None):
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False) \
+            .order_by('-created_at', '-id')
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return get_timeline_helper().load_objects_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+
+    @classmethod
+    def get_tweets_window(cls, user_id, count, created_at__lt=None, created_at__gt=None):
+        # complete window, tweets beyond the cached list are read from db
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False) \
+            .order_by('-created_at', '-id')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return get_timeline_helper().load_complete_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+
+    @classmethod
+    def get_tweets_windows(cls, user_ids, count, created_at__lt=None, created_at__gt=None):
+        # get_tweets_window of many users, cached lists read in one pipeline
+        return get_timeline_helper().load_complete_windows(
+            [
+                (
+                    USER_TWEETS_PATTERN.format(user_id=user_id),
+                    Tweet.objects.filter(user_id=user_id, has_deleted=False)
+                    .order_by('-created_at', '-id'),
+                )
+                for user_id in user_ids
+            ],
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
 
     @classmethod
     def push_tweets_to_cache(cls, tweet):
-        queryset = Tweet.objects.filter(user_id=tweet.user_id)
+        queryset = Tweet.objects.filter(user_id=tweet.user_id, has_deleted=False)
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, queryset)
+        get_timeline_helper().push_object(key, tweet, queryset)
+
+    @classmethod
+    def extend_cached_tweets(cls, user_id):
+        # a reader scrolled past the cached tweets
+        if settings.REDIS_LIST_EXTEND_ON_DEEP_SCROLL:
+            extend_cached_tweets_task.delay(user_id)
+
+    @classmethod
+    def load_older_tweets_to_cache(cls, user_id):
+        queryset = Tweet.objects.filter(user_id=user_id, has_deleted=False)
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return get_timeline_helper().extend_cache(
+            key,
+            queryset,
+            settings.REDIS_LIST_EXTENDED_LENGTH_LIMIT,
+        )
+
+    @classmethod
+    def delete_tweet(cls, tweet):
+        """
+        Mark the tweet as deleted and leave the rest to
+        cleanup_deleted_tweet_task, readers skip it in the meantime
+        """
+        conn = RedisClient.get_connection()
+        conn.sadd(DELETED_TWEET_IDS_KEY, tweet.id)
+        tweet.has_deleted = True
+        tweet.deleted_at = utc_now()
+        tweet.save(update_fields=['has_deleted', 'deleted_at'])
+        cleanup_deleted_tweet_task.delay(tweet.id)
+
+    @classmethod
+    def exclude_deleted_tweets(cls, objects, tweet_id_attr='id'):
+        objects = list(objects)
+        deleted_tweet_ids = cls.get_deleted_tweet_ids(
+            getattr(obj, tweet_id_attr) for obj in objects
+        )
+        return [
+            obj
+            for obj in objects
+            if getattr(obj, tweet_id_attr) not in deleted_tweet_ids
+        ]
+
+    @classmethod
+    def get_deleted_tweet_ids(cls, tweet_ids):
+        # deleted tweets which may still be in cached lists
+        tweet_ids = list(tweet_ids)
+        if not tweet_ids:
+            return set()
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for tweet_id in tweet_ids:
+            pipe.sismember(DELETED_TWEET_IDS_KEY, tweet_id)
+        return set(
+            tweet_id
+            for tweet_id, deleted in zip(tweet_ids, pipe.execute())
+            if deleted
+        )
+
+    @classmethod
+    def cleanup_deleted_tweet(cls, tweet):
+        """
+        Remove a deleted tweet from the cached tweets of its author, drop
+        its counters and soft-delete its photos. Newsfeeds are cleaned up
+        by NewsFeedService.remove_deleted_tweet first.
+        """
+        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
+        get_timeline_helper().remove_objects(key, [tweet.id])
+
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        for attr in COUNTER_ATTRS:
+            pipe.delete(RedisHelper.get_count_key(tweet, attr))
+            pipe.hdel(RedisHelper.get_pending_count_key(Tweet, attr), tweet.id)
+        pipe.execute()
+
+        TweetPhoto.objects.filter(tweet_id=tweet.id, has_deleted=False) \
+            .update(has_deleted=True, deleted_at=utc_now())
+        cls.invalidate_photo_urls(tweet.id)
+        # nothing cached refers to the tweet anymore
+        conn.srem(DELETED_TWEET_IDS_KEY, tweet.id)
@@ -0,0 +1,38 @@
+from celery import shared_task
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+COUNTER_ATTRS = ('likes_count', 'comments_count')
+COMMENT_COUNTER_ATTRS = ('likes_count',)
+
+
+@shared_task(time_limit=ONE_HOUR)  # avoid indefinite task process
+def flush_pending_counts_task():
+    # write-behind counters, see settings.COUNTER_WRITE_BEHIND
+    from comments.models import Comment
+
+    flushed = {
+        attr: RedisHelper.flush_pending_counts(Tweet, attr)
+        for attr in COUNTER_ATTRS
+    }
+    for attr in COMMENT_COUNTER_ATTRS:
+        flushed['comment_' + attr] = RedisHelper.flush_pending_counts(Comment, attr)
+    return flushed
+
+
+@shared_task(time_limit=ONE_HOUR)
+def cleanup_deleted_tweet_task(tweet_id):
+    from newsfeeds.services import NewsFeedService
+    from tweets.services import TweetService
+
+    tweet = Tweet.objects.get(id=tweet_id)
+    removed = NewsFeedService.remove_deleted_tweet(tweet.id)
+    TweetService.cleanup_deleted_tweet(tweet)
+    return removed
+
+
+@shared_task(time_limit=ONE_HOUR)
+def extend_cached_tweets_task(user_id):
+    from tweets.services import TweetService
+    return TweetService.load_older_tweets_to_cache(user_id)
@@ -1,10 +1,16 @@
+from comments.models import Comment
 from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.test import override_settings
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import TweetPhoto
+from tweets.models import Tweet, TweetPhoto
 from tweets.services import TweetService
+from tweets.tasks import flush_pending_counts_task
 from twitter.cache import USER_TWEETS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer
 from utils.time_helpers import utc_now
 
@@ -53,6 +59,110 @@ class TweetTests(TestCase):
         cached_tweet = DjangoModelSerializer.deserialize(data)
         self.assertEqual(tweet, cached_tweet)
 
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind_counts(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(2, 5)]
+        for user in users:
+            self.create_like(user, self.tweet)
+        comment = self.create_comment(users[0], self.tweet)
+        liked_comment = self.create_comment(users[1], self.tweet)
+        self.create_like(users[2], liked_comment)
+        comment.delete()
+
+        # db is not updated until the deltas are flushed
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(self.tweet.comments_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+
+        # expired redis counters are back-filled with the pending deltas
+        conn = RedisClient.get_connection()
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'comments_count'))
+        self.create_comment(users[2], self.tweet)
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+        counts = RedisHelper.get_counts([self.tweet], ['likes_count', 'comments_count'])
+        self.assertEqual(counts[self.tweet.id], {'likes_count': 3, 'comments_count': 2})
+
+        flush_pending_counts_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 3)
+        self.assertEqual(self.tweet.comments_count, 2)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+        liked_comment.refresh_from_db()
+        self.assertEqual(liked_comment.likes_count, 1)
+        # nothing left to flush
+        self.assertEqual(flush_pending_counts_task(), {
+            'likes_count': 0,
+            'comments_count': 0,
+            'comment_likes_count': 0,
+        })
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_backfill_across_flush_is_not_cached(self):
+        self.create_like(self.user1, self.tweet)
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(self.tweet, 'likes_count')
+        conn.delete(key)
+
+        # the pending delta is flushed after db is read, before it is added
+        tweet = Tweet.objects.get(id=self.tweet.id)
+
+        def refresh_from_db(fields):
+            Tweet.refresh_from_db(tweet, fields=fields)
+            flush_pending_counts_task()
+        tweet.refresh_from_db = refresh_from_db
+        RedisHelper.get_count(tweet, 'likes_count')
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+        # flushed deltas are taken out of the pending hash
+        self.create_like(self.create_user('user2'), self.tweet)
+        pending_key = RedisHelper.get_pending_count_key(Tweet, 'likes_count')
+        self.assertEqual(RedisHelper.flush_pending_counts(Tweet, 'likes_count'), 1)
+        self.assertEqual(conn.hgetall(pending_key), {})
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+
+    def test_reconcile_tweet_counts(self):
+        self.create_like(self.user1, self.tweet)
+        self.create_comment(self.user1, self.tweet)
+        self.tweet.likes_count = 10
+        self.tweet.comments_count = 10
+        self.tweet.save()
+        RedisHelper.get_count(self.tweet, 'likes_count')
+
+        call_command('reconcile_tweet_counts', stdout=StringIO())
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_reconcile_keeps_pending_counts(self):
+        user2 = self.create_user('user2')
+        self.create_like(user2, self.tweet)
+        comment = self.create_comment(self.user1, self.tweet)
+        self.create_like(user2, comment)
+        Comment.objects.filter(id=comment.id).update(likes_count=10)
+
+        stdout = StringIO()
+        call_command('reconcile_tweet_counts', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), 'Reconciled 0 tweets and 1 comments')
+        # the likes are still pending, db is fixed to the recount minus them
+        comment.refresh_from_db()
+        self.assertEqual(comment.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(comment, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+
+        flush_pending_counts_task()
+        self.tweet.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(comment.likes_count, 1)
+
 
 class TweetServiceTests(TestCase):
     def setUp(self):
@@ -96,3 +206,39 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.user1.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_get_cached_tweets_window(self):
+        user2 = self.create_user('user2')
+        tweets = [
+            self.create_tweet(user2, 'tweet {}'.format(i))
+            for i in range(5)
+        ][::-1]
+
+        RedisClient.clear()
+
+        # cache miss
+        window, cached_length = TweetService.get_cached_tweets_window(user2.id, 2)
+        self.assertEqual([t.id for t in window], [tweets[0].id, tweets[1].id])
+        self.assertEqual(cached_length, 5)
+
+        # cache hit, older than the cursor
+        window, cached_length = TweetService.get_cached_tweets_window(
+            user2.id,
+            2,
+            created_at__lt=tweets[1].created_at,
+        )
+        self.assertEqual([t.id for t in window], [tweets[2].id, tweets[3].id])
+        self.assertEqual(cached_length, 5)
+
+        # newer than the cursor, no count limit
+        window, _ = TweetService.get_cached_tweets_window(
+            user2.id,
+            None,
+            created_at__gt=tweets[3].created_at,
+        )
+        self.assertEqual([t.id for t in window], [t.id for t in tweets[:3]])
+
+    @override_settings(REDIS_TIMELINE_STORE='sorted_set')
+    def test_get_user_tweets_in_sorted_set(self):
+        self.test_get_user_tweets()
+        self.test_get_cached_tweets_window()
@@ -1,7 +1,30 @@
 # Memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
+TWEET_DETAIL_PATTERN = 'tweet_detail:{tweet_id}'
+TWEET_PHOTO_NAMES_PATTERN = 'tweet_photo_names:{tweet_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # Redis
+ACTIVE_USER_PATTERN = 'active_user:{user_id}'
+CACHE_REBUILD_LOCK_PATTERN = 'rebuild_lock:{key}'
+CELEBRITY_USER_IDS_KEY = 'celebrity_user_ids'
+COUNT_BACKFILL_PATTERN = 'count_backfill:{key}'
+COUNTS_FLUSH_EPOCH_PATTERN = 'counts_flush_epoch:{model},{attr}'
+COUNTS_FLUSH_LOCK_PATTERN = 'counts_flush_lock:{model},{attr}'
+DELETED_TWEET_IDS_KEY = 'deleted_tweet_ids'
+FANOUT_PROGRESS_PATTERN = 'fanout_progress:{tweet_id}'
+FOLLOWER_COUNT_PATTERN = 'follower_count:{user_id}'
+FOLLOWER_IDS_PATTERN = 'follower_ids:{user_id}'
+FOLLOWING_COUNT_PATTERN = 'following_count:{user_id}'
+FOLLOWING_IDS_PATTERN = 'following_ids:{user_id}'
+FOLLOWINGS_PATTERN = 'followings:{user_id}'
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidation'
+NEWSFEED_MATERIALIZING_PATTERN = 'newsfeed_materializing:{user_id}'
+PENDING_COUNTS_PATTERN = 'pending_counts:{model},{attr}'
+SET_LOAD_PATTERN = 'set_load:{key}:{token}'
+SET_LOADING_PATTERN = 'set_loading:{key}'
+SET_PENDING_OPS_PATTERN = 'set_pending_ops:{key}'
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'
+USER_LIKED_OVERFLOW_PATTERN = 'user_liked_overflow:{key}'
+USER_LIKED_PATTERN = 'user_liked:{user_id},{model}'
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
 USER_NEWSFEEDS_PATTERN = 'newsfeeds:{user_id}'
@@ -177,17 +177,82 @@ CACHES = {
     },
 }
 
+# per-process LRU cache in front of memcached, invalidated over redis pub/sub
+LOCAL_CACHE_ENABLED = True
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_TTL = 60  # in seconds
+
 # Redis settings
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# structure of cached timelines, 'list' or 'sorted_set' (scored by created_at)
+REDIS_TIMELINE_STORE = 'list'
+# readers scrolling past the cached tweets and newsfeeds get the cached
+# lists extended in the background, up to this many objects
+REDIS_LIST_EXTEND_ON_DEEP_SCROLL = True
+REDIS_LIST_EXTENDED_LENGTH_LIMIT = 1000 if not TESTING else 40
+# reads start re-arming the expiry of cached timelines around this many
+# seconds before they expire, see RedisHelper._rearm_expiry_early
+REDIS_EARLY_REARM_WINDOW = 3600
+
+# rendered tweet details are invalidated by tweet, comment and like changes,
+# user profiles embedded in them are refreshed when they expire
+TWEET_DETAIL_CACHE_TIMEOUT = 60  # in seconds
+
+# single flight cache rebuilds, in seconds
+CACHE_REBUILD_LOCK_TIMEOUT = 5
+CACHE_REBUILD_WAIT_TIMEOUT = 0.5
+CACHE_REBUILD_POLL_INTERVAL = 0.02
+
+# write-behind counters: likes / comments only update the redis counters
+# and a hash of pending deltas, flushed to db by flush_pending_counts_task
+COUNTER_WRITE_BEHIND = False
+COUNTER_FLUSH_INTERVAL = 10  # in seconds
+# a flush of a counter holds its lock at most this long (in seconds), as
+# long as the flush task may run
+COUNTER_FLUSH_LOCK_TIMEOUT = 60 * 60
+
+# fanout of a tweet is split into batch tasks of this many followers
+FANOUT_BATCH_SIZE = 1000
+FANOUT_BULK_CREATE_BATCH_SIZE = 200
+# follower and following ids, and ids of the objects users liked, are
+# cached whole, loaded from db in batches
+REDIS_SET_LOAD_BATCH_SIZE = 1000
+# users who liked more objects of a type are not cached, has_liked of a page
+# is looked up in db
+LIKED_SET_LOAD_LIMIT = 10000 if not TESTING else 5
+# writes to a set cached whole are logged for replay this long (in seconds)
+# after a load of the set started, see utils.redis_set_helper, back-fills
+# of friendship counters are given as long
+REDIS_SET_LOAD_TIMEOUT = 300
+# tweets of authors with this many followers are not fanned out,
+# followers merge them into their newsfeeds at read time
+CELEBRITY_FOLLOWER_THRESHOLD = 10000
+# fanouts skip users who did not read their newsfeeds for this long, their
+# newsfeeds are materialized in the background on their next read. Reads
+# mark users active either way, turn it on once it has been deployed off for
+# NEWSFEED_ACTIVE_USER_TTL, else every user counts as inactive
+NEWSFEED_SKIP_INACTIVE_USERS = False
+NEWSFEED_ACTIVE_USER_TTL = 14 * 86400  # in seconds
+# reads are served in pull mode while newsfeeds are materialized, at most
+# this long (in seconds) if the task is lost
+NEWSFEED_MATERIALIZE_TIMEOUT = 300
+# newsfeeds of an unfollowed user are deleted in batches of this size
+NEWSFEED_PURGE_BATCH_SIZE = 1000
 
 # Celery Configuration Options
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING else 'redis://127.0.0.1:6379/0'
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
+CELERY_BEAT_SCHEDULE = {
+    'flush-pending-counts': {
+        'task': 'tweets.tasks.flush_pending_counts_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+}
 
 
 try:
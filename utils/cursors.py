@@ -0,0 +1,98 @@
+"""
+Keyset cursors of timelines ordered by (created_at, id), newest first.
+
+Window bounds, the created_at__lt / created_at__gt arguments of paginations,
+services and redis helpers, are either a datetime as in the legacy query
+params, or a Keyset which also orders the objects sharing a created_at.
+"""
+import base64
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from utils.redis_serializers import EPOCH, ONE_MICROSECOND
+
+# ids are positive, a datetime bound is the keyset before (lt) or after
+# (gt) every object created at that time
+MIN_ID = 0
+MAX_ID = 2 ** 63 - 1
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class Keyset(namedtuple('Keyset', ('created_at', 'id'))):
+    __slots__ = ()
+
+
+def get_id_field(model_class):
+    # models whose rows are unique by another column per timeline, such as
+    # the tweet of a newsfeed, set keyset_id_field
+    return getattr(model_class, 'keyset_id_field', 'id')
+
+
+def get_keyset(obj):
+    return Keyset(obj.created_at, getattr(obj, get_id_field(obj.__class__)) or MIN_ID)
+
+
+def to_upper_keyset(bound):
+    if bound is None or isinstance(bound, Keyset):
+        return bound
+    return Keyset(bound, MIN_ID)
+
+
+def to_lower_keyset(bound):
+    if bound is None or isinstance(bound, Keyset):
+        return bound
+    return Keyset(bound, MAX_ID)
+
+
+def order_queryset(queryset):
+    return queryset.order_by('-created_at', '-' + get_id_field(queryset.model))
+
+
+def filter_queryset(queryset, created_at__lt=None, created_at__gt=None):
+    """
+    Rows between the bounds. The created_at range comes first so that the
+    (..., created_at) indexes are used, the id only breaks ties.
+    """
+    id_field = get_id_field(queryset.model)
+    if isinstance(created_at__lt, Keyset):
+        queryset = queryset.filter(created_at__lte=created_at__lt.created_at).filter(
+            Q(created_at__lt=created_at__lt.created_at)
+            | Q(**{id_field + '__lt': created_at__lt.id})
+        )
+    elif created_at__lt is not None:
+        queryset = queryset.filter(created_at__lt=created_at__lt)
+    if isinstance(created_at__gt, Keyset):
+        queryset = queryset.filter(created_at__gte=created_at__gt.created_at).filter(
+            Q(created_at__gt=created_at__gt.created_at)
+            | Q(**{id_field + '__gt': created_at__gt.id})
+        )
+    elif created_at__gt is not None:
+        queryset = queryset.filter(created_at__gt=created_at__gt)
+    return queryset
+
+
+def encode_cursor(direction, keyset):
+    micros = (keyset.created_at - EPOCH) // ONE_MICROSECOND
+    raw = '{},{},{}'.format(direction, micros, keyset.id)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns (direction, keyset), NEXT pages go back in time and PREVIOUS
+    pages load what is newer than the keyset
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        direction, micros, object_id = raw.split(',')
+        if direction not in (NEXT, PREVIOUS):
+            raise ValueError(direction)
+        created_at = EPOCH + timedelta(microseconds=int(micros))
+        return direction, Keyset(created_at, int(object_id))
+    except (TypeError, ValueError, UnicodeError):
+        raise NotFound('Invalid cursor')
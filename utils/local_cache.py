@@ -0,0 +1,125 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from twitter.cache import LOCAL_CACHE_INVALIDATION_CHANNEL
+from utils.redis_client import RedisClient
+
+
+class LocalCache:
+    """
+    Bounded per-process LRU cache with TTL, in front of memcached for the
+    hot objects. Values are copied in and out, so that attributes hydrated
+    on a returned object never leak into the cache.
+    Invalidations are broadcast over redis pub/sub to every process.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        if not settings.LOCAL_CACHE_ENABLED:
+            return None
+        self._start_listener()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] < time.monotonic():
+                # expired
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return copy.copy(item[0])
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value):
+        if not settings.LOCAL_CACHE_ENABLED:
+            return
+        item = (copy.copy(value), time.monotonic() + self.ttl)
+        with self._lock:
+            self._data[key] = item
+            self._data.move_to_end(key)
+            # evict the least recently used
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_many(self, data):
+        for key, value in data.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate(self, key):
+        # evict locally, then in every other process
+        self.delete(key)
+        if settings.LOCAL_CACHE_ENABLED:
+            conn = RedisClient.get_connection()
+            conn.publish(LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _on_invalidation(self, message):
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        self.delete(key)
+
+    def _start_listener(self):
+        # threads do not survive a fork, start one listener per process
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            pubsub = RedisClient.get_connection().pubsub(
+                ignore_subscribe_messages=True,
+            )
+            pubsub.subscribe(**{
+                LOCAL_CACHE_INVALIDATION_CHANNEL: self._on_invalidation,
+            })
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            self._listener_pid = os.getpid()
+
+
+local_cache = LocalCache(
+    max_size=settings.LOCAL_CACHE_MAX_SIZE,
+    ttl=settings.LOCAL_CACHE_TTL,
+)
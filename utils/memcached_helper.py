@@ -1,5 +1,9 @@
+import time
+
 from django.conf import settings
 from django.core.cache import caches
+from twitter.cache import CACHE_REBUILD_LOCK_PATTERN
+from utils.local_cache import local_cache
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -13,16 +17,92 @@ class MemcachedHelper:
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
+        # first layer of cache, in process
+        obj = local_cache.get(key)
+        if obj is not None:
+            return obj
         # cache hit
         obj = cache.get(key)
         if obj:
+            local_cache.set(key, obj)
             return obj
-        # cache miss
-        obj = model_class.objects.get(id=object_id)  # if not found, raise error
-        cache.set(key, obj)
+        # cache miss, only one caller loads from db, the others wait briefly
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        if not cache.add(lock_key, 1, settings.CACHE_REBUILD_LOCK_TIMEOUT):
+            obj = cls._wait_for_object(key, lock_key)
+            if obj:
+                local_cache.set(key, obj)
+                return obj
+            # read from db without loading the cache, the lock is not ours
+            return model_class.objects.get(id=object_id)
+        try:
+            obj = model_class.objects.get(id=object_id)  # if not found, raise error
+            cache.set(key, obj)
+        finally:
+            cache.delete(lock_key)
+        local_cache.set(key, obj)
         return obj
 
+    @classmethod
+    def _wait_for_object(cls, key, lock_key):
+        deadline = time.monotonic() + settings.CACHE_REBUILD_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+            obj = cache.get(key)
+            if obj:
+                return obj
+            if cache.get(lock_key) is None:
+                break
+        return None
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        Multi-get of objects, cache misses are loaded by one id__in query.
+        Returns {object id: object}, objects not found are left out.
+        """
+        keys = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in set(object_ids)
+            if object_id is not None
+        }
+        # first layer of cache, in process
+        objects = {
+            keys[key]: obj
+            for key, obj in local_cache.get_many(keys.keys()).items()
+        }
+        missing_keys = [
+            key
+            for key, object_id in keys.items()
+            if object_id not in objects
+        ]
+        if not missing_keys:
+            return objects
+
+        # cache hit
+        cached_objects = cache.get_many(missing_keys)
+        local_cache.set_many(cached_objects)
+        objects.update({keys[key]: obj for key, obj in cached_objects.items()})
+        missing_ids = [
+            object_id
+            for object_id in keys.values()
+            if object_id not in objects
+        ]
+        if not missing_ids:
+            return objects
+
+        # cache miss
+        missing_objects = {
+            cls.get_key(model_class, obj.id): obj
+            for obj in model_class.objects.filter(id__in=missing_ids)
+        }
+        cache.set_many(missing_objects)
+        local_cache.set_many(missing_objects)
+        objects.update({obj.id: obj for obj in missing_objects.values()})
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
         cache.delete(key)
+        local_cache.invalidate(key)
@@ -1,19 +1,103 @@
+import heapq
+from functools import partial
+
 from dateutil import parser
 from django.conf import settings
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import BasePagination
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from utils.cursors import (
+    NEXT,
+    PREVIOUS,
+    decode_cursor,
+    encode_cursor,
+    filter_queryset,
+    get_keyset,
+    order_queryset,
+    to_lower_keyset,
+    to_upper_keyset,
+)
+
+
+class CountedPaginator(Paginator):
+    """
+    Django paginator taking the count from get_count(), such as a cached
+    counter, instead of a COUNT(*) over the queryset
+    """
+
+    def __init__(self, object_list, per_page, get_count=None, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.get_count = get_count
+
+    @cached_property
+    def count(self):
+        if self.get_count is None:
+            return super(CountedPaginator, self).count
+        return self.get_count()
 
 
 class FriendshipPagination(PageNumberPagination):
+    """
+    Pages by number with the total counts, or, when the cursor param is
+    given (empty for the first page), by (created_at, id) keyset without
+    counting at all
+    """
     # default page size
     page_size = 20
     # page_size_query_param to customize page size on different clients
     page_size_query_param = 'size'
     # maximum size allowed for clients
     max_page_size = 20
+    cursor_query_param = 'cursor'
+    cursor_mode = False
+    has_next_page = False
+    next_cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None, get_count=None, load_window=None):
+        """
+        queryset is a QuerySet or a list supporting slices such as the
+        cached friendships. get_count() returns its total count, only called
+        when paging by number. load_window(count, created_at__lt) returns
+        its objects older than the cursor, newest first, when paging by
+        cursor, queryset is filtered otherwise.
+        """
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if self.cursor_mode:
+            return self.paginate_queryset_by_cursor(queryset, request, load_window)
+        self.django_paginator_class = partial(CountedPaginator, get_count=get_count)
+        return super(FriendshipPagination, self).paginate_queryset(queryset, request, view)
+
+    def paginate_queryset_by_cursor(self, queryset, request, load_window=None):
+        page_size = self.get_page_size(request)
+        cursor = request.query_params[self.cursor_query_param]
+        keyset = None
+        if cursor:
+            direction, keyset = decode_cursor(cursor)
+            if direction != NEXT:
+                raise NotFound('Invalid cursor')
+
+        # check if next page exists, to avoid empty load
+        if load_window is not None:
+            objects = list(load_window(page_size + 1, created_at__lt=keyset))
+        else:
+            queryset = filter_queryset(queryset, created_at__lt=keyset)
+            objects = list(order_queryset(queryset)[:page_size + 1])
+        self.has_next_page = len(objects) > page_size
+        objects = objects[:page_size]
+        if self.has_next_page:
+            self.next_cursor = encode_cursor(NEXT, get_keyset(objects[-1]))
+        return objects
 
     def get_paginated_response(self, data):
+        if self.cursor_mode:
+            return Response({
+                'has_next_page': self.has_next_page,
+                'next_cursor': self.next_cursor,
+                'results': data,
+            })
         return Response({
             'total_results': self.page.paginator.count,
             'total_pages': self.page.paginator.num_pages,
@@ -24,8 +108,17 @@ class FriendshipPagination(PageNumberPagination):
 
 
 class EndlessPagination(BasePagination):
+    """
+    Pages go back in time, newest first. Clients pass the opaque cursors of
+    the previous response, next_cursor for older objects and previous_cursor
+    for newer ones, or the legacy created_at__lt / created_at__gt params.
+    Cursors are (created_at, id) keysets, see utils.cursors, so objects
+    sharing a created_at are neither skipped nor repeated across pages.
+    """
     page_size = 20 if not settings.TESTING else 10
     has_next_page = False
+    first_keyset = None
+    last_keyset = None
 
     def __int__(self):
         super(EndlessPagination, self).__init__()
@@ -33,52 +126,80 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
+    def get_bounds(self, request):
         """
-        Pagination for list
+        (created_at__lt, created_at__gt) of the request, parsed once into
+        keysets or datetimes
         """
+        if 'cursor' in request.query_params:
+            direction, keyset = decode_cursor(request.query_params['cursor'])
+            if direction == NEXT:
+                return keyset, None
+            return None, keyset
+
+        created_at__lt, created_at__gt = None, None
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
         if 'created_at__gt' in request.query_params:
             created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+        return created_at__lt, created_at__gt
+
+    def _set_page(self, objects, created_at__gt=None):
+        # keysets the cursors of the response are built from
+        objects = list(objects)
+        if objects:
+            self.first_keyset = get_keyset(objects[0])
+            self.last_keyset = get_keyset(objects[-1])
+        elif created_at__gt is not None:
+            # nothing newer yet, poll from the same place
+            self.first_keyset = to_lower_keyset(created_at__gt)
+        return objects
+
+    def paginate_ordered_list(self, reverse_ordered_list, request):
+        """
+        Pagination for list
+        """
+        created_at__lt, created_at__gt = self.get_bounds(request)
+        if created_at__gt is not None:
+            lower = to_lower_keyset(created_at__gt)
             objects = []
             for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
+                if get_keyset(obj) > lower:
                     objects.append(obj)
                 else:
                     break
             self.has_next_page = False
-            return objects
+            return self._set_page(objects, created_at__gt)
 
         index = 0
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+        if created_at__lt is not None:
+            upper = to_upper_keyset(created_at__lt)
             for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
+                if get_keyset(obj) < upper:
                     break
             else:
                 reverse_ordered_list = []
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+        return self._set_page(reverse_ordered_list[index: index + self.page_size])
 
     def paginate_queryset(self, queryset, request, view=None):
         """
         Pagination for queryset
         """
+        created_at__lt, created_at__gt = self.get_bounds(request)
         # refresh the page will load all latest posts
-        if 'created_at__gt' in request.query_params:
-            created_at__gt = request.query_params['created_at__gt']
-            queryset = queryset.filter(created_at__gt=created_at__gt)
+        if created_at__gt is not None:
+            queryset = filter_queryset(queryset, created_at__gt=created_at__gt)
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            return self._set_page(order_queryset(queryset), created_at__gt)
 
         # reload the page for older posts
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = request.query_params['created_at__lt']
-            queryset = queryset.filter(created_at__lt=created_at__lt)
+        queryset = filter_queryset(queryset, created_at__lt=created_at__lt)
 
         # check if next page exists, to avoid empty load
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
-        self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]
+        objects = list(order_queryset(queryset)[:self.page_size + 1])
+        self.has_next_page = len(objects) > self.page_size
+        return self._set_page(objects[:self.page_size])
 
     def paginate_cached_list(self, cached_list, request):
         """
@@ -87,7 +208,8 @@ class EndlessPagination(BasePagination):
         paginated_list = self.paginate_ordered_list(cached_list, request)
         # refresh the page, paginated_list contains the latest data
         # directly return
-        if 'created_at__gt' in request.query_params:
+        _, created_at__gt = self.get_bounds(request)
+        if created_at__gt is not None:
             return paginated_list
         # has_next_page is true, cached_list still contains data
         # also directly return
@@ -100,8 +222,88 @@ class EndlessPagination(BasePagination):
         # database exists data not in cache, retrieve data from db
         return None
 
+    def paginate_stitched_window(self, load_window, queryset, request, extend_cache=None):
+        """
+        Pagination for cached list which only loads the page it needs,
+        load_window(count, created_at__lt, created_at__gt) returns the
+        cached objects between the cursors and the length of the cache.
+        A page reaching past the tail of the cached list is completed from
+        queryset, starting right after the last cached object. extend_cache()
+        is called when db was read, to let the cached list grow for readers
+        scrolling deep.
+        """
+        created_at__lt, created_at__gt = self.get_bounds(request)
+        # refresh the page, the latest data is always in cache
+        if created_at__gt is not None:
+            objects, _ = load_window(None, created_at__gt=created_at__gt)
+            self.has_next_page = False
+            return self._set_page(objects, created_at__gt)
+
+        # load one more object to check if next page exists
+        count = self.page_size + 1
+        objects, cached_length = load_window(count, created_at__lt=created_at__lt)
+        if len(objects) < count and cached_length >= settings.REDIS_LIST_LENGTH_LIMIT:
+            # the cached list ends within the page, db has the rest
+            if objects:
+                created_at__lt = get_keyset(objects[-1])
+            queryset = filter_queryset(queryset, created_at__lt=created_at__lt)
+            remainder = list(order_queryset(queryset)[:count - len(objects)])
+            objects = list(objects) + remainder
+            if remainder and extend_cache is not None:
+                extend_cache()
+
+        self.has_next_page = len(objects) > self.page_size
+        return self._set_page(objects[:self.page_size])
+
+    def paginate_merged_windows(self, load_windows, request, key=None):
+        """
+        Pagination over several timelines merged by keyset, each
+        load_window(count, created_at__lt, created_at__gt) returns the
+        complete list of objects between the cursors, newest first.
+        Objects with the same key(obj) are only returned once.
+        """
+        created_at__lt, created_at__gt = self.get_bounds(request)
+        count = None
+        if created_at__gt is None:
+            # load one more object to check if next page exists
+            count = self.page_size + 1
+        else:
+            created_at__lt = None
+
+        windows = [
+            load_window(count, created_at__lt=created_at__lt, created_at__gt=created_at__gt)
+            for load_window in load_windows
+        ]
+        objects, seen_keys = [], set()
+        for obj in heapq.merge(*windows, key=get_keyset, reverse=True):
+            if key is not None:
+                if key(obj) in seen_keys:
+                    continue
+                seen_keys.add(key(obj))
+            objects.append(obj)
+            if count is not None and len(objects) >= count:
+                break
+
+        if created_at__gt is not None:
+            self.has_next_page = False
+            return self._set_page(objects, created_at__gt)
+        self.has_next_page = len(objects) > self.page_size
+        return self._set_page(objects[:self.page_size])
+
+    def get_next_cursor(self):
+        if not self.has_next_page or self.last_keyset is None:
+            return None
+        return encode_cursor(NEXT, self.last_keyset)
+
+    def get_previous_cursor(self):
+        if self.first_keyset is None:
+            return None
+        return encode_cursor(PREVIOUS, self.first_keyset)
+
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': self.get_next_cursor(),
+            'previous_cursor': self.get_previous_cursor(),
             'results': data,
         })
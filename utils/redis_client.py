@@ -4,6 +4,7 @@ import redis
 
 class RedisClient:
     conn = None
+    scripts = {}
 
     # Singleton Pattern
     @classmethod
@@ -17,6 +18,14 @@ class RedisClient:
         )
         return cls.conn
 
+    @classmethod
+    def get_script(cls, script):
+        # lua scripts are registered once, then called through EVALSHA
+        if script not in cls.scripts:
+            conn = cls.get_connection()
+            cls.scripts[script] = conn.register_script(script)
+        return cls.scripts[script]
+
     @classmethod
     def clear(cls):
         # clear all keys in Redis, for testing
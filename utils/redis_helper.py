@@ -1,68 +1,717 @@
-from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+import heapq
+import math
+import random
+import struct
+import time
+from functools import partial
+
 from django.conf import settings
+from django.db.models import F
+from redis.exceptions import WatchError
+from twitter.cache import (
+    CACHE_REBUILD_LOCK_PATTERN,
+    COUNTS_FLUSH_EPOCH_PATTERN,
+    COUNTS_FLUSH_LOCK_PATTERN,
+    PENDING_COUNTS_PATTERN,
+)
+from utils.cursors import (
+    Keyset,
+    filter_queryset,
+    get_id_field,
+    get_keyset,
+    order_queryset,
+    to_lower_keyset,
+    to_upper_keyset,
+)
+from utils.redis_client import RedisClient
+from utils.redis_lock import RedisLock
+from utils.redis_serializers import CompactModelSerializer, EPOCH, ONE_MICROSECOND
+
+
+# load only if the key is absent, so that concurrent cache misses
+# can not push several copies of the same list
+LIST_LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# push only if the key exists, otherwise the caller back-fills the list.
+# lists extended past the limit (see extend_cache) keep their length.
+# ARGV[3] is the created_at of the object in microseconds, followed by
+# pairs of schema header and created_at position to decode cached entries
+# with, an object older than the head (a fanout which ran late) is inserted
+# in order. Entries of other encodings are taken as older. Returns 1 if
+# pushed, 0 if the key is missing and -1 if the object is older than a full
+# list, it is read from db past the list.
+LIST_PUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local limit = math.max(tonumber(ARGV[2]), redis.call('LLEN', KEYS[1]))
+local created_at = tonumber(ARGV[3])
+local positions = {}
+for i = 4, #ARGV, 2 do
+    positions[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+local function is_newer(entry)
+    local position = positions[string.sub(entry, 1, 3)]
+    if position == nil then
+        return false
+    end
+    return cjson.decode(string.sub(entry, 4))[position] > created_at
+end
+
+if not is_newer(redis.call('LINDEX', KEYS[1], 0)) then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+else
+    local pivot = nil
+    for _, entry in ipairs(redis.call('LRANGE', KEYS[1], 1, -1)) do
+        if not is_newer(entry) then
+            pivot = entry
+            break
+        end
+    end
+    if pivot ~= nil then
+        redis.call('LINSERT', KEYS[1], 'BEFORE', pivot, ARGV[1])
+    elseif redis.call('LLEN', KEYS[1]) < tonumber(ARGV[2]) then
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+    else
+        return -1
+    end
+end
+redis.call('LTRIM', KEYS[1], 0, limit - 1)
+return 1
+"""
+
+# append older objects only if the tail is still the one they follow
+LIST_EXTEND_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], -1) ~= ARGV[1] then
+    return 0
+end
+return redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+"""
+
+
+# KEYS are the pending deltas of a counter and its flush epoch, ARGV pairs
+# of object id and delta flushed to db. Deltas are taken out rather than
+# the hash deleted, those recorded during the flush stay pending
+PENDING_COUNTS_TAKE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -ARGV[i + 1]) == 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+redis.call('INCR', KEYS[2])
+return 1
+"""
+
+# KEYS are the flush lock and flush epoch of ARGV[1] counters followed by
+# the counters to back-fill. ARGV[2] is the expire time, then the epochs
+# read before db, then the counts. A back-fill which read across a flush
+# may have counted a delta twice or not at all, it is not cached
+COUNTS_BACKFILL_SCRIPT = """
+local n = tonumber(ARGV[1])
+for i = 1, n do
+    if redis.call('EXISTS', KEYS[2 * i - 1]) == 1 then
+        return 0
+    end
+    if tonumber(redis.call('GET', KEYS[2 * i]) or 0) ~= tonumber(ARGV[2 + i]) then
+        return 0
+    end
+end
+for i = 2 * n + 1, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i - n + 2], 'EX', ARGV[2], 'NX')
+end
+return 1
+"""
 
 
 class RedisHelper:
+    # codec of the objects in cached lists, reads legacy json entries too
+    serializer = CompactModelSerializer
+
     @classmethod
     def _load_cache_to_list(cls, key, objects):
-        conn = RedisClient.get_connection()
-
         serialized_list = []
         # maximum cache size
         # only if exceed the limit, will retrieve data from database
         for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
+            serialized_data = cls.serializer.serialize(obj)
             serialized_list.append(serialized_data)
 
         if serialized_list:
-            conn.rpush(key, *serialized_list)
+            script = RedisClient.get_script(LIST_LOAD_SCRIPT)
+            script(keys=[key], args=[settings.REDIS_KEY_EXPIRE_TIME, *serialized_list])
+
+    @classmethod
+    def _load_cache(cls, key, objects):
+        cls._load_cache_to_list(key, objects)
+
+    @classmethod
+    def _read_cache(cls, key):
+        conn = RedisClient.get_connection()
+        return [
+            cls.serializer.deserialize(serialized_data)
+            for serialized_data in conn.lrange(key, 0, -1)
+        ]
+
+    @classmethod
+    def _rebuild_cache(cls, key, queryset):
+        """
+        Back-fill on cache miss in a single flight: only the caller holding
+        the rebuild lock queries the db, the others poll the cache briefly.
+        Returns the objects loaded into the cache.
+        """
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        token = RedisLock.acquire(lock_key, settings.CACHE_REBUILD_LOCK_TIMEOUT)
+        if token is None:
+            deadline = time.monotonic() + settings.CACHE_REBUILD_WAIT_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(settings.CACHE_REBUILD_POLL_INTERVAL)
+                objects = cls._read_cache(key)
+                if objects:
+                    return objects
+                if not RedisLock.is_locked(lock_key):
+                    # rebuilt as empty, or the rebuild failed
+                    break
+            # read from db without loading the cache
+            return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+
+        try:
+            objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+            cls._load_cache(key, objects)
+            return objects
+        finally:
+            RedisLock.release(lock_key, token)
+
+    @classmethod
+    def _rearm_expiry_early(cls, conn, key, ttl):
+        """
+        Probabilistic early expiration, applied to the expiry only: the
+        closer a key gets to its expiry, the more likely a read re-arms it,
+        so hot timelines do not expire and get rebuilt by a burst of
+        readers. The cached objects are not reloaded, timelines are written
+        through so they are current already.
+        """
+        if ttl is None or ttl < 0:
+            return
+        # 1 - random() is in (0, 1]
+        threshold = -settings.REDIS_EARLY_REARM_WINDOW * math.log(1 - random.random())
+        if ttl / 1000 < threshold:
             conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
 
     @classmethod
     def load_objects(cls, key, queryset):
         conn = RedisClient.get_connection()
 
-        # cache hit
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
+        pipe = conn.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.pttl(key)
+        serialized_list, ttl = pipe.execute()
+
+        # cache hit, redis does not keep empty lists
+        if serialized_list:
+            cls._rearm_expiry_early(conn, key, ttl)
             objects = []
             for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
+                deserialized_obj = cls.serializer.deserialize(serialized_data)
                 objects.append(deserialized_obj)
             return objects
 
         # cache miss
-        cls._load_cache_to_list(key, queryset)
+        return cls._rebuild_cache(key, queryset)
+
+    @classmethod
+    def _find_window_start(cls, conn, key, serialized_list, length, created_at__lt):
+        """
+        Index of the first cached object not newer than the created_at__lt
+        cursor, so that deep pages do not deserialize every newer object.
+        A binary search, in the first window already fetched or else by
+        LINDEX, decodes O(log n) objects.
+        """
+        upper = to_upper_keyset(created_at__lt)
+        if serialized_list and len(serialized_list) < length \
+                and cls.serializer.deserialize(serialized_list[-1]).created_at > upper.created_at:
+            low, high = len(serialized_list), length
+            get_entry = partial(conn.lindex, key)
+        else:
+            low, high = 0, len(serialized_list)
+            get_entry = serialized_list.__getitem__
+
+        while low < high:
+            middle = (low + high) // 2
+            serialized_data = get_entry(middle)
+            if serialized_data is None:
+                # the list shrank meanwhile
+                high = middle
+            elif cls.serializer.deserialize(serialized_data).created_at > upper.created_at:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @classmethod
+    def _iter_cached_objects(cls, conn, key, serialized_list, length, window_size, start=0):
+        # deserialize lazily from start, fetch the next window only when it
+        # is reached
+        if start < len(serialized_list):
+            serialized_list = serialized_list[start:]
+        elif start < length:
+            serialized_list = conn.lrange(key, start, start + window_size - 1)
+        else:
+            return
+        while serialized_list:
+            for serialized_data in serialized_list:
+                yield cls.serializer.deserialize(serialized_data)
+            start += len(serialized_list)
+            if start >= length:
+                return
+            serialized_list = conn.lrange(key, start, start + window_size - 1)
+
+    @classmethod
+    def _filter_window(cls, objects, count, created_at__lt, created_at__gt):
+        """
+        objects are ordered by created_at desc, those sharing a created_at
+        may be cached out of keyset order, so the window is sorted by keyset
+        """
+        upper = to_upper_keyset(created_at__lt)
+        lower = to_lower_keyset(created_at__gt)
+        window = []
+        for obj in objects:
+            if lower is not None and obj.created_at < lower.created_at:
+                break
+            if count is not None and len(window) >= count \
+                    and obj.created_at < window[-1].created_at:
+                break
+            keyset = get_keyset(obj)
+            if upper is not None and keyset >= upper:
+                continue
+            if lower is not None and keyset <= lower:
+                continue
+            window.append(obj)
+        window.sort(key=get_keyset, reverse=True)
+        return window[:count] if count is not None else window
+
+    # replies queued by _queue_window
+    WINDOW_REPLIES = 3
+
+    @classmethod
+    def _queue_window(cls, pipe, key, count, created_at__lt, created_at__gt):
+        window_size = count or settings.REDIS_LIST_LENGTH_LIMIT
+        pipe.llen(key)
+        pipe.lrange(key, 0, window_size - 1)
+        pipe.pttl(key)
+
+    @classmethod
+    def _read_window(cls, conn, key, queryset, replies, count, created_at__lt, created_at__gt):
+        window_size = count or settings.REDIS_LIST_LENGTH_LIMIT
+        length, serialized_list, ttl = replies
+
+        # cache hit
+        if length:
+            cls._rearm_expiry_early(conn, key, ttl)
+            start = 0
+            if created_at__lt is not None:
+                start = cls._find_window_start(
+                    conn,
+                    key,
+                    serialized_list,
+                    length,
+                    created_at__lt,
+                )
+            objects = cls._iter_cached_objects(
+                conn,
+                key,
+                serialized_list,
+                length,
+                window_size,
+                start,
+            )
+            window = cls._filter_window(objects, count, created_at__lt, created_at__gt)
+            return window, length
+
+        # cache miss
+        objects = cls._rebuild_cache(key, queryset)
+        window = cls._filter_window(objects, count, created_at__lt, created_at__gt)
+        return window, len(objects)
+
+    @classmethod
+    def load_objects_window(
+        cls,
+        key,
+        queryset,
+        count=None,
+        created_at__lt=None,
+        created_at__gt=None,
+    ):
+        """
+        Load at most `count` cached objects created between the cursors,
+        only the windows of the list that are reached get fetched and
+        deserialized. Returns the objects and the length of the cached list.
+        """
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        cls._queue_window(pipe, key, count, created_at__lt, created_at__gt)
+        return cls._read_window(
+            conn,
+            key,
+            queryset,
+            pipe.execute(),
+            count,
+            created_at__lt,
+            created_at__gt,
+        )
 
+    @classmethod
+    def load_objects_windows(
+        cls,
+        keys_and_querysets,
+        count=None,
+        created_at__lt=None,
+        created_at__gt=None,
+    ):
+        """
+        load_objects_window of many cached lists, the first windows of all
+        of them are read in one pipeline
+        """
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        for key, _ in keys_and_querysets:
+            cls._queue_window(pipe, key, count, created_at__lt, created_at__gt)
+        replies = pipe.execute()
+        size = cls.WINDOW_REPLIES
+        return [
+            cls._read_window(
+                conn,
+                key,
+                queryset,
+                replies[index * size:index * size + size],
+                count,
+                created_at__lt,
+                created_at__gt,
+            )
+            for index, (key, queryset) in enumerate(keys_and_querysets)
+        ]
+
+    @classmethod
+    def _complete_window(
+        cls,
+        queryset,
+        objects,
+        cached_length,
+        count,
+        created_at__lt,
+        created_at__gt,
+    ):
+        # cache contains all data
+        if cached_length < settings.REDIS_LIST_LENGTH_LIMIT:
+            return objects
+        if count is not None and len(objects) >= count:
+            return objects
+        # an older cached object closed the window
+        if count is None and created_at__lt is None and len(objects) < cached_length:
+            return objects
+
+        queryset = filter_queryset(queryset, created_at__lt, created_at__gt)
+        queryset = order_queryset(queryset)
+        if count is not None:
+            queryset = queryset[:count]
         return list(queryset)
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
+    def load_complete_window(
+        cls,
+        key,
+        queryset,
+        count=None,
+        created_at__lt=None,
+        created_at__gt=None,
+    ):
+        """
+        Same as load_objects_window, but a window reaching beyond the cached
+        list is read from db, so it is always complete. For timelines which
+        are merged and can not fall back to db one by one.
+        """
+        objects, cached_length = cls.load_objects_window(
+            key,
+            queryset,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        return cls._complete_window(
+            queryset,
+            objects,
+            cached_length,
+            count,
+            created_at__lt,
+            created_at__gt,
+        )
+
+    @classmethod
+    def load_complete_windows(
+        cls,
+        keys_and_querysets,
+        count=None,
+        created_at__lt=None,
+        created_at__gt=None,
+    ):
+        windows = cls.load_objects_windows(
+            keys_and_querysets,
+            count,
+            created_at__lt=created_at__lt,
+            created_at__gt=created_at__gt,
+        )
+        return [
+            cls._complete_window(
+                queryset,
+                objects,
+                cached_length,
+                count,
+                created_at__lt,
+                created_at__gt,
+            )
+            for (_, queryset), (objects, cached_length) in zip(keys_and_querysets, windows)
+        ]
+
+    @classmethod
+    def delete_cache(cls, key):
         conn = RedisClient.get_connection()
-        if not conn.exists(key):
-            # if the key not exists, will push all data to cache
-            cls._load_cache_to_list(key, queryset)
+        conn.delete(key)
+
+    @classmethod
+    def remove_objects_by_value(cls, keys_and_objects):
+        """
+        Remove objects from many cached lists in one pipeline, matching
+        the cached entries by value. Only for objects whose fields do not
+        change once cached, like newsfeeds.
+        """
+        if not keys_and_objects:
             return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        # left push
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for key, obj in keys_and_objects:
+            for serialized_data in cls.serializer.serialize_versions(obj):
+                pipe.lrem(key, 0, serialized_data)
+        pipe.execute()
+
+    @classmethod
+    def _update_cached_list(cls, key, update):
+        """
+        Rewrite a cached list with update(entries), entries are (serialized
+        data, object) pairs newest first. Runs in a transaction retried on
+        concurrent writes, lists not in cache are skipped.
+        """
+        conn = RedisClient.get_connection()
+        with conn.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    serialized_list = pipe.lrange(key, 0, -1)
+                    if not serialized_list:
+                        return False
+                    entries = [
+                        (serialized_data, cls.serializer.deserialize(serialized_data))
+                        for serialized_data in serialized_list
+                    ]
+                    limit = max(settings.REDIS_LIST_LENGTH_LIMIT, len(entries))
+                    entries = update(entries)[:limit]
+                    pipe.multi()
+                    pipe.delete(key)
+                    if entries:
+                        pipe.rpush(key, *[serialized_data for serialized_data, _ in entries])
+                        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    @classmethod
+    def merge_objects(cls, key, objects):
+        """
+        Merge objects of any created_at into a cached list, objects already
+        in the list are skipped
+        """
+        def update(entries):
+            cached_ids = set(obj.id for _, obj in entries)
+            new_entries = sorted(
+                [
+                    (cls.serializer.serialize(obj), obj)
+                    for obj in objects
+                    if obj.id not in cached_ids
+                ],
+                key=lambda entry: entry[1].created_at,
+                reverse=True,
+            )
+            return list(heapq.merge(
+                entries,
+                new_entries,
+                key=lambda entry: entry[1].created_at,
+                reverse=True,
+            ))
+        return cls._update_cached_list(key, update)
+
+    @classmethod
+    def replace_object(cls, key, obj):
+        # rewrite the cached entry of an updated object in place
+        serialized_data = cls.serializer.serialize(obj)
+        return cls._update_cached_list(key, lambda entries: [
+            (serialized_data, obj) if cached_obj.id == obj.id else (cached_data, cached_obj)
+            for cached_data, cached_obj in entries
+        ])
+
+    @classmethod
+    def remove_objects(cls, key, ids):
+        ids = set(ids)
+        return cls._update_cached_list(key, lambda entries: [
+            entry
+            for entry in entries
+            if entry[1].id not in ids
+        ])
+
+    @classmethod
+    def push_object(cls, key, obj, queryset):
+        # left push and trim in one round trip
+        script = RedisClient.get_script(LIST_PUSH_SCRIPT)
+        pushed = script(keys=[key], args=cls._get_push_args(obj))
+        if pushed == 0:
+            # if the key not exists, will push all data to cache
+            cls._rebuild_cache(key, queryset)
+
+    @classmethod
+    def push_objects(cls, keys_and_objects):
+        """
+        Push objects to many cached lists in one pipeline, for fanouts.
+        Lists not in cache are skipped instead of rebuilt, they load the
+        objects from db on next read. Returns the number of pushed objects.
+        """
+        if not keys_and_objects:
+            return 0
+        conn = RedisClient.get_connection()
+        script = RedisClient.get_script(LIST_PUSH_SCRIPT)
+        pipe = conn.pipeline(transaction=False)
+        for key, obj in keys_and_objects:
+            script(keys=[key], args=cls._get_push_args(obj), client=pipe)
+        return sum(pushed == 1 for pushed in pipe.execute())
+
+    @classmethod
+    def _get_push_args(cls, obj):
+        args = [
+            cls.serializer.serialize(obj),
+            settings.REDIS_LIST_LENGTH_LIMIT,
+            (obj.created_at - EPOCH) // ONE_MICROSECOND,
+        ]
+        for header, position in cls.serializer.get_field_positions(obj.__class__, 'created_at'):
+            args.extend([header, position])
+        return args
+
+    @classmethod
+    def extend_cache(cls, key, queryset, max_length):
+        """
+        Append the objects following the tail of a cached list, for readers
+        scrolling past it, until the list holds max_length objects.
+        Returns the number of objects appended.
+        """
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.llen(key)
+        pipe.lindex(key, -1)
+        length, tail = pipe.execute()
+        if not length or length >= max_length:
+            return 0
+
+        upper = get_keyset(cls.serializer.deserialize(tail))
+        queryset = order_queryset(filter_queryset(queryset, created_at__lt=upper))
+        objects = list(queryset[:max_length - length])
+        if not objects:
+            return 0
+        script = RedisClient.get_script(LIST_EXTEND_SCRIPT)
+        extended = script(keys=[key], args=[
+            tail,
+            *[cls.serializer.serialize(obj) for obj in objects],
+        ])
+        if not extended:
+            # the tail moved meanwhile
+            return 0
+        return len(objects)
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{},{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
+    @classmethod
+    def get_pending_count_key(cls, model_class, attr):
+        return PENDING_COUNTS_PATTERN.format(model=model_class.__name__, attr=attr)
+
+    @classmethod
+    def _get_flush_keys(cls, model_class, attr):
+        # lock of the flushes of a counter and their number
+        return (
+            COUNTS_FLUSH_LOCK_PATTERN.format(model=model_class.__name__, attr=attr),
+            COUNTS_FLUSH_EPOCH_PATTERN.format(model=model_class.__name__, attr=attr),
+        )
+
+    @classmethod
+    def _get_flush_epochs(cls, conn, model_class, attrs):
+        """
+        Read before a back-fill adds up db and the pending deltas, a flush
+        may move deltas from one to the other meanwhile
+        """
+        if not settings.COUNTER_WRITE_BEHIND:
+            return []
+        keys = [cls._get_flush_keys(model_class, attr)[1] for attr in attrs]
+        return [int(epoch or 0) for epoch in conn.mget(keys)]
+
+    @classmethod
+    def _cache_counts(cls, conn, model_class, attrs, epochs, counts):
+        """
+        Back-fill the counters of counts, a dict of counter key to count,
+        unless a flush of attrs ran since epochs were read. Counters
+        back-filled by incr/decr meanwhile are not overwritten.
+        """
+        keys = []
+        for attr in attrs[:len(epochs)]:
+            keys.extend(cls._get_flush_keys(model_class, attr))
+        keys.extend(counts.keys())
+        script = RedisClient.get_script(COUNTS_BACKFILL_SCRIPT)
+        return script(keys=keys, args=[
+            len(epochs),
+            settings.REDIS_KEY_EXPIRE_TIME,
+            *epochs,
+            *counts.values(),
+        ])
+
+    @classmethod
+    def _load_count_from_db(cls, obj, attr):
+        obj.refresh_from_db(fields=[attr])
+        count = getattr(obj, attr)
+        if settings.COUNTER_WRITE_BEHIND:
+            # deltas not flushed to db yet
+            conn = RedisClient.get_connection()
+            key = cls.get_pending_count_key(obj.__class__, attr)
+            count += int(conn.hget(key, obj.id) or 0)
+        return count
+
+    @classmethod
+    def _backfill_count(cls, conn, obj, attr):
+        epochs = cls._get_flush_epochs(conn, obj.__class__, [attr])
+        count = cls._load_count_from_db(obj, attr)
+        cls._cache_counts(conn, obj.__class__, [attr], epochs, {
+            cls.get_count_key(obj, attr): count,
+        })
+        return count
+
     @classmethod
     def incr_count(cls, obj, attr):
         conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
         if not conn.exists(key):
             # back-fill cache from db
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+            return cls._backfill_count(conn, obj, attr)
         return conn.incr(key)
 
     @classmethod
@@ -71,10 +720,7 @@ class RedisHelper:
         key = cls.get_count_key(obj, attr)
         if not conn.exists(key):
             # back-fill cache
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+            return cls._backfill_count(conn, obj, attr)
         return conn.decr(key)
 
     @classmethod
@@ -84,8 +730,424 @@ class RedisHelper:
         count = conn.get(key)
         if count is not None:
             return int(count)
+        return cls._backfill_count(conn, obj, attr)
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
+    @classmethod
+    def add_pending_count(cls, obj, attr, delta):
+        """
+        Write-behind: record a counter delta to be flushed to db in batch
+        by flush_pending_counts
+        """
+        conn = RedisClient.get_connection()
+        key = cls.get_pending_count_key(obj.__class__, attr)
+        conn.hincrby(key, obj.id, delta)
+
+    @classmethod
+    def flush_pending_counts(cls, model_class, attr, batch_size=500):
+        """
+        Apply the pending deltas of a counter to db, one UPDATE per distinct
+        delta and batch of ids, and only then take them out of the pending
+        hash, so that db plus pending deltas never miss a delta. Deltas
+        recorded meanwhile stay pending. Returns the number of flushed
+        objects, 0 if another flush of the counter is running.
+        """
+        conn = RedisClient.get_connection()
+        lock_key, _ = cls._get_flush_keys(model_class, attr)
+        token = RedisLock.acquire(lock_key, settings.COUNTER_FLUSH_LOCK_TIMEOUT)
+        if token is None:
+            return 0
+        try:
+            return cls._flush_pending_counts(conn, model_class, attr, batch_size)
+        finally:
+            RedisLock.release(lock_key, token)
+
+    @classmethod
+    def _flush_pending_counts(cls, conn, model_class, attr, batch_size):
+        key = cls.get_pending_count_key(model_class, attr)
+        ids_by_delta = {}
+        for object_id, delta in conn.hgetall(key).items():
+            ids_by_delta.setdefault(int(delta), []).append(int(object_id))
+
+        # deltas left at 0 are only cleared
+        flushed = {object_id: 0 for object_id in ids_by_delta.pop(0, [])}
+        try:
+            for delta, ids in ids_by_delta.items():
+                for i in range(0, len(ids), batch_size):
+                    batch = ids[i:i + batch_size]
+                    model_class.objects.filter(id__in=batch) \
+                        .update(**{attr: F(attr) + delta})
+                    flushed.update((object_id, delta) for object_id in batch)
+        finally:
+            # what is not flushed stays pending, the next run will retry
+            _, epoch_key = cls._get_flush_keys(model_class, attr)
+            script = RedisClient.get_script(PENDING_COUNTS_TAKE_SCRIPT)
+            script(keys=[key, epoch_key], args=[
+                item
+                for object_id, delta in flushed.items()
+                for item in (object_id, delta)
+            ])
+        return sum(1 for delta in flushed.values() if delta != 0)
+
+    @classmethod
+    def reconcile_counts(cls, model_class, attr, counts):
+        """
+        Fix the drift of a counter, counts maps object ids to their counts
+        recounted from db. Pending deltas are kept, db is set to the count
+        minus the pending delta while no flush of the counter runs and the
+        counters are back-filled on next read. Returns the ids of the fixed
+        objects, None if a flush of the counter is running.
+        """
+        conn = RedisClient.get_connection()
+        lock_key, epoch_key = cls._get_flush_keys(model_class, attr)
+        token = RedisLock.acquire(lock_key, settings.COUNTER_FLUSH_LOCK_TIMEOUT)
+        if token is None:
+            return None
+        try:
+            ids = list(counts.keys())
+            rows = model_class.objects.filter(id__in=ids).values_list('id', attr)
+            pending_counts = conn.hmget(cls.get_pending_count_key(model_class, attr), ids)
+            pending_counts = dict(zip(ids, pending_counts))
+            fixed = []
+            for object_id, count in rows:
+                pending_count = int(pending_counts[object_id] or 0)
+                if count + pending_count != counts[object_id]:
+                    model_class.objects.filter(id=object_id) \
+                        .update(**{attr: counts[object_id] - pending_count})
+                    fixed.append(object_id)
+
+            pipe = conn.pipeline()
+            for object_id in ids:
+                pipe.delete(cls.get_count_key(model_class(id=object_id), attr))
+            # back-fills which read db before it was fixed are not cached
+            pipe.incr(epoch_key)
+            pipe.execute()
+            return fixed
+        finally:
+            RedisLock.release(lock_key, token)
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        """
+        Counters of a page of objects in one MGET, misses are back-filled
+        with a single id__in query. Returns {object id: {attr: count}}
+        """
+        if not objects:
+            return {}
+        conn = RedisClient.get_connection()
+        keys = [
+            cls.get_count_key(obj, attr)
+            for obj in objects
+            for attr in attrs
+        ]
+        cached_counts = iter(conn.mget(keys))
+        counts, missing_objects = {}, {}
+        for obj in objects:
+            counts[obj.id] = {}
+            for attr in attrs:
+                count = next(cached_counts)
+                if count is None:
+                    missing_objects[obj.id] = obj
+                    continue
+                counts[obj.id][attr] = int(count)
+        if not missing_objects:
+            return counts
+
+        # cache miss, back-fill from db
+        model_class = objects[0].__class__
+        epochs = cls._get_flush_epochs(conn, model_class, attrs)
+        queryset = model_class.objects.filter(id__in=missing_objects.keys())
+        rows = list(queryset.values('id', *attrs))
+        if settings.COUNTER_WRITE_BEHIND and rows:
+            # deltas not flushed to db yet
+            pipe = conn.pipeline()
+            for attr in attrs:
+                key = cls.get_pending_count_key(model_class, attr)
+                pipe.hmget(key, [row['id'] for row in rows])
+            for attr, pending_counts in zip(attrs, pipe.execute()):
+                for row, delta in zip(rows, pending_counts):
+                    row[attr] += int(delta or 0)
+
+        backfilled = {}
+        for row in rows:
+            obj = missing_objects[row['id']]
+            for attr in attrs:
+                counts[obj.id][attr] = row[attr]
+                backfilled[cls.get_count_key(obj, attr)] = row[attr]
+        if backfilled:
+            cls._cache_counts(conn, model_class, attrs, epochs, backfilled)
+        return counts
+
+
+# replace the member of the same keyset id (same created_at score) so that
+# duplicated pushes are idempotent, members cached with another id prefix
+# match by value, then trim the oldest members, sets extended past the
+# limit keep their size
+SORTED_SET_PUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local limit = math.max(tonumber(ARGV[3]), redis.call('ZCARD', KEYS[1]))
+local id_prefix = string.sub(ARGV[2], 1, 8)
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])) do
+    if string.sub(member, 1, 8) == id_prefix or string.sub(member, 9) == string.sub(ARGV[2], 9) then
+        redis.call('ZREM', KEYS[1], member)
+    end
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -limit - 1)
+return 1
+"""
+
+# same as LIST_EXTEND_SCRIPT, ARGV[2..] are score and member pairs
+SORTED_SET_EXTEND_SCRIPT = """
+if redis.call('ZRANGE', KEYS[1], 0, 0)[1] ~= ARGV[1] then
+    return 0
+end
+return redis.call('ZADD', KEYS[1], unpack(ARGV, 2))
+"""
+
+# same as LIST_LOAD_SCRIPT, ARGV[2..] are score and member pairs
+SORTED_SET_LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class RedisSortedSetHelper(RedisHelper):
+    """
+    Cached timelines stored in sorted sets scored by created_at (in
+    microseconds), cursors are resolved by range-by-score in O(log n).
+    Members are the 8-byte big-endian object id followed by the serialized
+    object, so objects sharing a created_at are ordered by id.
+    """
+    ID_PREFIX = struct.Struct('>Q')
+
+    @classmethod
+    def get_sorted_set_key(cls, key):
+        # keep apart from the list of the same timeline
+        return '{}:zset'.format(key)
+
+    @classmethod
+    def get_score(cls, created_at):
+        return (created_at - EPOCH) // ONE_MICROSECOND
+
+    @classmethod
+    def _serialize_member(cls, obj):
+        serialized_data = cls.serializer.serialize(obj)
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode('utf-8')
+        return cls._get_id_prefix(obj) + serialized_data
+
+    @classmethod
+    def _get_id_prefix(cls, obj):
+        # members sharing a score are ordered by the keyset id of the
+        # cursors, bulk created objects may come without id
+        return cls.ID_PREFIX.pack(getattr(obj, get_id_field(obj.__class__)) or 0)
+
+    @classmethod
+    def _deserialize_member(cls, member):
+        return cls.serializer.deserialize(member[cls.ID_PREFIX.size:])
+
+    @classmethod
+    def _load_cache_to_sorted_set(cls, key, objects):
+        args = []
+        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
+            args.append(cls.get_score(obj.created_at))
+            args.append(cls._serialize_member(obj))
+
+        if args:
+            script = RedisClient.get_script(SORTED_SET_LOAD_SCRIPT)
+            script(keys=[key], args=[settings.REDIS_KEY_EXPIRE_TIME, *args])
+
+    @classmethod
+    def _load_cache(cls, key, objects):
+        cls._load_cache_to_sorted_set(key, objects)
+
+    @classmethod
+    def _read_cache(cls, key):
+        conn = RedisClient.get_connection()
+        return [
+            cls._deserialize_member(member)
+            for member in conn.zrevrange(key, 0, -1)
+        ]
+
+    @classmethod
+    def load_objects(cls, key, queryset):
+        conn = RedisClient.get_connection()
+        key = cls.get_sorted_set_key(key)
+
+        pipe = conn.pipeline()
+        pipe.zrevrange(key, 0, -1)
+        pipe.pttl(key)
+        members, ttl = pipe.execute()
+
+        # cache hit
+        if members:
+            cls._rearm_expiry_early(conn, key, ttl)
+            return [cls._deserialize_member(member) for member in members]
+
+        # cache miss
+        return cls._rebuild_cache(key, queryset)
+
+    WINDOW_REPLIES = 4
+
+    @classmethod
+    def _queue_window(cls, pipe, key, count, created_at__lt, created_at__gt):
+        """
+        Members at the score of a keyset upper bound are read apart, since
+        those which are not before the keyset would shorten the window
+        """
+        key = cls.get_sorted_set_key(key)
+        max_score = '+inf'
+        min_score = '-inf'
+        if created_at__lt is not None:
+            upper = to_upper_keyset(created_at__lt)
+            max_score = '({}'.format(cls.get_score(upper.created_at))
+        if created_at__gt is not None:
+            # ties of a keyset lower bound are filtered in _read_window
+            lower = to_lower_keyset(created_at__gt)
+            min_score = cls.get_score(lower.created_at)
+            if not isinstance(created_at__gt, Keyset):
+                min_score = '({}'.format(min_score)
+        pipe.zcard(key)
+        if isinstance(created_at__lt, Keyset):
+            tie_score = cls.get_score(created_at__lt.created_at)
+            pipe.zrevrangebyscore(key, tie_score, tie_score)
+        else:
+            # placeholder, every window queues WINDOW_REPLIES commands
+            pipe.zcard(key)
+        if count is None:
+            pipe.zrevrangebyscore(key, max_score, min_score)
+        else:
+            pipe.zrevrangebyscore(key, max_score, min_score, start=0, num=count)
+        pipe.pttl(key)
+
+    @classmethod
+    def _read_window(cls, conn, key, queryset, replies, count, created_at__lt, created_at__gt):
+        key = cls.get_sorted_set_key(key)
+        length, tie_members, members, ttl = replies
+        if not isinstance(created_at__lt, Keyset):
+            # placeholder reply
+            tie_members = []
+
+        # cache hit
+        if length:
+            cls._rearm_expiry_early(conn, key, ttl)
+            objects = [
+                cls._deserialize_member(member)
+                for member in tie_members + members
+            ]
+            window = cls._filter_window(objects, count, created_at__lt, created_at__gt)
+            return window, length
+
+        # cache miss
+        objects = cls._rebuild_cache(key, queryset)
+        window = cls._filter_window(objects, count, created_at__lt, created_at__gt)
+        return window, len(objects)
+
+    @classmethod
+    def delete_cache(cls, key):
+        conn = RedisClient.get_connection()
+        conn.delete(cls.get_sorted_set_key(key))
+
+    @classmethod
+    def remove_objects_by_value(cls, keys_and_objects):
+        if not keys_and_objects:
+            return
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for key, obj in keys_and_objects:
+            id_prefix = cls._get_id_prefix(obj)
+            pipe.zrem(cls.get_sorted_set_key(key), *[
+                id_prefix + serialized_data
+                for serialized_data in cls.serializer.serialize_versions(obj)
+            ])
+        pipe.execute()
+
+    @classmethod
+    def merge_objects(cls, key, objects):
+        # members are ordered by score, merging is pushing
+        return cls.push_objects([(key, obj) for obj in objects]) > 0
+
+    @classmethod
+    def replace_object(cls, key, obj):
+        # the member of the same id and created_at is replaced by pushing
+        return cls.push_objects([(key, obj)]) > 0
+
+    @classmethod
+    def remove_objects(cls, key, ids):
+        conn = RedisClient.get_connection()
+        key = cls.get_sorted_set_key(key)
+        # members are prefixed with the keyset id, which may not be the id
+        ids = set(ids)
+        members = [
+            member
+            for member in conn.zrange(key, 0, -1)
+            if cls._deserialize_member(member).id in ids
+        ]
+        if not members:
+            return False
+        conn.zrem(key, *members)
+        return True
+
+    @classmethod
+    def extend_cache(cls, key, queryset, max_length):
+        conn = RedisClient.get_connection()
+        key = cls.get_sorted_set_key(key)
+        pipe = conn.pipeline()
+        pipe.zcard(key)
+        pipe.zrange(key, 0, 0)
+        length, tail = pipe.execute()
+        if not length or length >= max_length:
+            return 0
+
+        upper = get_keyset(cls._deserialize_member(tail[0]))
+        queryset = order_queryset(filter_queryset(queryset, created_at__lt=upper))
+        objects = list(queryset[:max_length - length])
+        if not objects:
+            return 0
+        args = []
+        for obj in objects:
+            args.append(cls.get_score(obj.created_at))
+            args.append(cls._serialize_member(obj))
+        script = RedisClient.get_script(SORTED_SET_EXTEND_SCRIPT)
+        return script(keys=[key], args=[tail[0], *args])
+
+    @classmethod
+    def push_object(cls, key, obj, queryset):
+        key = cls.get_sorted_set_key(key)
+        script = RedisClient.get_script(SORTED_SET_PUSH_SCRIPT)
+        pushed = script(keys=[key], args=[
+            cls.get_score(obj.created_at),
+            cls._serialize_member(obj),
+            settings.REDIS_LIST_LENGTH_LIMIT,
+        ])
+        if not pushed:
+            # if the key not exists, will push all data to cache
+            cls._rebuild_cache(key, queryset)
+
+    @classmethod
+    def push_objects(cls, keys_and_objects):
+        if not keys_and_objects:
+            return 0
+        conn = RedisClient.get_connection()
+        script = RedisClient.get_script(SORTED_SET_PUSH_SCRIPT)
+        pipe = conn.pipeline(transaction=False)
+        for key, obj in keys_and_objects:
+            script(keys=[cls.get_sorted_set_key(key)], args=[
+                cls.get_score(obj.created_at),
+                cls._serialize_member(obj),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+            ], client=pipe)
+        return sum(pipe.execute())
+
+
+def get_timeline_helper():
+    # redis structure backing the cached timelines, selected in settings
+    if settings.REDIS_TIMELINE_STORE == 'sorted_set':
+        return RedisSortedSetHelper
+    return RedisHelper
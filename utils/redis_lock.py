@@ -0,0 +1,36 @@
+import uuid
+
+from utils.redis_client import RedisClient
+
+# only the holder of the token can release the lock
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisLock:
+
+    @classmethod
+    def acquire(cls, key, timeout):
+        """
+        Try once to take the lock for `timeout` seconds,
+        returns the token of the lock or None if it is taken
+        """
+        conn = RedisClient.get_connection()
+        token = uuid.uuid4().hex
+        if conn.set(key, token, nx=True, px=int(timeout * 1000)):
+            return token
+        return None
+
+    @classmethod
+    def is_locked(cls, key):
+        conn = RedisClient.get_connection()
+        return bool(conn.exists(key))
+
+    @classmethod
+    def release(cls, key, token):
+        script = RedisClient.get_script(RELEASE_SCRIPT)
+        script(keys=[key], args=[token])
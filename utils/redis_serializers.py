@@ -1,6 +1,15 @@
+import json
+import struct
+from datetime import datetime, timedelta
+
+import pytz
 from django.core import serializers
+from django.db import models
 from utils.json_encoder import JSONEncoder
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
 
 class DjangoModelSerializer:
 
@@ -13,3 +22,111 @@ class DjangoModelSerializer:
     def deserialize(cls, serialized_data):
         # will return object
         return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class CompactModelSerializer:
+    """
+    Versioned codec for objects cached in redis lists.
+    Layout: a 3-byte header (codec version, model code, schema version)
+    followed by a json array of the registered field values in order.
+    Datetimes are stored as integer microseconds since epoch.
+
+    Models without a registered schema fall back to DjangoModelSerializer,
+    and entries written by DjangoModelSerializer (starting with b'[') can
+    still be read, so the codec rolls out without flushing redis.
+    """
+    CODEC_VERSION = 1
+    HEADER = struct.Struct('>BBB')
+
+    # (model code, schema version) -> (model class, fields, datetime flags)
+    _schemas = {}
+    # model class -> (model code, schema version)
+    _latest_schemas = {}
+
+    @classmethod
+    def register(cls, model_class, code, version, fields):
+        """
+        Register the field tuple of one schema version of a model.
+        Old versions stay registered so entries already in redis can be read,
+        the highest version is used for writing.
+        """
+        is_datetime = tuple(
+            isinstance(model_class._meta.get_field(field), models.DateTimeField)
+            for field in fields
+        )
+        cls._schemas[(code, version)] = (model_class, tuple(fields), is_datetime)
+        latest = cls._latest_schemas.get(model_class)
+        if latest is None or latest[1] < version:
+            cls._latest_schemas[model_class] = (code, version)
+
+    @classmethod
+    def serialize(cls, instance):
+        schema_id = cls._latest_schemas.get(instance.__class__)
+        if schema_id is None:
+            return DjangoModelSerializer.serialize(instance)
+        return cls._serialize_schema(instance, schema_id)
+
+    @classmethod
+    def serialize_versions(cls, instance):
+        """
+        Every encoding of instance which may be cached, legacy one included,
+        so that cached entries can be removed by value
+        """
+        encodings = [DjangoModelSerializer.serialize(instance).encode('utf-8')]
+        for schema_id, (model_class, _, _) in cls._schemas.items():
+            if model_class == instance.__class__:
+                encodings.append(cls._serialize_schema(instance, schema_id))
+        return encodings
+
+    @classmethod
+    def get_field_positions(cls, model_class, field):
+        """
+        Header of each registered schema of model_class with the position
+        of field in its payload array, counting from 1 as lua scripts do
+        """
+        positions = []
+        for schema_id, (schema_class, fields, _) in cls._schemas.items():
+            if schema_class == model_class and field in fields:
+                header = cls.HEADER.pack(cls.CODEC_VERSION, *schema_id)
+                positions.append((header, fields.index(field) + 1))
+        return positions
+
+    @classmethod
+    def _serialize_schema(cls, instance, schema_id):
+        _, fields, is_datetime = cls._schemas[schema_id]
+        values = []
+        for field, field_is_datetime in zip(fields, is_datetime):
+            value = getattr(instance, field)
+            if field_is_datetime and value is not None:
+                value = (value - EPOCH) // ONE_MICROSECOND
+            values.append(value)
+        header = cls.HEADER.pack(cls.CODEC_VERSION, *schema_id)
+        payload = json.dumps(values, separators=(',', ':'), ensure_ascii=False)
+        return header + payload.encode('utf-8')
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if isinstance(serialized_data, str) or serialized_data[:1] == b'[':
+            # entry written before the compact codec rolled out
+            return DjangoModelSerializer.deserialize(serialized_data)
+
+        codec_version, code, version = cls.HEADER.unpack_from(serialized_data)
+        if codec_version != cls.CODEC_VERSION:
+            raise ValueError(f'Unknown codec version {codec_version}')
+        model_class, fields, is_datetime = cls._schemas[(code, version)]
+        values = json.loads(serialized_data[cls.HEADER.size:])
+
+        data = {}
+        for field, field_is_datetime, value in zip(fields, is_datetime, values):
+            if field_is_datetime and value is not None:
+                value = EPOCH + timedelta(microseconds=value)
+            data[field] = value
+        # fields missing from an older schema version fall back to defaults
+        field_names, field_values = [], []
+        for field in model_class._meta.concrete_fields:
+            field_names.append(field.attname)
+            if field.attname in data:
+                field_values.append(data[field.attname])
+            else:
+                field_values.append(field.get_default())
+        return model_class.from_db(None, field_names, field_values)
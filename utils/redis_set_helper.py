@@ -0,0 +1,138 @@
+import uuid
+
+from django.conf import settings
+from twitter.cache import (
+    SET_LOAD_PATTERN,
+    SET_LOADING_PATTERN,
+    SET_PENDING_OPS_PATTERN,
+)
+from utils.redis_client import RedisClient
+
+# KEYS are the set, its loading marker and its pending ops, ARGV[2] is the
+# command (SADD, SREM, ZADD or ZREM) followed by its arguments. A partial
+# set must not be created: while a load is in progress the write is
+# logged, as command, number of arguments, arguments, to be replayed onto
+# the loaded set
+SET_UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call(ARGV[2], KEYS[1], unpack(ARGV, 3))
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[2], #ARGV - 2, unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+end
+return 0
+"""
+
+# KEYS are the set, the set loaded aside, the loading marker and the
+# pending ops. The writes logged during the load are replayed in order
+# onto the loaded set before it is renamed in place, they are idempotent
+# set operations so replaying those already in the db snapshot is harmless
+SET_PUBLISH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[2])
+    return 0
+end
+local ops = redis.call('LRANGE', KEYS[4], 0, -1)
+local i = 1
+while i <= #ops do
+    local n = tonumber(ops[i + 1])
+    redis.call(ops[i], KEYS[2], unpack(ops, i + 2, i + 1 + n))
+    i = i + 2 + n
+end
+redis.call('RENAME', KEYS[2], KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[3], KEYS[4])
+return 1
+"""
+
+
+class RedisSetHelper:
+    """
+    Redis sets and sorted sets cached whole, such as the friends of a user.
+    A miss loads the set from db aside, in batches, and renames it in place
+    so readers never see it half loaded. Writes update the cached set, or
+    are logged while a load is in progress and replayed onto the loaded set
+    before it is published, so the db snapshot of a load can not lose them.
+    """
+
+    @classmethod
+    def get_keys(cls, key):
+        return [
+            key,
+            SET_LOADING_PATTERN.format(key=key),
+            SET_PENDING_OPS_PATTERN.format(key=key),
+        ]
+
+    @classmethod
+    def mark_loading(cls, key):
+        """
+        Log the writes to the set of key ahead of a load run in the
+        background. Returns False if a load is in progress already.
+        """
+        conn = RedisClient.get_connection()
+        _, loading_key, _ = cls.get_keys(key)
+        return bool(conn.set(loading_key, 1, ex=settings.REDIS_SET_LOAD_TIMEOUT, nx=True))
+
+    @classmethod
+    def load(cls, key, command, items, sentinel, batch_size, max_items=None):
+        """
+        Load the set of key with command (SADD or ZADD) from items, the
+        argument tuples of command, which must read db lazily, after the
+        loading marker is set. sentinel is added too so that empty sets
+        stay cached. Returns whether the set was published, None if it has
+        more than max_items items and is not cached.
+        """
+        conn = RedisClient.get_connection()
+        _, loading_key, pending_key = cls.get_keys(key)
+        load_key = SET_LOAD_PATTERN.format(key=key, token=uuid.uuid4().hex)
+        timeout = settings.REDIS_SET_LOAD_TIMEOUT
+        # writes from now on are logged for replay
+        conn.set(loading_key, 1, ex=timeout)
+
+        pipe = conn.pipeline(transaction=False)
+        pipe.execute_command(command, load_key, *sentinel)
+        pipe.expire(load_key, timeout)
+        pipe.execute()
+
+        count, args = 0, []
+        for item in items:
+            count += 1
+            if max_items is not None and count > max_items:
+                conn.delete(load_key)
+                return None
+            args.extend(item)
+            if len(args) >= batch_size * len(item):
+                cls._load_batch(pipe, command, key, load_key, args)
+                args = []
+        if args:
+            cls._load_batch(pipe, command, key, load_key, args)
+
+        script = RedisClient.get_script(SET_PUBLISH_SCRIPT)
+        published = script(
+            keys=[key, load_key, loading_key, pending_key],
+            args=[settings.REDIS_KEY_EXPIRE_TIME],
+        )
+        return bool(published)
+
+    @classmethod
+    def _load_batch(cls, pipe, command, key, load_key, args):
+        # one round trip per batch, the marker lives as long as the load
+        _, loading_key, _ = cls.get_keys(key)
+        pipe.execute_command(command, load_key, *args)
+        pipe.expire(load_key, settings.REDIS_SET_LOAD_TIMEOUT)
+        pipe.expire(loading_key, settings.REDIS_SET_LOAD_TIMEOUT)
+        pipe.execute()
+
+    @classmethod
+    def update(cls, key, command, *args, client=None):
+        """
+        Apply command (SADD, SREM, ZADD or ZREM) to the cached set of key,
+        queued on client when it is a pipeline
+        """
+        script = RedisClient.get_script(SET_UPDATE_SCRIPT)
+        return script(
+            keys=cls.get_keys(key),
+            args=[settings.REDIS_SET_LOAD_TIMEOUT, command, *args],
+            client=client,
+        )
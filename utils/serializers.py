@@ -0,0 +1,16 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    List serializer which lets the child serializer load the data of the
+    whole page in bulk, through child.prefetch(objects), before each
+    object is serialized
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        objects = list(iterable)
+        self.child.prefetch(objects)
+        return super().to_representation(objects)
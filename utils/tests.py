@@ -1,5 +1,20 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import CACHE_REBUILD_LOCK_PATTERN, LOCAL_CACHE_INVALIDATION_CHANNEL
+from utils.local_cache import LocalCache, local_cache
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper, RedisSortedSetHelper
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
 
 
 class UtilsTests(TestCase):
@@ -17,3 +32,317 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_compact_model_serializer(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user, 'compact tweet 中文')
+        tweet.refresh_from_db()
+
+        serialized_data = CompactModelSerializer.serialize(tweet)
+        legacy_data = DjangoModelSerializer.serialize(tweet).encode('utf-8')
+        self.assertEqual(len(serialized_data) < len(legacy_data), True)
+
+        # compact entries and legacy json entries are both readable
+        for data in [serialized_data, legacy_data]:
+            cached_tweet = CompactModelSerializer.deserialize(data)
+            self.assertEqual(isinstance(cached_tweet, Tweet), True)
+            self.assertEqual(cached_tweet.id, tweet.id)
+            self.assertEqual(cached_tweet.user_id, user.id)
+            self.assertEqual(cached_tweet.content, tweet.content)
+            self.assertEqual(cached_tweet.created_at, tweet.created_at)
+            self.assertEqual(cached_tweet.likes_count, 0)
+
+    def test_redis_sorted_set_helper(self):
+        self.clear_cache()
+        user = self.create_user('user1')
+        tweets = [
+            self.create_tweet(user, 'tweet {}'.format(i))
+            for i in range(settings.REDIS_LIST_LENGTH_LIMIT + 2)
+        ][::-1]
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        key = 'sorted_set_key'
+
+        # cache miss, load the latest objects up to the limit
+        window, length = RedisSortedSetHelper.load_objects_window(key, queryset, 3)
+        self.assertEqual([t.id for t in window], [t.id for t in tweets[:3]])
+        self.assertEqual(length, settings.REDIS_LIST_LENGTH_LIMIT)
+
+        # range by score
+        window, _ = RedisSortedSetHelper.load_objects_window(
+            key,
+            queryset,
+            2,
+            created_at__lt=tweets[4].created_at,
+        )
+        self.assertEqual([t.id for t in window], [tweets[5].id, tweets[6].id])
+        window, _ = RedisSortedSetHelper.load_objects_window(
+            key,
+            queryset,
+            created_at__gt=tweets[2].created_at,
+        )
+        self.assertEqual([t.id for t in window], [t.id for t in tweets[:2]])
+
+        # duplicated pushes are idempotent, oldest members get trimmed
+        new_tweet = self.create_tweet(user, 'new tweet')
+        for _ in range(2):
+            RedisSortedSetHelper.push_object(key, new_tweet, queryset)
+        cached_tweets = RedisSortedSetHelper.load_objects(key, queryset)
+        self.assertEqual(len(cached_tweets), settings.REDIS_LIST_LENGTH_LIMIT)
+        self.assertEqual(cached_tweets[0].id, new_tweet.id)
+        self.assertEqual(cached_tweets[1].id, tweets[0].id)
+
+    def test_deep_page_of_cached_list(self):
+        self.clear_cache()
+        user = self.create_user('user1')
+        tweets = [
+            self.create_tweet(user, 'tweet {}'.format(i))
+            for i in range(settings.REDIS_LIST_LENGTH_LIMIT)
+        ][::-1]
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        RedisHelper.load_objects('timeline_key', queryset)
+
+        class CountingSerializer(CompactModelSerializer):
+            decoded = 0
+
+            @classmethod
+            def deserialize(cls, serialized_data):
+                CountingSerializer.decoded += 1
+                return super().deserialize(serialized_data)
+
+        class CountingHelper(RedisHelper):
+            serializer = CountingSerializer
+
+        # the objects newer than the cursor are skipped without decoding
+        for i in [0, 1, 5, len(tweets) - 3, len(tweets) - 1]:
+            CountingSerializer.decoded = 0
+            window, _ = CountingHelper.load_objects_window(
+                'timeline_key',
+                queryset,
+                2,
+                created_at__lt=tweets[i].created_at,
+            )
+            self.assertEqual([t.id for t in window], [t.id for t in tweets[i + 1:i + 3]])
+            self.assertEqual(CountingSerializer.decoded <= 10, True)
+
+        # an object older than the full list is left to db, without rebuild
+        old_tweet = self.create_tweet(user)
+        old_tweet.created_at = tweets[-1].created_at - timedelta(seconds=1)
+        with self.assertNumQueries(0):
+            RedisHelper.push_object('timeline_key', old_tweet, queryset)
+            self.assertEqual(RedisHelper.push_objects([('timeline_key', old_tweet)]), 0)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.llen('timeline_key'), settings.REDIS_LIST_LENGTH_LIMIT)
+
+    def test_load_cache_only_if_absent(self):
+        self.clear_cache()
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for _ in range(3)][::-1]
+        conn = RedisClient.get_connection()
+
+        # concurrent back-fills do not push duplicated lists
+        RedisHelper._load_cache_to_list('list_key', tweets)
+        RedisHelper._load_cache_to_list('list_key', tweets)
+        self.assertEqual(conn.llen('list_key'), 3)
+        self.assertEqual(conn.ttl('list_key') > 0, True)
+
+        RedisSortedSetHelper._load_cache_to_sorted_set('zset_key', tweets)
+        RedisSortedSetHelper._load_cache_to_sorted_set('zset_key', tweets[:1])
+        self.assertEqual(conn.zcard('zset_key'), 3)
+
+        # push to an absent key back-fills from the queryset
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        RedisHelper.push_object('new_list_key', tweets[0], queryset)
+        self.assertEqual(conn.llen('new_list_key'), 3)
+        RedisHelper.push_object('new_list_key', tweets[0], queryset)
+        self.assertEqual(conn.llen('new_list_key'), 4)
+
+    def test_get_counts(self):
+        self.clear_cache()
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        tweets = [self.create_tweet(user1) for _ in range(3)]
+        self.create_like(user1, tweets[0])
+        self.create_like(user2, tweets[0])
+        self.create_comment(user2, tweets[1])
+        RedisClient.clear()
+
+        # cache miss, back-filled by one query
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        self.assertEqual(counts[tweets[0].id], {'likes_count': 2, 'comments_count': 0})
+        self.assertEqual(counts[tweets[1].id], {'likes_count': 0, 'comments_count': 1})
+
+        # cache hit
+        self.create_like(user1, tweets[1])
+        with self.assertNumQueries(0):
+            counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        self.assertEqual(counts[tweets[1].id], {'likes_count': 1, 'comments_count': 1})
+        self.assertEqual(counts[tweets[2].id], {'likes_count': 0, 'comments_count': 0})
+
+    def test_get_objects_through_cache(self):
+        self.clear_cache()
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        tweet_ids = [tweet.id for tweet in tweets]
+
+        # cache miss, one query for all objects
+        with self.assertNumQueries(1):
+            cached_tweets = MemcachedHelper.get_objects_through_cache(
+                Tweet,
+                tweet_ids + [-1],
+            )
+        self.assertEqual(set(cached_tweets.keys()), set(tweet_ids))
+
+        # cache hit
+        with self.assertNumQueries(0):
+            cached_tweets = MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+        self.assertEqual(cached_tweets[tweets[0].id].content, tweets[0].content)
+
+    @override_settings(CACHE_REBUILD_WAIT_TIMEOUT=0.05)
+    def test_waiter_does_not_release_rebuild_lock(self):
+        self.clear_cache()
+        tweet = self.create_tweet(self.create_user('user1'))
+        self.clear_cache()
+        key = MemcachedHelper.get_key(Tweet, tweet.id)
+        lock_key = CACHE_REBUILD_LOCK_PATTERN.format(key=key)
+        caches['testing'].add(lock_key, 1, settings.CACHE_REBUILD_LOCK_TIMEOUT)
+
+        # the holder is slow, the waiter reads db and leaves the lock alone
+        cached_tweet = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+        self.assertEqual(cached_tweet.id, tweet.id)
+        self.assertEqual(caches['testing'].get(lock_key), 1)
+        self.assertEqual(caches['testing'].get(key), None)
+
+    def test_rearm_expiry_early(self):
+        self.clear_cache()
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for _ in range(3)]
+        conn = RedisClient.get_connection()
+        RedisHelper._load_cache_to_list('timeline_key', tweets)
+
+        # far from expiry, the expiry is kept
+        conn.expire('timeline_key', settings.REDIS_KEY_EXPIRE_TIME - 100)
+        RedisHelper.load_objects_window('timeline_key', None, 2)
+        self.assertEqual(conn.ttl('timeline_key') < settings.REDIS_KEY_EXPIRE_TIME - 99, True)
+
+        # about to expire, reads re-arm the expiry
+        conn.expire('timeline_key', 1)
+        with self.settings(REDIS_EARLY_REARM_WINDOW=10 ** 9):
+            RedisHelper.load_objects_window('timeline_key', None, 2)
+        self.assertEqual(conn.ttl('timeline_key') > 1, True)
+
+
+# waiters do not give up on a slow rebuild and query the db themselves,
+# the tests check coalescing rather than the speed of the scheduler
+@override_settings(CACHE_REBUILD_WAIT_TIMEOUT=30)
+class SingleFlightRebuildTests(TransactionTestCase):
+    """
+    Cache misses from concurrent threads, each with its own db connection,
+    so the test data is committed for them to read it
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('user1')
+        self.tweets = [
+            Tweet.objects.create(user=self.user, content='tweet {}'.format(i))
+            for i in range(3)
+        ][::-1]
+        caches['testing'].clear()
+        local_cache.clear()
+        RedisClient.clear()
+
+    def run_concurrently(self, load, threads=20):
+        """
+        Call load from threads released at once, returns their results and
+        the number of db queries they ran
+        """
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+        results, queries = [], []
+
+        def count_query(execute, sql, params, many, context):
+            with lock:
+                queries.append(sql)
+            return execute(sql, params, many, context)
+
+        def run():
+            try:
+                with connection.execute_wrapper(count_query):
+                    barrier.wait()
+                    result = load()
+                with lock:
+                    results.append(result)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=run) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results, len(queries)
+
+    def test_redis_rebuild(self):
+        queryset = Tweet.objects.filter(user=self.user).order_by('-created_at')
+
+        def load():
+            window, _ = RedisHelper.load_objects_window('timeline_key', queryset, 2)
+            return [tweet.id for tweet in window]
+
+        results, queries = self.run_concurrently(load)
+        self.assertEqual(queries, 1)
+        self.assertEqual(results, [[self.tweets[0].id, self.tweets[1].id]] * 20)
+
+    def test_memcached_rebuild(self):
+        tweet = self.tweets[0]
+
+        def load():
+            return MemcachedHelper.get_object_through_cache(Tweet, tweet.id).content
+
+        results, queries = self.run_concurrently(load)
+        self.assertEqual(queries, 1)
+        self.assertEqual(results, [tweet.content] * 20)
+
+
+class LocalCacheTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def test_lru_and_ttl(self):
+        cache = LocalCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is the least recently used
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        expired_cache = LocalCache(max_size=2, ttl=-1)
+        expired_cache.set('a', 1)
+        self.assertEqual(expired_cache.get('a'), None)
+
+    def test_hydrated_attributes_do_not_leak(self):
+        user = self.create_user('user1')
+        cached_user = MemcachedHelper.get_object_through_cache(User, user.id)
+        cached_user._cached_user_profile = 'stale profile'
+        cached_user = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(hasattr(cached_user, '_cached_user_profile'), False)
+
+    def test_invalidation_broadcast(self):
+        user = self.create_user('user1')
+        key = MemcachedHelper.get_key(User, user.id)
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertNotEqual(local_cache.get(key), None)
+
+        # message published by another process
+        RedisClient.get_connection().publish(LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+        for _ in range(50):
+            if local_cache.get(key) is None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(local_cache.get(key), None)